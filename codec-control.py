@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+#
+# writes codec registers at runtime, without rebuilding the bitstream or re-enumerating
+#
+# usage: codec-control.py [--dac-volume DB] [--line-out-gain DB] [--mic-gain DB]
+#                         [--write PAGE REGISTER VALUE ...]
+#
+# The writes are queued on the device and sent to the TLV320AIC3254 over I2C
+# between the sample rate changes. See the register map in datasheets/TLV320AIC3254Manual.pdf
+#
+import sys
+import time
+import argparse
+import usb
+
+from device_protocol import find_device, vendor_request, REQUEST_WRITE_CODEC
+
+def dac_volume(db):
+    """ left and right DAC digital volume, -63.5 to +24 dB in 0.5 dB steps """
+    value = round(max(-63.5, min(24, db)) * 2) & 0xff
+    return [(0, 0x41, value), (0, 0x42, value)]
+
+def line_out_gain(db):
+    """ LOL and LOR driver gain, -6 to +29 dB in 1 dB steps, unmuted """
+    value = round(max(-6, min(29, db))) & 0x3f
+    return [(1, 0x12, value), (1, 0x13, value)]
+
+def mic_gain(db):
+    """ left and right MICPGA gain, 0 to 47.5 dB in 0.5 dB steps """
+    value = round(max(0, min(47.5, db)) * 2)
+    return [(1, 0x3b, value), (1, 0x3c, value)]
+
+def write_register(dev, page, register, value):
+    for _ in range(100):
+        try:
+            vendor_request(dev, REQUEST_WRITE_CODEC, (page << 8) | register, value)
+            return
+        except usb.core.USBError as error:
+            # the device stalls while its command queue is full
+            if error.errno != 32:
+                raise
+            time.sleep(0.001)
+    sys.exit("the codec command queue does not drain")
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--dac-volume",    type=float, help="DAC digital volume in dB")
+parser.add_argument("--line-out-gain", type=float, help="line out driver gain in dB")
+parser.add_argument("--mic-gain",      type=float, help="microphone PGA gain in dB")
+parser.add_argument("--write", nargs=3, action="append", default=[], metavar=("PAGE", "REGISTER", "VALUE"),
+                    help="write a register, numbers may be hex (0x..)")
+args = parser.parse_args()
+
+writes = []
+if args.dac_volume is not None:
+    writes += dac_volume(args.dac_volume)
+if args.line_out_gain is not None:
+    writes += line_out_gain(args.line_out_gain)
+if args.mic_gain is not None:
+    writes += mic_gain(args.mic_gain)
+writes += [tuple(int(number, 0) for number in write) for write in args.write]
+
+if not writes:
+    parser.error("nothing to write")
+
+dev = find_device()
+
+for page, register, value in writes:
+    write_register(dev, page, register, value)
+    print(f"page {page} register 0x{register:02x} = 0x{value:02x}")
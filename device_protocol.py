@@ -0,0 +1,75 @@
+#
+# what the host tools need to know about the interface: its IDs, the vendor requests
+# and the layout of the registers they read. The gateware defines them in
+# gateware/requesthandlers.py (VendorRequestHandlers) and in the blocks named below.
+#
+import sys
+
+VENDOR_ID  = 0x1209
+PRODUCT_ID = 0x4711
+
+# vendor requests to the device
+REQUEST_READ_HISTOGRAM     = 0x01
+REQUEST_CLEAR_HISTOGRAMS   = 0x02
+REQUEST_READ_TELEMETRY     = 0x03
+REQUEST_CLEAR_TELEMETRY    = 0x04
+REQUEST_SET_MONITOR_GAIN   = 0x05
+REQUEST_READ_MONITOR_GAINS = 0x06
+REQUEST_WRITE_CODEC        = 0x07
+REQUEST_SET_LOOPBACK       = 0x08
+REQUEST_READ_LOOPBACK      = 0x09
+
+# the data stage of an IN request is a single packet on the control endpoint
+MAX_REQUEST_LENGTH = 64
+
+# the ILA streams its samples from this interface and endpoint
+ILA_INTERFACE = 3
+ILA_ENDPOINT  = 0x83
+
+# Telemetry.REGISTERS in gateware/telemetry.py
+TELEMETRY_REGISTERS = [
+    "underflows",
+    "jitter_buffer_underruns",
+    "record_overflows",
+    "jitter_buffer_high_water",
+    "transmitter_high_water",
+    "record_high_water",
+    "feedback_value",
+    "sof_count",
+    "altsetting_changes",
+]
+
+# the latency histograms of USB2AudioInterface in gateware/deca_usb2_audio_interface.py
+HISTOGRAM_BINS      = 512
+HISTOGRAM_BIN_SHIFT = 8
+USB_CLOCK_FREQUENCY = 60e6
+
+# MonitorMixer in gateware/monitor_mixer.py
+MONITOR_UNITY_GAIN = 0x8000
+MONITOR_MAX_GAIN   = 0xffff
+
+# Loopback in gateware/loopback.py
+LOOPBACK_MODES     = {"off": 0, "digital": 1, "analog": 2}
+LOOPBACK_REGISTERS = ["mode", "latency", "measurements", "timeouts"]
+
+def find_device():
+    """ the interface as a pyusb device, exits when it is not connected """
+    import usb
+    dev = usb.core.find(idVendor=VENDOR_ID, idProduct=PRODUCT_ID)
+    if dev is None:
+        sys.exit("USB audio interface not found")
+    return dev
+
+def vendor_request(dev, request, value=0, index=0):
+    """ a vendor request to the device without data stage """
+    import usb
+    dev.ctrl_transfer(usb.util.CTRL_OUT | usb.util.CTRL_TYPE_VENDOR | usb.util.CTRL_RECIPIENT_DEVICE,
+                      request, value, index)
+
+def read_words(dev, request, value, index, count):
+    """ reads count little endian 32 bit words with a vendor request """
+    import usb
+    assert 4 * count <= MAX_REQUEST_LENGTH, f"{count} words do not fit into one request"
+    data = dev.ctrl_transfer(usb.util.CTRL_IN | usb.util.CTRL_TYPE_VENDOR | usb.util.CTRL_RECIPIENT_DEVICE,
+                             request, value, index, 4 * count)
+    return [int.from_bytes(data[i:i + 4], "little") for i in range(0, len(data), 4)]
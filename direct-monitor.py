@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+#
+# sets the direct monitoring gains of the interface: the inputs are mixed
+# into the outputs of the same channel on the FPGA, without a round trip through the host
+#
+# usage: direct-monitor.py [--channel N] [--gain DB | --off]
+#
+# Without --gain or --off the current gains are shown.
+#
+import math
+import argparse
+
+from device_protocol import find_device, vendor_request, read_words, \
+    REQUEST_SET_MONITOR_GAIN, REQUEST_READ_MONITOR_GAINS, MAX_REQUEST_LENGTH, \
+    MONITOR_UNITY_GAIN, MONITOR_MAX_GAIN
+
+GAINS_PER_REQUEST = MAX_REQUEST_LENGTH // 4
+
+def gain_to_register(db):
+    return min(round(MONITOR_UNITY_GAIN * 10**(db / 20)), MONITOR_MAX_GAIN)
+
+def read_gains(dev, nr_channels):
+    gains = []
+    for first_channel in range(0, nr_channels, GAINS_PER_REQUEST):
+        count = min(GAINS_PER_REQUEST, nr_channels - first_channel)
+        gains += read_words(dev, REQUEST_READ_MONITOR_GAINS, 0, first_channel, count)
+    return gains
+
+def format_gain(value):
+    if value == 0:
+        return "off"
+    return f"{20 * math.log10(value / MONITOR_UNITY_GAIN):+.1f} dB"
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--channel", type=int, action="append", help="input channel, may be repeated, default: all")
+parser.add_argument("--channels", type=int, default=2, help="number of channels of the codec")
+parser.add_argument("--gain", type=float, help="monitoring gain in dB, at most +6 dB")
+parser.add_argument("--off",  action="store_true", help="switch the monitoring off")
+args = parser.parse_args()
+
+dev = find_device()
+
+channels = args.channel or range(args.channels)
+
+if args.off or args.gain is not None:
+    value = 0 if args.off else gain_to_register(args.gain)
+    for channel in channels:
+        vendor_request(dev, REQUEST_SET_MONITOR_GAIN, value, channel)
+
+for channel, value in enumerate(read_gains(dev, args.channels)):
+    print(f"channel {channel}: {format_gain(value)}")
@@ -127,6 +127,16 @@ class ArrowDECAPlatform(IntelPlatform, LUNAPlatform):
             Attrs(io_standard="3.3-V LVCMOS")
         ),
 
+        # TDM codec on the GPIO header, the codec is the bus clock master
+        Resource("tdm", 0,
+            Subsignal("mclk",  Pins("P_8:11", dir="o")),
+            Subsignal("bclk",  Pins("P_8:13", dir="i")),
+            Subsignal("fsync", Pins("P_8:15", dir="i")),
+            Subsignal("dout",  Pins("P_8:17", dir="o")),
+            Subsignal("din",   Pins("P_8:19", dir="i")),
+            Attrs(io_standard="3.3-V LVCMOS")
+        ),
+
         SPIResource(0, clk="P_9:11", copi="P_9:13", cipo=None, cs_n="P_9:15", attrs=Attrs(io_standard="3.3-V LVCMOS")),
 
         Resource("audio", 0,
@@ -195,6 +205,31 @@ class ArrowDECAPlatform(IntelPlatform, LUNAPlatform):
             "41": "V17", "42": "W3"}),
     ]
 
+    def build(self, elaboratable, name="top", build_dir="build", do_build=True,
+              program_opts=None, do_program=False, **kwargs):
+        # quartus_pgm is always run the same way, see toolchain_program
+        if program_opts:
+            raise TypeError(f"ArrowDECAPlatform takes no program options, got {', '.join(program_opts)}")
+
+        from build_cache import BuildCache
+        if not BuildCache.enabled():
+            return super().build(elaboratable, name, build_dir, do_build, program_opts, do_program, **kwargs)
+
+        # the descriptors are only cached for builds, elaboration itself never touches the cache
+        cache = BuildCache()
+        if hasattr(elaboratable, "create_descriptors"):
+            elaboratable.descriptors = cache.descriptors(elaboratable, elaboratable.create_descriptors)
+
+        # skip the toolchain if an identical design was built before
+        if not do_build:
+            return super().build(elaboratable, name, build_dir, do_build, program_opts, do_program, **kwargs)
+
+        plan = self.prepare(elaboratable, name, **kwargs)
+        products = cache.execute(plan, build_dir, name, platform_file=__file__)
+        if do_program:
+            self.toolchain_program(products, name)
+        return products
+
     def toolchain_program(self, products, name):
         quartus_pgm = os.environ.get("QUARTUS_PGM", "quartus_pgm")
         with products.extract("{}.sof".format(name)) as bitstream_filename:
@@ -5,7 +5,36 @@ from amlib.stream           import StreamInterface
 from amlib.utils            import rising_edge_detected
 from amlib.stream.generator import PacketListStreamer
 
+from audio_pll              import AudioPLL
+
 class AudioInit(Elaboratable):
+    """ initializes the TLV320AIC3254 over I2C and switches its sample rate
+
+        There is no fixed power up delay: the codec is polled until it answers,
+        software reset, polled until the reset bit clears and then initialized. After the sample rate
+        has been programmed, done goes high as soon as the codec reports its DAC and ADC powered up,
+        which needs the clocks from the PLL.
+
+        A sample rate change powers the converters down, reconfigures the audio PLL (see AudioPLL)
+        to MCLK = 256 * fs and programs the codec dividers for it.
+        The codec reset is only released once, when the PLL has locked after power up.
+    """
+    CODEC_ADDRESS = 0x30
+    # the register reads are on page 0
+    SOFTWARE_RESET_REGISTER = 0x01
+    ADC_FLAG_REGISTER       = 0x24
+    DAC_FLAG_REGISTER       = 0x25
+    # left and right ADC / DAC powered up
+    ADC_POWERED_UP          = 0b0100_0100
+    DAC_POWERED_UP          = 0b1000_1000
+    # the codec has to be left alone for 1ms after a reset (at 60MHz)
+    RESET_LOCKOUT_CYCLES    = 60000
+
+    software_reset = [
+        [0x30, 0x00, 0x00],     # Initialize to Page 0
+        [0x30, 0x01, 0x01],     # software reset
+    ]
+
     # MCLK = 12.288MHz
     # PLL Disabled
     # DOSR 128
@@ -66,9 +95,9 @@ class AudioInit(Elaboratable):
         [0x30, 0x52, 0x00],        # Right ADC Channel Un-muted
     ]
 
+    # after software_reset
     minimal_dac = [
         [0x30, 0x00, 0x00],     # Initialize to Page 0
-        [0x30, 0x01, 0x01],     # software reset
         [0x30, 0x04, 0x00],     # MCLK PIN is CODEC_CLKIN
         [0x30, 0x1b, 0b00_11_1_1_00], # I2S, 32bit, BCLK Out, WCLK Out, 00
         [0x30, 0x0b, 0x81],     # Power up the NDAC divider with value 1
@@ -112,45 +141,218 @@ class AudioInit(Elaboratable):
         [0x30, 0x47, 0x84],  #enable, beep generator
     ]
 
-    def __init__(self) -> None:
-        self.start      = Signal()
-        self.done       = Signal()
-        self.stream_out = StreamInterface()
+    # MCLK = 256 * fs for every sample rate
+    MCLK_PER_SAMPLE = 256
+
+    # before the audio PLL is reconfigured
+    power_down_sequence = [
+        [0x30, 0x00, 0x00],         # Select Page 0
+        [0x30, 0x3f, 0x14],         # Power down the Left and Right DAC
+        [0x30, 0x51, 0x02],         # Power down the Left and Right ADC
+    ]
+
+    @staticmethod
+    def rate_family(sample_rate):
+        """ returns the base rate (44.1kHz or 48kHz) and the speed multiplier (1, 2 or 4) """
+        base_rate  = 48000 if sample_rate % 48000 == 0 else 44100
+        multiplier = sample_rate // base_rate
+        assert base_rate * multiplier == sample_rate and multiplier in [1, 2, 4], \
+            f"unsupported sample rate: {sample_rate}"
+        return base_rate, multiplier
+
+    @classmethod
+    def sample_rate_sequence(cls, sample_rate):
+        """ register writes which switch the codec over to the given sample rate,
+            after the audio PLL has been set to MCLK = 256 * fs.
+
+            The codec PLL is off, MCLK is CODEC_CLKIN. NDAC * MDAC = NADC * MADC = 2 * multiplier
+            give a modulator clock of 128 * base rate, and the oversampling ratios and the
+            bit clock divider select 1x, 2x or 4x speed.
+        """
+        base_rate, multiplier = cls.rate_family(sample_rate)
+
+        # DAC_CLK stays at or below 24.576MHz, MDAC * DOSR at or above 128
+        divider_n    = 2 if multiplier == 4 else 1
+        divider_m    = 2 * multiplier // divider_n
+        osr          = 128 // multiplier
+        bclk_n       = cls.MCLK_PER_SAMPLE // divider_n // 64 # BCLK = 64 * fs
+
+        # interpolation/decimation filter B handles up to 96kHz, filter C up to 192kHz
+        dac_processing_block = 8  if multiplier < 4  else 17 # PRB_P8 / PRB_P17
+        adc_processing_block = {1: 1, 2: 7, 4: 13}[multiplier] # PRB_R1 / PRB_R7 / PRB_R13
+
+        return [
+            [0x30, 0x00, 0x00],           # Select Page 0
+            [0x30, 0x05, 0x11],           # PLL powered down, P = 1, R = 1
+            [0x30, 0x04, 0x00],           # MCLK pin is CODEC_CLKIN
+            [0x30, 0x0b, 0x80 + divider_n], # Power up the NDAC divider
+            [0x30, 0x0c, 0x80 + divider_m], # Power up the MDAC divider
+            [0x30, 0x0d, osr >> 8],       # Program the OSR of DAC
+            [0x30, 0x0e, osr & 0xff],
+            [0x30, 0x12, 0x80 + divider_n], # Power up the NADC divider
+            [0x30, 0x13, 0x80 + divider_m], # Power up the MADC divider
+            [0x30, 0x14, osr & 0xff],     # Program the OSR of ADC
+            [0x30, 0x1e, 0x80 + bclk_n],         # BCLK N divider powered up
+            [0x30, 0x3c, dac_processing_block],  # Set the DAC processing block
+            [0x30, 0x3d, adc_processing_block],  # Set the ADC processing block
+            [0x30, 0x3f, 0xd4],           # Power up the Left and Right DAC
+            [0x30, 0x51, 0xc2],           # Power up the Left and Right ADC
+        ]
+
+    def __init__(self, sample_rates=[48000], default_sample_rate=48000) -> None:
+        # same order as the sample rate index of UAC2RequestHandlers
+        self._sample_rates        = sorted(sample_rates)
+        self._default_sample_rate = default_sample_rate
+
+        self.start             = Signal()
+        self.done              = Signal()
+        # high while a sequence is sent or the codec is polled
+        self.busy              = Signal()
+        self.sample_rate_index = Signal(range(len(sample_rates)))
+        self.set_sample_rate   = Signal()
+        self.stream_out        = StreamInterface()
+        self.codec_reset       = Signal()
+
+        # register reads, see I2CController
+        self.read_request      = Signal()
+        self.read_device       = Signal(8)
+        self.read_register     = Signal(8)
+        self.read_data         = Signal(8)
+        self.read_ack          = Signal()
+        self.read_done         = Signal()
 
     def elaborate(self, platform: Platform) -> Module:
         m = Module()
 
         m.domains += ClockDomain("audio")
 
-        audio_locked = Signal()
-
-        m.submodules.audio_pll = Instance("ALTPLL",
-            p_BANDWIDTH_TYPE         = "AUTO",
-            # audio master clock = 12.288 MHz = 48 kHz * 256
-            p_CLK0_DIVIDE_BY         = 83,
-            p_CLK0_DUTY_CYCLE        = 50,
-            p_CLK0_MULTIPLY_BY       = 17,
-            p_CLK0_PHASE_SHIFT       = 0,
+        active_sample_rate = Signal.like(self.sample_rate_index)
+        pll_reconfigure    = Signal()
+        pll_busy           = Signal()
 
-            p_INCLK0_INPUT_FREQUENCY = 16667,
-            p_OPERATION_MODE         = "NORMAL",
+        m.submodules.audio_pll = audio_pll = DomainRenamer("usb")(
+            AudioPLL([self.MCLK_PER_SAMPLE * rate for rate in self._sample_rates],
+                     self.MCLK_PER_SAMPLE * self._default_sample_rate))
 
-            i_inclk  = ClockSignal("usb"),
-            o_clk    = ClockSignal("audio"),
-            o_locked = audio_locked,
-        )
+        pll_started = Signal()
+        with m.If(audio_pll.locked):
+            m.d.usb += pll_started.eq(1)
 
-        m.d.comb += ResetSignal("audio").eq(~audio_locked)
+        m.d.comb += [
+            audio_pll.select.eq(active_sample_rate),
+            audio_pll.reconfigure.eq(pll_reconfigure),
+            pll_busy.eq(audio_pll.busy),
+            self.codec_reset.eq(~pll_started),
+        ]
 
-        m.submodules.audio_init_streamer = init_streamer = \
+        m.submodules.software_reset_streamer = reset_streamer = PacketListStreamer(self.software_reset)
+        m.submodules.power_down_streamer     = power_down_streamer = PacketListStreamer(self.power_down_sequence)
+        m.submodules.audio_init_streamer     = init_streamer  = \
             PacketListStreamer(self.minimal_dac + self.init_sequence_adc)
 
-        m.d.comb += [
-            init_streamer.start.eq(rising_edge_detected(m, self.start, domain="usb")),
-            self.stream_out.stream_eq(init_streamer.stream),
-        ]
+        sample_rate_streamers = []
+        for rate in self._sample_rates:
+            streamer = PacketListStreamer(self.sample_rate_sequence(rate))
+            m.submodules[f"sample_rate_{rate}_streamer"] = streamer
+            sample_rate_streamers.append(streamer)
+
+        # the sample rate has to be programmed once after the initial setup
+        sample_rate_pending = Signal(reset=1)
+        lockout             = Signal(range(self.RESET_LOCKOUT_CYCLES + 1))
+
+        with m.If(self.set_sample_rate):
+            m.d.usb += sample_rate_pending.eq(1)
+
+        m.d.comb += self.read_device.eq(self.CODEC_ADDRESS)
+
+        def poll(register, ready):
+            """ reads register until ready(value) holds, returns the condition for the next state """
+            m.d.comb += [
+                self.read_register.eq(register),
+                self.read_request.eq(~self.read_done),
+            ]
+            return self.read_done & self.read_ack & ready(self.read_data)
+
+        def stream(streamer):
+            m.d.comb += self.stream_out.stream_eq(streamer.stream)
+
+        with m.FSM(domain="usb") as fsm:
+            m.d.comb += self.busy.eq(~fsm.ongoing("IDLE") | sample_rate_pending)
+
+            with m.State("WAIT_START"):
+                with m.If(rising_edge_detected(m, self.start, domain="usb")):
+                    m.next = "PROBE"
+
+            # the codec does not answer while it is held in reset
+            with m.State("PROBE"):
+                with m.If(poll(self.SOFTWARE_RESET_REGISTER, lambda value: 1)):
+                    m.d.comb += reset_streamer.start.eq(1)
+                    m.next = "SOFTWARE_RESET"
+
+            with m.State("SOFTWARE_RESET"):
+                stream(reset_streamer)
+                with m.If(reset_streamer.done):
+                    m.next = "WAIT_RESET"
+
+            # the reset bit clears itself when the reset is complete
+            with m.State("WAIT_RESET"):
+                with m.If(poll(self.SOFTWARE_RESET_REGISTER, lambda value: ~value[0])):
+                    m.d.usb += lockout.eq(self.RESET_LOCKOUT_CYCLES)
+                    m.next = "LOCKOUT"
+
+            with m.State("LOCKOUT"):
+                m.d.usb += lockout.eq(lockout - 1)
+                with m.If(lockout == 0):
+                    m.d.comb += init_streamer.start.eq(1)
+                    m.next = "INIT"
+
+            with m.State("INIT"):
+                stream(init_streamer)
+                with m.If(init_streamer.done):
+                    m.next = "IDLE"
+
+            with m.State("IDLE"):
+                with m.If(sample_rate_pending):
+                    m.d.usb += [
+                        active_sample_rate.eq(self.sample_rate_index),
+                        sample_rate_pending.eq(0),
+                    ]
+                    m.d.comb += power_down_streamer.start.eq(1)
+                    m.next = "POWER_DOWN"
+
+            with m.State("POWER_DOWN"):
+                stream(power_down_streamer)
+                with m.If(power_down_streamer.done):
+                    m.d.comb += pll_reconfigure.eq(1)
+                    m.next = "AUDIO_PLL"
+
+            # the audio domain is held in reset until the PLL has locked again
+            with m.State("AUDIO_PLL"):
+                with m.If(~pll_busy):
+                    m.next = "START_SAMPLE_RATE"
+
+            with m.State("START_SAMPLE_RATE"):
+                for index, streamer in enumerate(sample_rate_streamers):
+                    m.d.comb += streamer.start.eq(active_sample_rate == index)
+                m.next = "SAMPLE_RATE"
+
+            with m.State("SAMPLE_RATE"):
+                for index, streamer in enumerate(sample_rate_streamers):
+                    with m.If(active_sample_rate == index):
+                        stream(streamer)
+                        with m.If(streamer.done):
+                            m.next = "WAIT_DAC"
+
+            # the converters only power up when their clocks run
+            with m.State("WAIT_DAC"):
+                with m.If(poll(self.DAC_FLAG_REGISTER,
+                               lambda value: (value & self.DAC_POWERED_UP) == self.DAC_POWERED_UP)):
+                    m.next = "WAIT_ADC"
 
-        with m.If(init_streamer.done):
-            m.d.usb += self.done.eq(1)
+            with m.State("WAIT_ADC"):
+                with m.If(poll(self.ADC_FLAG_REGISTER,
+                               lambda value: (value & self.ADC_POWERED_UP) == self.ADC_POWERED_UP)):
+                    m.d.usb += self.done.eq(1)
+                    m.next = "IDLE"
 
-        return m
\ No newline at end of file
+        return m
@@ -0,0 +1,212 @@
+from fractions        import Fraction
+
+from amaranth         import *
+from amaranth.build   import Platform
+from amaranth.lib.cdc import FFSynchronizer
+
+class AudioPLL(Elaboratable):
+    """ MAX 10 PLL which generates the audio master clock and is reconfigured at runtime
+
+        Each of frequencies gets its own M, N and C0 counter settings. On reconfigure,
+        the settings for select are shifted into the scan chain of the PLL, applied with configupdate
+        and the PLL is reset, so changing the frequency costs a relock instead of a different bitstream.
+        The audio domain is held in reset until the PLL has locked again.
+
+        The scan chain is shifted through once: the bits of C0, M and N are replaced,
+        all others (C1-C4, charge pump, loop filter and VCO post-scale) are fed back from scandataout
+        and keep the values Quartus compiled for the initial frequency.
+        The PLL runs from the 60MHz usb clock, which is also the clock of this module.
+    """
+    INPUT_FREQUENCY = 60e6
+    VCO_MIN         = 600e6
+    VCO_MAX         = 1300e6
+    # the phase frequency detector needs at least 5MHz
+    MAX_N           = 12
+    MAX_DIVIDE      = 512
+
+    SCAN_CHAIN_LENGTH   = 144
+    # counters in the order they are shifted in, starting with the LSB of the C4 low count,
+    # followed by the charge pump and loop filter bits
+    SCAN_CHAIN_COUNTERS = ["C4", "C3", "C2", "C1", "C0", "M", "N"]
+    COUNTER_BITS        = 18
+    RESET_CYCLES        = 16
+
+    @classmethod
+    def counter_settings(cls, frequency):
+        """ returns (n, m, c) for the closest output frequency INPUT_FREQUENCY * m / (n * c) """
+        best = None
+        for n in range(1, cls.MAX_N + 1):
+            for c in range(1, cls.MAX_DIVIDE + 1):
+                vco = frequency * c
+                if not cls.VCO_MIN <= vco <= cls.VCO_MAX:
+                    continue
+
+                m = round(vco * n / cls.INPUT_FREQUENCY)
+                if not 1 <= m <= cls.MAX_DIVIDE:
+                    continue
+
+                error = abs(cls.INPUT_FREQUENCY * m / (n * c) - frequency)
+                if best is None or error < best[0]:
+                    best = (error, n, m, c)
+
+        assert best is not None, f"no PLL settings for {frequency} Hz"
+        return best[1:]
+
+    @staticmethod
+    def counter_bits(divide):
+        """ scan chain bits of a counter, bit 0 is shifted in first:
+            low count, odd division, high count (LSB first), bypass.
+            A count of 256 is written as 0.
+        """
+        if divide == 1:
+            return 1 << 17
+
+        high = (divide + 1) // 2
+        low  = divide // 2
+        return (low % 256) | (divide % 2) << 8 | (high % 256) << 9
+
+    def __init__(self, frequencies, initial_frequency):
+        # parameters
+        self._frequencies       = frequencies
+        self._initial_frequency = initial_frequency
+
+        # ports
+        self.select      = Signal(range(len(frequencies)))
+        self.reconfigure = Signal()
+        self.busy        = Signal()
+        self.locked      = Signal()
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        n, pll_m, c = self.counter_settings(self._initial_frequency)
+        ratio = Fraction(pll_m, n * c)
+
+        scanclk      = Signal()
+        scanclkena   = Signal()
+        scandata     = Signal()
+        scandataout  = Signal()
+        scandone     = Signal()
+        configupdate = Signal()
+        areset       = Signal()
+        pll_locked   = Signal()
+
+        m.submodules.pll = Instance("ALTPLL",
+            p_BANDWIDTH_TYPE         = "AUTO",
+            p_CLK0_DIVIDE_BY         = ratio.denominator,
+            p_CLK0_DUTY_CYCLE        = 50,
+            p_CLK0_MULTIPLY_BY       = ratio.numerator,
+            p_CLK0_PHASE_SHIFT       = 0,
+
+            p_INCLK0_INPUT_FREQUENCY = round(1e12 / self.INPUT_FREQUENCY),
+            p_OPERATION_MODE         = "NORMAL",
+
+            p_PORT_ARESET            = "PORT_USED",
+            p_PORT_CONFIGUPDATE      = "PORT_USED",
+            p_PORT_SCANCLK           = "PORT_USED",
+            p_PORT_SCANCLKENA        = "PORT_USED",
+            p_PORT_SCANDATA          = "PORT_USED",
+            p_PORT_SCANDATAOUT       = "PORT_USED",
+            p_PORT_SCANDONE          = "PORT_USED",
+
+            i_inclk        = ClockSignal("sync"),
+            i_areset       = areset,
+            i_scanclk      = scanclk,
+            i_scanclkena   = scanclkena,
+            i_scandata     = scandata,
+            i_configupdate = configupdate,
+            o_scandataout  = scandataout,
+            o_scandone     = scandone,
+            o_clk          = ClockSignal("audio"),
+            o_locked       = pll_locked,
+        )
+
+        m.d.comb += ResetSignal("audio").eq(~pll_locked | self.busy)
+
+        m.submodules.locked_sync   = FFSynchronizer(pll_locked, self.locked)
+        scandone_sync = Signal()
+        m.submodules.scandone_sync = FFSynchronizer(scandone, scandone_sync)
+
+        # C0, M and N are next to each other in the scan chain
+        first_bit  = self.SCAN_CHAIN_COUNTERS.index("C0") * self.COUNTER_BITS
+        image_bits = 3 * self.COUNTER_BITS
+        images = Array(Const(self.counter_bits(c) |
+                             self.counter_bits(pll_m) << self.COUNTER_BITS |
+                             self.counter_bits(n) << 2 * self.COUNTER_BITS, image_bits)
+                       for n, pll_m, c in (self.counter_settings(frequency) for frequency in self._frequencies))
+
+        image          = Signal(image_bits)
+        position       = Signal(range(self.SCAN_CHAIN_LENGTH))
+        in_image       = Signal()
+        image_position = Signal(range(image_bits))
+        counter  = Signal(range(self.RESET_CYCLES))
+
+        # free running scan clock of 60MHz / 8: the PLL samples scandata on the rising edge,
+        # and scandataout has settled two cycles after the falling edge
+        phase = Signal(3)
+        m.d.sync += phase.eq(phase + 1)
+        m.d.comb += [
+            scanclk.eq(phase[2]),
+            in_image.eq((position >= first_bit) & (position < first_bit + image_bits)),
+            image_position.eq(position - first_bit),
+        ]
+
+        with m.FSM() as fsm:
+            m.d.comb += self.busy.eq(~fsm.ongoing("IDLE"))
+
+            with m.State("IDLE"):
+                with m.If(self.reconfigure):
+                    m.d.sync += [
+                        image.eq(images[self.select]),
+                        position.eq(0),
+                    ]
+                    m.next = "WAIT_PHASE"
+
+            with m.State("WAIT_PHASE"):
+                with m.If(phase == 7):
+                    m.d.sync += scanclkena.eq(1)
+                    m.next = "SHIFT"
+
+            with m.State("SHIFT"):
+                with m.If(phase == 2):
+                    m.d.sync += scandata.eq(Mux(in_image, image.bit_select(image_position, 1), scandataout))
+                with m.If(phase == 7):
+                    m.d.sync += position.eq(position + 1)
+                    with m.If(position == self.SCAN_CHAIN_LENGTH - 1):
+                        m.d.sync += [
+                            scanclkena.eq(0),
+                            configupdate.eq(1),
+                        ]
+                        m.next = "UPDATE"
+
+            # configupdate is high for one rising edge of the scan clock
+            with m.State("UPDATE"):
+                with m.If(phase == 7):
+                    m.d.sync += configupdate.eq(0)
+                    m.next = "WAIT_DONE"
+
+            with m.State("WAIT_DONE"):
+                with m.If(scandone_sync):
+                    m.d.sync += [
+                        areset.eq(1),
+                        counter.eq(self.RESET_CYCLES - 1),
+                    ]
+                    m.next = "RESET"
+
+            with m.State("RESET"):
+                m.d.sync += counter.eq(counter - 1)
+                with m.If(counter == 0):
+                    m.d.sync += [
+                        areset.eq(0),
+                        counter.eq(self.RESET_CYCLES - 1),
+                    ]
+                    m.next = "WAIT_LOCK"
+
+            # locked still shows the reset for the synchronizer delay
+            with m.State("WAIT_LOCK"):
+                with m.If(counter != 0):
+                    m.d.sync += counter.eq(counter - 1)
+                with m.Elif(self.locked):
+                    m.next = "IDLE"
+
+        return m
@@ -0,0 +1,132 @@
+import os
+import re
+import json
+import shutil
+import hashlib
+import inspect
+import logging
+
+from amaranth.build.run import LocalBuildProducts
+from usb_protocol.emitters import DeviceDescriptorCollection
+
+class BuildCache:
+    """ content addressed cache of bitstream builds
+
+        A build is identified by a hash of everything the toolchain gets to see:
+        the generated netlist, the constraint and project files with the toolchain options,
+        the platform file and the toolchain environment. On a hit the bitstreams and
+        reports of the earlier build are copied to the build directory instead of running Quartus.
+        Set DECA_BUILD_CACHE to the cache directory, or to 'off' to disable it.
+    """
+    # the files of a build which are kept
+    ARTIFACT_SUFFIXES = [".sof", ".pof", ".rbf", ".sta.rpt", ".sta.summary", ".fit.summary", ".flow.rpt"]
+    # the source locations in the netlist change with every unrelated edit of the python code
+    SOURCE_ATTRIBUTES = re.compile(r'^\s*attribute \\src "[^"]*"\n|\(\* src = "[^"]*" \*\)\s*', re.MULTILINE)
+    # environment variables which select the toolchain and its options
+    TOOLCHAIN_ENVIRONMENT = re.compile(r"^(AMARANTH_|QUARTUS_|LUNA_)")
+
+    def __init__(self, directory=None):
+        self.directory = directory or os.environ.get("DECA_BUILD_CACHE",
+            os.path.join(os.path.expanduser("~"), ".cache", "deca-usb2-audio-interface"))
+
+    @staticmethod
+    def enabled():
+        return os.environ.get("DECA_BUILD_CACHE") != "off"
+
+    def _digest(self):
+        digest = hashlib.sha256()
+        for variable in sorted(os.environ):
+            if self.TOOLCHAIN_ENVIRONMENT.match(variable):
+                digest.update(f"{variable}={os.environ[variable]}\n".encode())
+        return digest
+
+    def build_key(self, plan, platform_file):
+        """ hash of the build plan, without the source locations """
+        digest = self._digest()
+        for filename in sorted(plan.files):
+            content = plan.files[filename]
+            if isinstance(content, str):
+                content = self.SOURCE_ATTRIBUTES.sub("", content).encode()
+            digest.update(filename.encode() + b"\0")
+            digest.update(content + b"\0")
+
+        digest.update(plan.script.encode() + b"\0")
+        with open(platform_file, "rb") as f:
+            digest.update(f.read())
+
+        return digest.hexdigest()
+
+    def execute(self, plan, build_dir, name, platform_file):
+        """ runs the build plan, unless an identical build is in the cache """
+        key   = self.build_key(plan, platform_file)
+        entry = os.path.join(self.directory, key)
+
+        # the sources are always written, for inspection and the programmer
+        plan.execute_local(build_dir, run_script=False)
+
+        if os.path.isdir(entry):
+            logging.info(f"Build cache hit ({key[:16]}), reusing the bitstream of an earlier build.")
+            for filename in os.listdir(entry):
+                shutil.copy2(os.path.join(entry, filename), build_dir)
+        else:
+            logging.info(f"Build cache miss ({key[:16]}), running the toolchain.")
+            plan.execute_local(build_dir)
+
+            # build into a temporary directory, so an interrupted copy never looks like a hit
+            temporary_entry = entry + ".partial"
+            shutil.rmtree(temporary_entry, ignore_errors=True)
+            os.makedirs(temporary_entry)
+            for filename in os.listdir(build_dir):
+                if any(filename.endswith(suffix) for suffix in self.ARTIFACT_SUFFIXES):
+                    shutil.copy2(os.path.join(build_dir, filename), temporary_entry)
+            os.rename(temporary_entry, entry)
+
+        self.report_timing(build_dir, name)
+        return LocalBuildProducts(os.path.abspath(build_dir))
+
+    def report_timing(self, build_dir, name):
+        """ logs the worst slack of each clock from the timing analyzer summary """
+        summary = os.path.join(build_dir, f"{name}.sta.summary")
+        if not os.path.exists(summary):
+            return
+
+        with open(summary) as f:
+            analysis = None
+            for line in f:
+                field, _, value = line.partition(":")
+                if field.strip() == "Type":
+                    analysis = value.strip()
+                elif field.strip() == "Slack" and analysis is not None:
+                    slack = float(value)
+                    logging.info(f"{'FAILED ' if slack < 0 else ''}{analysis}: slack {slack:.3f} ns")
+
+    def descriptors(self, device, create_descriptors):
+        """ the USB descriptors of device, created with create_descriptors on a cache miss
+
+            The key is made of the class constants and parameters of the device and the source code
+            of all its methods except elaborate, which does not contribute to the descriptors.
+        """
+        digest = self._digest()
+        for attribute, value in sorted({**vars(type(device)), **vars(device)}.items()):
+            if isinstance(value, (int, float, str, bool, list, tuple, dict, type(None))):
+                digest.update(f"{attribute}={value!r}\n".encode())
+        for method_name, method in inspect.getmembers(type(device), inspect.isfunction):
+            if method_name != "elaborate":
+                digest.update(inspect.getsource(method).encode())
+        key = digest.hexdigest()
+
+        filename = os.path.join(self.directory, "descriptors", key + ".json")
+        if os.path.exists(filename):
+            with open(filename) as f:
+                cached = json.load(f)
+            descriptors = DeviceDescriptorCollection(automatic_language_descriptor=False)
+            for type_number, index, data in cached:
+                descriptors.add_descriptor(bytes.fromhex(data), index=index, descriptor_type=type_number)
+            return descriptors
+
+        descriptors = create_descriptors()
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename + ".partial", "w") as f:
+            json.dump([(int(type_number), index, bytes(data).hex()) for type_number, index, data in descriptors], f)
+        os.rename(filename + ".partial", filename)
+        return descriptors
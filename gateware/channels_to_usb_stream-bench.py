@@ -3,43 +3,50 @@ from channels_to_usb_stream import ChannelsToUSBStream
 from amaranth.sim import Simulator, Tick
 
 if __name__ == "__main__":
-    dut = ChannelsToUSBStream(2)
+    dut = ChannelsToUSBStream(4)
 
-    def send_one_frame(sample: int, channel: int):
+    def send_one_frame(sample: int, channel: int, last=False):
         yield dut.channel_stream_in.channel_no.eq(channel)
         yield dut.channel_stream_in.payload.eq(sample)
+        yield dut.channel_stream_in.last.eq(last)
         yield dut.channel_stream_in.valid.eq(1)
         yield
+        while not (yield dut.channel_stream_in.ready):
+            yield
+        yield dut.channel_stream_in.valid.eq(0)
+
+    def start_packet(frames: int):
+        yield dut.packet_frames.eq(frames)
+        yield dut.start_packet.eq(1)
+        yield
+        yield dut.start_packet.eq(0)
 
     def process():
         yield dut.usb_stream_out.ready.eq(1)
         yield
+        # complete frame
         yield from send_one_frame(0x030201, 0)
         yield from send_one_frame(0x131211, 1)
+        yield from send_one_frame(0x232221, 2)
+        yield from send_one_frame(0x333231, 3)
         yield
         yield
-        yield
-        yield from send_one_frame(0x232221, 0)
-        yield
-        yield
-        yield
-        yield from send_one_frame(0x333231, 1)
-        yield
-        yield
-        yield
-        yield dut.channel_stream_in.valid.eq(0)
-        yield
-        yield
-        yield
-        yield
+        # only two channels, the remaining ones are zero filled
         yield from send_one_frame(0x434241, 0)
+        yield from send_one_frame(0x535251, 1, last=True)
         yield
         yield
         yield
-        yield from send_one_frame(0x535251, 1)
-        yield
-        yield
-        yield
+        # channel 1 is missing
+        yield from send_one_frame(0x636261, 0)
+        yield from send_one_frame(0x737271, 2)
+        yield from send_one_frame(0x838281, 3)
+        for _ in range(10): yield
+        yield from start_packet(2)
+        for _ in range(40): yield
+        # packed 24 bit
+        yield dut.subslot_size.eq(3)
+        yield from start_packet(1)
         for _ in range(30): yield
 
     sim = Simulator(dut)
@@ -47,4 +54,4 @@ if __name__ == "__main__":
     sim.add_sync_process(process)
 
     with sim.write_vcd(f'channels_to_usb_stream.vcd'):
-        sim.run()
\ No newline at end of file
+        sim.run()
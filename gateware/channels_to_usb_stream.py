@@ -1,9 +1,20 @@
 from amaranth           import *
 from amaranth.build     import Platform
-from amaranth.lib.fifo  import SyncFIFO
-from amlib.stream       import StreamInterface, connect_fifo_to_stream
+from amlib.stream       import StreamInterface
 
 class ChannelsToUSBStream(Elaboratable):
+    """ packs the incoming channel samples into isochronous IN packets
+
+        The samples are written one per cycle into a block RAM ring of
+        audio frames, which is large enough for two packets: one frame
+        being filled while the frames of the current packet are sent.
+        Channels missing from a frame are filled with zero words.
+        At start_packet the oldest packet_frames complete frames are handed
+        to the USB side, which sends them byte by byte in the current subslot format.
+        If fewer frames are available, the packet is shortened to those,
+        packet_frames_handed is the number of frames it really contains.
+        Bytes of the previous packet which were not sent by then are dropped.
+    """
     def __init__(self, max_nr_channels=2, sample_width=24, max_packet_size=512):
         assert sample_width in [16, 24, 32]
 
@@ -12,14 +23,42 @@ class ChannelsToUSBStream(Elaboratable):
         self._channel_bits    = Shape.cast(range(max_nr_channels)).width
         self._sample_width    = sample_width
         self._max_packet_size = max_packet_size
+        # max_packet_size is given for the largest subslot size, 4 bytes
+        self._max_frames      = max_packet_size // (4 * max_nr_channels)
+        self._ring_frames     = 2**Shape.cast(range(2 * self._max_frames)).width
 
         # ports
         self.usb_stream_out      = StreamInterface()
         self.channel_stream_in   = StreamInterface(name="channels_stream_in", payload_width=self._sample_width, extra_fields=[("channel_no", self._channel_bits)])
+        # bytes per sample on USB: 4 (left justified in 32 bit), 3 (24 bit, packed) or 2 (16 bit)
+        self.subslot_size        = Signal(3, reset=4)
+
+        # number of complete audio frames which have not been handed to USB yet
+        self.frames_available    = Signal(range(self._ring_frames + 1))
+        self.start_packet        = Signal()
+        self.packet_frames       = Signal(range(self._max_frames + 1))
+        # the frames really handed over at start_packet: packet_frames, but at most frames_available
+        self.packet_frames_handed = Signal.like(self.packet_frames)
+
+        # latency instrumentation
+        # strobes when the first byte of a frame goes out
+        self.frame_sent          = Signal()
+        # complete frames waiting to be sent, including those of the current packet
+        self.frames_queued       = Signal(range(self._ring_frames + self._max_frames + 1))
+        # strobes when frames are lost because the ring is full or a packet was not sent completely
+        self.frames_dropped      = Signal()
 
     def elaborate(self, platform: Platform) -> Module:
         m = Module()
-        m.submodules.out_fifo = out_fifo = SyncFIFO(width=8, depth=self._max_packet_size)
+
+        channel_bits = self._channel_bits
+        ring_frames  = self._ring_frames
+        frame_bits   = Shape.cast(range(ring_frames)).width
+
+        # the words are addressed by Cat(channel, frame)
+        ring_buffer = Memory(width=self._sample_width, depth=ring_frames * 2**channel_bits)
+        m.submodules.ring_write = ring_write = ring_buffer.write_port()
+        m.submodules.ring_read  = ring_read  = ring_buffer.read_port(transparent=False)
 
         channel_stream  = self.channel_stream_in
         channel_payload = Signal(self._sample_width)
@@ -27,79 +66,193 @@ class ChannelsToUSBStream(Elaboratable):
         channel_ready   = Signal()
 
         m.d.comb += [
-            *connect_fifo_to_stream(out_fifo, self.usb_stream_out),
             channel_payload.eq(channel_stream.payload),
             channel_valid.eq(channel_stream.valid),
             channel_stream.ready.eq(channel_ready),
         ]
 
-        current_sample  = Signal(32 if self._sample_width > 16 else 16)
-        current_channel = Signal(self._channel_bits)
-        current_byte    = Signal(2 if self._sample_width > 16 else 1)
-
         last_channel    = self._max_nr_channels - 1
-        num_bytes = 4
-        last_byte = num_bytes - 1
-
-        shift = 8 if self._sample_width == 24 else 0
-
-        with m.If(out_fifo.w_rdy):
-            with m.FSM() as fsm:
-                current_channel_next = (current_channel + 1)[:self._channel_bits]
-
-                with m.State("WAIT-FIRST"):
-                    # we have to accept data until we find a first channel sample
-                    m.d.comb += channel_ready.eq(1)
-                    with m.If(channel_valid & (channel_stream.channel_no == 0)):
-                        m.d.sync += [
-                            current_sample.eq(channel_payload << shift),
-                            current_channel.eq(0),
-                        ]
-                        m.next = "SEND"
 
-                with m.State("SEND"):
+        #
+        # write side: one sample per cycle into the frame ring
+        #
+        write_frame      = Signal(frame_bits)
+        write_channel    = Signal(channel_bits)
+        frame_complete   = Signal()
+        ring_full        = Signal()
+
+        # the oldest frame not yet handed to USB
+        tail_frame       = Signal(frame_bits)
+        handed_frames    = Signal.like(self.packet_frames)
+
+        m.d.comb += [
+            ring_write.addr.eq(Cat(write_channel, write_frame)),
+            ring_full.eq(self.frames_available == ring_frames),
+        ]
+
+        with m.FSM():
+            with m.State("WAIT-FIRST"):
+                # we have to accept data until we find a first channel sample
+                m.d.comb += channel_ready.eq(1)
+                with m.If(channel_valid & (channel_stream.channel_no == 0) & ring_full):
+                    m.d.comb += self.frames_dropped.eq(1)
+
+                with m.If(channel_valid & (channel_stream.channel_no == 0) & ~ring_full):
                     m.d.comb += [
-                        out_fifo.w_data.eq(current_sample[0:8]),
-                        out_fifo.w_en.eq(1),
-                    ]
-                    m.d.sync += [
-                        current_byte.eq(current_byte + 1),
-                        current_sample.eq(current_sample >> 8),
+                        ring_write.data.eq(channel_payload),
+                        ring_write.en.eq(1),
                     ]
+                    m.d.sync += write_channel.eq(1)
 
-                    with m.If(current_byte == last_byte):
-                        with m.If(channel_valid):
-                            m.d.comb += channel_ready.eq(1)
+                    if last_channel == 0:
+                        m.d.comb += frame_complete.eq(1)
+                    else:
+                        with m.If(channel_stream.last):
+                            m.next = "FILL-ZEROS"
+                        with m.Else():
+                            m.next = "RECEIVE"
 
-                            m.d.sync += current_channel.eq(current_channel_next)
+            with m.State("RECEIVE"):
+                with m.If(channel_valid):
+                    # a new frame started before this one was complete
+                    with m.If(channel_stream.channel_no == 0):
+                        m.next = "FILL-ZEROS"
 
-                            with m.If(current_channel_next == channel_stream.channel_no):
-                                m.d.sync += current_sample.eq(channel_payload << shift)
-                                m.next = "SEND"
-                            with m.Else():
-                                m.next = "FILL-ZEROS"
+                    # a channel is missing, fill it with zeros
+                    with m.Elif(channel_stream.channel_no > write_channel):
+                        m.d.comb += [
+                            ring_write.data.eq(0),
+                            ring_write.en.eq(1),
+                        ]
+                        m.d.sync += write_channel.eq(write_channel + 1)
 
-                        with m.Else():
-                            m.next = "WAIT"
+                    with m.Elif(channel_stream.channel_no == write_channel):
+                        m.d.comb += [
+                            channel_ready.eq(1),
+                            ring_write.data.eq(channel_payload),
+                            ring_write.en.eq(1),
+                        ]
+                        m.d.sync += write_channel.eq(write_channel + 1)
+
+                        with m.If(write_channel == last_channel):
+                            m.d.comb += frame_complete.eq(1)
+                            m.next = "WAIT-FIRST"
+                        with m.Elif(channel_stream.last):
+                            m.next = "FILL-ZEROS"
 
-                with m.State("WAIT"):
-                    with m.If(channel_valid):
+                    # a channel we already have, drop it
+                    with m.Else():
                         m.d.comb += channel_ready.eq(1)
-                        m.d.sync += [
-                            current_sample.eq(channel_payload << shift),
-                            current_channel.eq(current_channel_next),
-                        ]
-                        m.next = "SEND"
 
-                with m.State("FILL-ZEROS"):
-                    m.d.comb += [
-                        out_fifo.w_data.eq(0),
-                        out_fifo.w_en.eq(1),
+            with m.State("FILL-ZEROS"):
+                m.d.comb += [
+                    ring_write.data.eq(0),
+                    ring_write.en.eq(1),
+                ]
+                m.d.sync += write_channel.eq(write_channel + 1)
+
+                with m.If(write_channel == last_channel):
+                    m.d.comb += frame_complete.eq(1)
+                    m.next = "WAIT-FIRST"
+
+        with m.If(frame_complete):
+            m.d.sync += [
+                write_frame.eq(write_frame + 1),
+                write_channel.eq(0),
+            ]
+
+        # the scheduler may ask for more frames than there are, e.g. when it catches up
+        packet_frames = self.packet_frames_handed
+        m.d.comb += [
+            packet_frames.eq(Mux(self.packet_frames > self.frames_available, self.frames_available, self.packet_frames)),
+            handed_frames.eq(Mux(self.start_packet, packet_frames, 0)),
+        ]
+        m.d.sync += self.frames_available.eq(self.frames_available + frame_complete - handed_frames)
+
+        #
+        # read side: hand the packet to USB at start_packet and send it byte by byte
+        #
+        read_frame       = Signal(frame_bits)
+        read_channel     = Signal(channel_bits)
+        read_byte        = Signal(2)
+        bytes_left       = Signal(range(self._max_packet_size + 1))
+        read_word_valid  = Signal()
+
+        last_byte        = Signal(2)
+        next_frame       = Signal(frame_bits)
+        next_channel     = Signal(channel_bits)
+        advance          = Signal()
+
+        out_stream = self.usb_stream_out
+
+        # frames of the current packet whose first byte has not been sent yet
+        packet_frames_left = Signal.like(self.packet_frames)
+
+        # the sample as it goes into the subslot, LSB first
+        subslot_sample = Signal(32)
+
+        def align(subslot_bits):
+            shift = subslot_bits - self._sample_width
+            return ring_read.data << shift if shift >= 0 else ring_read.data >> -shift
+
+        with m.Switch(self.subslot_size):
+            with m.Case(4):
+                m.d.comb += subslot_sample.eq(align(32))
+            with m.Case(3):
+                m.d.comb += subslot_sample.eq(align(24))
+            with m.Case(2):
+                m.d.comb += subslot_sample.eq(align(16))
+
+        m.d.comb += [
+            last_byte.eq(self.subslot_size - 1),
+            next_channel.eq(Mux(read_channel == last_channel, 0, read_channel + 1)),
+            next_frame.eq(Mux(read_channel == last_channel, read_frame + 1, read_frame)),
+
+            out_stream.valid.eq(read_word_valid & (bytes_left != 0)),
+            out_stream.payload.eq(subslot_sample.word_select(read_byte, 8)),
+            out_stream.last.eq(bytes_left == 1),
+
+            advance.eq(out_stream.valid & out_stream.ready & (read_byte == last_byte)),
+            self.frame_sent.eq(out_stream.valid & out_stream.ready & (read_channel == 0) & (read_byte == 0)),
+            self.frames_queued.eq(self.frames_available + packet_frames_left),
+            # fetch the next word while the last byte of the current one goes out
+            ring_read.addr.eq(Mux(advance, Cat(next_channel, next_frame), Cat(read_channel, read_frame))),
+        ]
+
+        with m.If(self.start_packet):
+            m.d.sync += [
+                read_frame.eq(tail_frame),
+                read_channel.eq(0),
+                read_byte.eq(0),
+                bytes_left.eq(packet_frames * self._max_nr_channels * self.subslot_size),
+                read_word_valid.eq(0),
+                tail_frame.eq(tail_frame + packet_frames),
+                out_stream.first.eq(1),
+                packet_frames_left.eq(packet_frames),
+            ]
+
+            with m.If(packet_frames_left != 0):
+                m.d.comb += self.frames_dropped.eq(1)
+
+        with m.Else():
+            # the read port has one cycle latency after a jump
+            m.d.sync += read_word_valid.eq(1)
+
+            with m.If(out_stream.valid & out_stream.ready):
+                m.d.sync += [
+                    read_byte.eq(read_byte + 1),
+                    bytes_left.eq(bytes_left - 1),
+                    out_stream.first.eq(0),
+                ]
+
+                with m.If(self.frame_sent):
+                    m.d.sync += packet_frames_left.eq(packet_frames_left - 1)
+
+                with m.If(advance):
+                    m.d.sync += [
+                        read_byte.eq(0),
+                        read_channel.eq(next_channel),
+                        read_frame.eq(next_frame),
                     ]
-                    m.d.sync += current_byte.eq(current_byte + 1)
 
-                    with m.If(current_byte == last_byte):
-                        m.d.sync += current_channel.eq(current_channel + 1)
-                        with m.If(current_channel == last_channel):
-                            m.next = "WAIT-FIRST"
         return m
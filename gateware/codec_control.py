@@ -0,0 +1,111 @@
+from amaranth          import *
+from amaranth.build    import Platform
+from amaranth.lib.fifo import SyncFIFOBuffered
+from amlib.stream      import StreamInterface
+
+class CodecCommandQueue(Elaboratable):
+    """ queue of codec register writes, which are issued at runtime
+
+        A command is (page, register, value), with the page in the upper byte.
+        Each one becomes three I2C packets: select the page, write the register and select page 0 again,
+        so the codec is always on page 0 between commands, which AudioInit relies on.
+        busy is high while there are commands to send, the I2C bus must not change hands then.
+    """
+    def __init__(self, device_address, depth=16):
+        # parameters
+        self._device_address = device_address
+        self._depth          = depth
+
+        # ports
+        self.command_in = StreamInterface(name="codec_command_in", payload_width=24)
+        self.stream_out = StreamInterface(name="codec_command_out")
+        self.busy       = Signal()
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        m.submodules.fifo = fifo = SyncFIFOBuffered(width=24, depth=self._depth)
+
+        m.d.comb += [
+            fifo.w_data.eq(self.command_in.payload),
+            fifo.w_en.eq(self.command_in.valid),
+            self.command_in.ready.eq(fifo.w_rdy),
+        ]
+
+        value    = Signal(8)
+        register = Signal(8)
+        page     = Signal(8)
+        sending  = Signal()
+        position = Signal(range(9))
+        byte_no  = Signal(range(3))
+
+        address  = Const(self._device_address, 8)
+        packets  = Array([address, Const(0x00, 8), page,
+                          address, register,       value,
+                          address, Const(0x00, 8), Const(0x00, 8)])
+
+        m.d.comb += [
+            self.busy.eq(sending | fifo.r_rdy),
+            self.stream_out.payload.eq(packets[position]),
+            self.stream_out.first.eq(byte_no == 0),
+            self.stream_out.last.eq(byte_no == 2),
+        ]
+
+        with m.If(~sending):
+            with m.If(fifo.r_rdy):
+                m.d.comb += fifo.r_en.eq(1)
+                m.d.sync += [
+                    Cat(value, register, page).eq(fifo.r_data),
+                    position.eq(0),
+                    byte_no.eq(0),
+                    sending.eq(1),
+                ]
+
+        with m.Else():
+            m.d.comb += self.stream_out.valid.eq(1)
+
+            with m.If(self.stream_out.ready):
+                m.d.sync += [
+                    position.eq(position + 1),
+                    byte_no.eq(Mux(byte_no == 2, 0, byte_no + 1)),
+                ]
+                with m.If(position == 8):
+                    m.d.sync += sending.eq(0)
+
+        return m
+
+
+class I2CArbiter(Elaboratable):
+    """ shares the I2C controller between AudioInit and the codec command queue
+
+        AudioInit owns the bus while it initializes the codec or changes the sample rate,
+        in between the command queue gets it. The bus only changes hands when the owner
+        is not busy and the I2C controller has finished its last transaction.
+        init_granted gates the register reads of AudioInit.
+    """
+    def __init__(self):
+        # ports
+        self.init_stream  = StreamInterface(name="i2c_arbiter_init")
+        self.init_busy    = Signal()
+        self.init_granted = Signal(reset=1)
+
+        self.queue_stream = StreamInterface(name="i2c_arbiter_queue")
+        self.queue_busy   = Signal()
+
+        self.i2c_busy     = Signal()
+        self.stream_out   = StreamInterface(name="i2c_arbiter_out")
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        with m.If(self.init_granted):
+            m.d.comb += self.stream_out.stream_eq(self.init_stream)
+            with m.If(~self.init_busy & self.queue_busy & ~self.i2c_busy):
+                m.d.sync += self.init_granted.eq(0)
+
+        with m.Else():
+            m.d.comb += self.stream_out.stream_eq(self.queue_stream)
+            with m.If(~self.queue_busy & ~self.i2c_busy):
+                m.d.sync += self.init_granted.eq(1)
+
+        return m
@@ -0,0 +1,107 @@
+from amaranth       import *
+from amaranth.build import Platform
+from amlib.stream   import StreamInterface
+
+class CompressedStreamILA(Elaboratable):
+    """ logic analyzer which only stores the samples where a signal changes
+
+        Drop-in for StreamILA: after the trigger, each buffer entry holds the signal values
+        and how many more cycles they stayed the same (the last signal, ila_repeat),
+        so a capture covers up to sample_depth * 2**repeat_width cycles.
+        When the buffer is full, its entries are sent over the stream, first entry first.
+    """
+    def __init__(self, *, signals, sample_depth, repeat_width=8, sample_rate=60e6):
+        # parameters
+        self.ila_repeat       = Signal(repeat_width, name="ila_repeat")
+        # the host expands the entries with the repeat count in the last signal
+        self.signals          = [*signals, self.ila_repeat]
+        self.sample_width     = len(Cat(*self.signals))
+        self.sample_depth     = sample_depth
+        self.sample_rate      = sample_rate
+        self.sample_period    = 1 / sample_rate
+        self.bits_per_sample  = 2 ** ((self.sample_width - 1).bit_length())
+        self.bytes_per_sample = (self.bits_per_sample + 7) // 8
+
+        self._inputs          = Cat(*signals)
+
+        # ports
+        self.trigger          = Signal()
+        self.sampling         = Signal()
+        self.complete         = Signal()
+        self.stream           = StreamInterface(payload_width=self.bits_per_sample)
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        buffer = Memory(width=self.sample_width, depth=self.sample_depth)
+        m.submodules.buffer_write = buffer_write = buffer.write_port()
+        m.submodules.buffer_read  = buffer_read  = buffer.read_port(transparent=False)
+
+        inputs      = self._inputs
+        last_inputs = Signal.like(inputs)
+        repeat      = self.ila_repeat
+        max_repeat  = 2**len(repeat) - 1
+        position    = Signal(range(self.sample_depth))
+        last_entry  = Signal()
+
+        m.d.comb += [
+            buffer_write.addr.eq(position),
+            buffer_write.data.eq(Cat(last_inputs, repeat)),
+            last_entry.eq(position == self.sample_depth - 1),
+            buffer_read.addr.eq(position),
+        ]
+
+        with m.FSM():
+            with m.State("IDLE"):
+                with m.If(self.trigger):
+                    m.d.sync += [
+                        last_inputs.eq(inputs),
+                        repeat.eq(0),
+                        position.eq(0),
+                        self.complete.eq(0),
+                    ]
+                    m.next = "SAMPLING"
+
+            with m.State("SAMPLING"):
+                m.d.comb += self.sampling.eq(1)
+
+                # the previous values end here: store them with their repeat count
+                with m.If((inputs != last_inputs) | (repeat == max_repeat)):
+                    m.d.comb += buffer_write.en.eq(1)
+                    m.d.sync += [
+                        last_inputs.eq(inputs),
+                        repeat.eq(0),
+                        position.eq(position + 1),
+                    ]
+
+                    with m.If(last_entry):
+                        m.d.sync += [
+                            position.eq(0),
+                            self.complete.eq(1),
+                        ]
+                        m.next = "SENDING"
+
+                with m.Else():
+                    m.d.sync += repeat.eq(repeat + 1)
+
+            with m.State("SENDING"):
+                # the read port needs one cycle after the address changed
+                data_valid = Signal()
+                m.d.comb += [
+                    self.stream.valid.eq(data_valid),
+                    self.stream.payload.eq(buffer_read.data),
+                    self.stream.first.eq(position == 0),
+                    self.stream.last.eq(last_entry),
+                ]
+                m.d.sync += data_valid.eq(1)
+
+                with m.If(self.stream.valid & self.stream.ready):
+                    m.d.sync += [
+                        position.eq(position + 1),
+                        data_valid.eq(0),
+                    ]
+
+                    with m.If(last_entry):
+                        m.next = "IDLE"
+
+        return m
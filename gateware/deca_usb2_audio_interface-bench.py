@@ -0,0 +1,532 @@
+#!/usr/bin/env python3
+#
+# full system simulation: USB2AudioInterface behind a ULPI PHY model, enumerated and
+# streamed by an isochronous host model, with an I2S codec model on the audio pins
+#
+# usage: deca_usb2_audio_interface-bench.py [--duration MS] [--sample-rate RATE] [--alt-setting N]
+#                                           [--channels N] [--jitter-buffer PRESET] [--codec-ppm PPM] [--vcd]
+#
+# Reports the throughput of both directions, packet errors and xruns over the simulated time.
+# The host sends a ramp on channel 1, which is checked at the DAC pin; the codec sends a ramp
+# from the ADC, which is checked in the IN packets. Exits with 1 if anything went wrong.
+# Expect about a minute of wall time per simulated millisecond.
+#
+import sys
+import struct
+import argparse
+
+from amaranth         import *
+from amaranth.hdl.rec import Record
+from amaranth.sim     import Simulator, Delay, Passive
+
+from deca_usb2_audio_interface import USB2AudioInterface
+from audio_init                import AudioInit
+from audio_pll                 import AudioPLL
+from requesthandlers           import VendorRequestHandlers
+from telemetry                 import Telemetry
+from usb_host_model            import ULPIPHYModel, USBHostModel
+
+class SimulationClockAndResetController(Elaboratable):
+    """ the simulator drives the usb clock, sync runs from it like on the board """
+    def elaborate(self, platform):
+        m = Module()
+
+        m.domains.sync = ClockDomain()
+        m.domains.usb  = ClockDomain()
+        m.d.comb += ClockSignal("sync").eq(ClockSignal("usb"))
+
+        return m
+
+
+class SimulationPlatform:
+    """ stands in for ArrowDECAPlatform, the resources are plain records the models connect to """
+    # same FPGA as the DECA, some cores look at it
+    device                 = "10M50DA"
+    default_usb_connection = "ulpi"
+    ignore_phy_vbus        = False
+    clock_domain_generator = SimulationClockAndResetController
+
+    RESOURCES = {
+        "ulpi":      [("data", [("i", 8), ("o", 8), ("oe", 1)]), ("clk", [("o", 1)]), ("stp", [("o", 1)]),
+                      ("dir", [("i", 1)]), ("nxt", [("i", 1)]), ("reset", [("o", 1)])],
+        "audio":     [("reset", [("o", 1)]), ("mclk", [("o", 1)]), ("wclk", [("i", 1)]), ("bclk", [("i", 1)]),
+                      ("spi_select", [("o", 1)]), ("din_mfp1", [("o", 1)]), ("dout_mfp2", [("i", 1)]),
+                      ("sclk_mfp3", [("o", 1)]), ("miso_mfp4", [("i", 1)]), ("gpio_mfp5", [("o", 1)])],
+        "i2c_audio": [("scl", [("i", 1), ("o", 1), ("oe", 1)]), ("sda", [("i", 1), ("o", 1), ("oe", 1)])],
+        "debug":     [("bclk", [("o", 1)]), ("wclk", [("o", 1)]), ("adc", [("o", 1)]), ("dac", [("o", 1)])],
+        "spi":       [("cs", [("o", 1)]), ("clk", [("o", 1)]), ("copi", [("o", 1)])],
+        "led":       [("o", 1)],
+    }
+
+    def __init__(self):
+        self._requested = {}
+
+    def request(self, name, number=0):
+        if (name, number) not in self._requested:
+            self._requested[(name, number)] = Record(self.RESOURCES[name], name=f"{name}_{number}")
+        return self._requested[(name, number)]
+
+    def add_clock_constraint(self, clock, frequency):
+        # the simulator drives the clocks
+        pass
+
+
+class ALTPLLModel(Elaboratable):
+    """ stands in for the ALTPLL primitive of AudioPLL: scan chain, configuration update and lock
+
+        The simulator drives the audio clock at the streamed sample rate, the model keeps
+        the counter settings of the last configuration update, see configured_frequency.
+    """
+    LOCK_CYCLES = 1000
+
+    def __init__(self, instance):
+        self._ports = { name: value for name, (value, direction) in instance.named_ports.items() }
+
+        self.chain  = Signal(AudioPLL.SCAN_CHAIN_LENGTH)
+        self.config = Signal(AudioPLL.SCAN_CHAIN_LENGTH)
+
+    @staticmethod
+    def divide(bits):
+        """ division of a counter in the scan chain, see AudioPLL.counter_bits """
+        if bits >> 17 & 1:
+            return 1
+        return ((bits & 0xff) or 256) + ((bits >> 9 & 0xff) or 256)
+
+    def configured_frequency(self):
+        """ the output frequency of the last configuration update, None before the first one """
+        config = yield self.config
+        if config == 0:
+            return None
+        c, pll_m, n = [self.divide(config >> (AudioPLL.SCAN_CHAIN_COUNTERS.index(counter) * AudioPLL.COUNTER_BITS)
+                                   & (2**AudioPLL.COUNTER_BITS - 1)) for counter in ["C0", "M", "N"]]
+        return AudioPLL.INPUT_FREQUENCY * pll_m / (n * c)
+
+    def elaborate(self, platform):
+        m = Module()
+        ports = self._ports
+
+        scanclk_last = Signal()
+        scanclk_rose = Signal()
+        lock_counter = Signal(range(self.LOCK_CYCLES + 1), reset=self.LOCK_CYCLES)
+
+        m.d.usb  += scanclk_last.eq(ports["scanclk"])
+        m.d.comb += [
+            scanclk_rose.eq(ports["scanclk"] & ~scanclk_last),
+            # bit 0 is shifted in first, and is the first one shifted out
+            ports["scandataout"].eq(self.chain[0]),
+        ]
+
+        with m.If(scanclk_rose & ports["scanclkena"]):
+            m.d.usb += [
+                self.chain.eq(Cat(self.chain[1:], ports["scandata"])),
+                ports["scandone"].eq(0),
+            ]
+        with m.If(scanclk_rose & ports["configupdate"]):
+            m.d.usb += [
+                self.config.eq(self.chain),
+                ports["scandone"].eq(1),
+            ]
+
+        with m.If(ports["areset"]):
+            m.d.usb += [
+                lock_counter.eq(self.LOCK_CYCLES),
+                ports["locked"].eq(0),
+            ]
+        with m.Elif(lock_counter != 0):
+            m.d.usb += lock_counter.eq(lock_counter - 1)
+        with m.Else():
+            m.d.usb += ports["locked"].eq(1)
+
+        return m
+
+
+def replace_submodule(fragment, path, replace):
+    """ replaces the submodule at path (the names of the submodules down to it)
+        with replace(submodule), returns the replacement
+    """
+    *parents, name = path
+    for parent in parents:
+        fragment = fragment.find_subfragment(parent)
+
+    for index, (subfragment, subfragment_name) in enumerate(fragment.subfragments):
+        if subfragment_name == name:
+            replacement = replace(subfragment)
+            fragment.subfragments[index] = (Fragment.get(replacement, None), name)
+            return replacement
+
+    raise NameError(f"no submodule {'.'.join(path)}")
+
+
+class I2CTargetModel:
+    """ the I2C side of the codec: acknowledges every byte, keeps the register writes
+        and answers register reads, with the status flags of a codec whose clocks run
+    """
+    # page 0 registers: (register which powers the block up, bits which are set when it is,
+    # flag register, flags which are read back)
+    POWER_FLAGS = [
+        (0x3f, 0b1100_0000, 0x25, 0b1000_1000), # DAC
+        (0x51, 0b1100_0000, 0x24, 0b0100_0100), # ADC
+    ]
+
+    def __init__(self, pads):
+        self._pads  = pads
+        # (page, register, value)
+        self.writes = []
+        self.reads  = []
+
+    def read_register(self, page, register):
+        if page == 0 and register == 0x01:
+            # the software reset bit clears itself
+            return 0
+        for power_register, power_bits, flag_register, flags in self.POWER_FLAGS:
+            if page == 0 and register == flag_register:
+                value = self.register(0, power_register) or 0
+                return flags if value & power_bits == power_bits else 0
+        return self.register(page, register) or 0
+
+    def process(self):
+        pads = self._pads
+        yield Passive()
+
+        scl_last, sda_last = 1, 1
+        byte, nr_bits, acknowledge = 0, 0, False
+        message, page, pointer = [], 0, 0
+        reading, pull_down = False, False
+
+        while True:
+            # open drain, with pull-ups
+            scl = int(not ((yield pads.scl.oe) and not (yield pads.scl.o)))
+            sda_initiator = int(not ((yield pads.sda.oe) and not (yield pads.sda.o)))
+            yield pads.scl.i.eq(scl)
+            yield pads.sda.i.eq(sda_initiator & (not pull_down))
+
+            if scl and scl_last and sda_initiator != sda_last:
+                if not sda_initiator:
+                    # (repeated) start
+                    message, byte, nr_bits, reading = [], 0, 0, False
+                elif len(message) == 3:
+                    # stop after device address, register and value
+                    if message[1] == 0:
+                        page = message[2]
+                    else:
+                        self.writes.append((page, message[1], message[2]))
+            elif scl and not scl_last and not acknowledge and not reading:
+                byte = (byte << 1) | sda_initiator
+                nr_bits += 1
+            elif not scl and scl_last:
+                if acknowledge:
+                    acknowledge, pull_down = False, False
+                    if reading:
+                        # send the register, MSB first
+                        byte = self.read_register(page, pointer)
+                        self.reads.append((page, pointer, byte))
+                        pull_down, nr_bits = not (byte & 0x80), 1
+                elif reading:
+                    # after the eighth bit, the initiator acknowledges
+                    pull_down = nr_bits < 8 and not (byte >> (7 - nr_bits)) & 1
+                    nr_bits += 1
+                elif nr_bits == 8:
+                    message.append(byte)
+                    if len(message) == 1:
+                        reading = bool(byte & 1)
+                    elif len(message) == 2:
+                        pointer = byte
+                    acknowledge, pull_down, byte, nr_bits = True, True, 0, 0
+
+            scl_last, sda_last = scl, sda_initiator
+            yield
+
+    def register(self, page, register):
+        values = [value for p, r, value in self.writes if (p, r) == (page, register)]
+        return values[-1] if values else None
+
+
+def ramp_frame(counter, nr_channels):
+    """ 24 bit samples of one audio frame: the ramp in the upper 16 bits of channel 1, inverted on channel 2 """
+    return [(counter & 0xffff) << 8, (~counter & 0xffff) << 8] + [0] * (nr_channels - 2)
+
+def ramp_value(sample):
+    return sample >> 8
+
+
+class RampChecker:
+    """ counts the gaps in a ramp, which starts at the first non zero value """
+    def __init__(self):
+        self.last   = None
+        self.values = 0
+        self.xruns  = 0
+
+    def check(self, value):
+        if self.last is None and value == 0:
+            return
+        if self.last is not None and value != (self.last + 1) & 0xffff:
+            self.xruns += 1
+        self.last    = value
+        self.values += 1
+
+
+class I2SCodecModel:
+    """ the codec as I2S clock master: plays a ramp into the ADC data line
+        and checks the ramp the host sent at the DAC data line
+    """
+    BITS_PER_FRAME = 64
+
+    def __init__(self, audio, sample_rate, ppm=0):
+        self._audio       = audio
+        self._half_period = 1 / (2 * self.BITS_PER_FRAME * sample_rate * (1 + ppm * 1e-6))
+        self.dac          = RampChecker()
+
+    def process(self):
+        audio = self._audio
+        yield Passive()
+
+        frame    = 1
+        samples  = ramp_frame(frame, 2)
+        received = [0, 0]
+        position = 0
+
+        while True:
+            # the data of a slot starts one bit clock after the word select edge, MSB first
+            slot, bit_no = divmod((position - 1) % self.BITS_PER_FRAME, 32)
+
+            # falling edge: the codec changes word select and its data
+            yield audio.bclk.eq(0)
+            yield audio.wclk.eq(position >= 32)
+            yield audio.dout_mfp2.eq((samples[slot] >> (23 - bit_no)) & 1 if bit_no < 24 else 0)
+            yield Delay(self._half_period)
+
+            # rising edge: the codec samples the DAC data
+            if bit_no < 24:
+                received[slot] = (received[slot] << 1) | (yield audio.din_mfp1)
+            if bit_no == 23:
+                if slot == 0:
+                    self.dac.check(ramp_value(received[slot] & 0xffffff))
+                received[slot] = 0
+            yield audio.bclk.eq(1)
+            yield Delay(self._half_period)
+
+            position = (position + 1) % self.BITS_PER_FRAME
+            if position == 0:
+                frame  += 1
+                samples = ramp_frame(frame, 2)
+
+
+def streaming_settings(configuration):
+    """ parses the configuration descriptor into the alternate settings of the interfaces:
+        { (interface, alternate setting): { "nr_channels", "subslot_size", "endpoints": { address: wMaxPacketSize } } }
+    """
+    settings  = {}
+    setting   = None
+    position  = 0
+    while position < len(configuration):
+        length, descriptor_type = configuration[position], configuration[position + 1]
+        descriptor = configuration[position:position + length]
+
+        if descriptor_type == 0x04: # interface
+            setting = settings.setdefault((descriptor[2], descriptor[3]), { "endpoints": {} })
+        elif descriptor_type == 0x24 and setting is not None: # class specific interface
+            # AS general and Type I format
+            if descriptor[2] == 0x01 and length == 16:
+                setting["nr_channels"] = descriptor[10]
+            elif descriptor[2] == 0x02:
+                setting["subslot_size"] = descriptor[4]
+        elif descriptor_type == 0x05 and setting is not None: # endpoint
+            setting["endpoints"][descriptor[2]] = struct.unpack_from("<H", descriptor, 4)[0]
+
+        position += length
+    return settings
+
+
+class AudioStreamer:
+    """ UAC2 driver of the host model
+
+        Sends a ramp on EP1 OUT, as many frames in each microframe as the feedback on EP1 IN asks for,
+        and checks that the ramp of the codec comes back on EP2 IN without gaps.
+    """
+    # bInterval 4 of the feedback endpoint
+    FEEDBACK_INTERVAL = 8
+
+    def __init__(self, host, configuration, alt_setting, sample_rate):
+        settings = streaming_settings(configuration)
+        output, input = settings[(1, alt_setting)], settings[(2, alt_setting)]
+
+        self._host         = host
+        self.nr_channels   = output["nr_channels"]
+        self.out_subslot   = output["subslot_size"]
+        self.in_subslot    = input["subslot_size"]
+        self._out_packet   = output["endpoints"][0x01] & 0x7ff
+        self._in_transactions = ((input["endpoints"][0x82] >> 11) & 0b11) + 1
+
+        # 16.16 audio frames per microframe
+        self.feedback      = round(sample_rate / 8000 * 2**16)
+        self._phase        = 0
+        self._counter      = 1
+
+        self.running       = False
+        self.microframes   = 0
+        self.out_frames    = 0
+        self.out_bytes     = 0
+        self.in_frames     = 0
+        self.in_bytes      = 0
+        self.feedback_errors = 0
+        self.partial_frames  = 0
+        self.record        = RampChecker()
+
+    def _encode(self, sample, subslot_size):
+        # left justified in the subslot
+        return (sample << (8 * subslot_size - 24) if subslot_size > 3 else sample >> (24 - 8 * subslot_size)) \
+            .to_bytes(subslot_size, "little")
+
+    def _decode(self, subslot):
+        value = int.from_bytes(subslot, "little")
+        return value >> (8 * len(subslot) - 24) if len(subslot) > 3 else value << (24 - 8 * len(subslot))
+
+    def microframe(self, microframe):
+        if not self.running:
+            return
+        host = self._host
+        self.microframes += 1
+
+        # playback, at the rate the device asks for
+        self._phase  += self.feedback
+        nr_frames     = self._phase >> 16
+        self._phase  &= 0xffff
+        payload = b"".join(self._encode(sample, self.out_subslot)
+                           for counter in range(self._counter, self._counter + nr_frames)
+                           for sample in ramp_frame(counter, self.nr_channels))
+        self._counter += nr_frames
+        yield from host.isochronous_out(1, payload, self._out_packet)
+        self.out_frames += nr_frames
+        self.out_bytes  += len(payload)
+
+        if microframe % self.FEEDBACK_INTERVAL == 0:
+            feedback = yield from host.isochronous_in(1)
+            if feedback is not None and len(feedback) == 4:
+                self.feedback = struct.unpack("<I", feedback)[0]
+            else:
+                self.feedback_errors += 1
+
+        # record
+        data = yield from host.isochronous_in(2, self._in_transactions)
+        if data is None:
+            return
+        frame_bytes = self.nr_channels * self.in_subslot
+        if len(data) % frame_bytes:
+            self.partial_frames += 1
+            return
+        for position in range(0, len(data), frame_bytes):
+            self.record.check(ramp_value(self._decode(data[position:position + self.in_subslot])))
+        self.in_frames += len(data) // frame_bytes
+        self.in_bytes  += len(data)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--duration", type=float, default=10, help="milliseconds of streaming to simulate")
+    parser.add_argument("--sample-rate", type=int, default=USB2AudioInterface.DEFAULT_SAMPLE_RATE,
+                        choices=USB2AudioInterface.SAMPLE_RATES)
+    parser.add_argument("--alt-setting", type=int, default=1, choices=range(1, len(USB2AudioInterface.SUBSLOT_FORMATS) + 1),
+                        help="alternate setting of both streaming interfaces, selects the subslot format")
+    parser.add_argument("--channels", type=int, default=USB2AudioInterface.NR_CHANNELS,
+                        choices=USB2AudioInterface.SUPPORTED_NR_CHANNELS)
+    parser.add_argument("--jitter-buffer", default=USB2AudioInterface.DEFAULT_JITTER_BUFFER_PRESET,
+                        choices=USB2AudioInterface.JITTER_BUFFER_PRESETS.keys())
+    parser.add_argument("--codec-ppm", type=float, default=0, help="deviation of the codec clocks from nominal")
+    parser.add_argument("--vcd", action="store_true", help="write deca_usb2_audio_interface.vcd")
+    args = parser.parse_args()
+
+    dut = USB2AudioInterface(nr_channels=args.channels, jitter_buffer_preset=args.jitter_buffer, serial_format="i2s")
+
+    platform = SimulationPlatform()
+    fragment = Fragment.get(dut, platform)
+    # the ALTPLL is a vendor primitive the simulator does not know
+    audio_pll = replace_submodule(fragment, ["audio_init", "audio_pll", "pll"], ALTPLLModel)
+
+    phy   = ULPIPHYModel(platform.request("ulpi"))
+    host  = USBHostModel(phy)
+    codec = I2SCodecModel(platform.request("audio"), args.sample_rate, args.codec_ppm)
+    i2c   = I2CTargetModel(platform.request("i2c_audio"))
+    results = {}
+
+    def host_process():
+        yield from host.wait(100)
+        yield from host.bus_reset()
+
+        yield from host.get_descriptor(0x01, length=18)
+        yield from host.set_address(1)
+        header = yield from host.get_descriptor(0x02, length=9)
+        configuration = yield from host.get_descriptor(0x02, length=struct.unpack_from("<H", header, 2)[0])
+        yield from host.set_configuration(1)
+
+        streamer = AudioStreamer(host, configuration, args.alt_setting, args.sample_rate)
+        host.periodic.append(streamer.microframe)
+
+        # SET CUR of the sampling frequency control of clock source 1
+        yield from host.control_transfer(0x21, 0x01, 0x0100, 0x0100, struct.pack("<I", args.sample_rate))
+        yield from host.set_interface(1, args.alt_setting)
+        yield from host.set_interface(2, args.alt_setting)
+        start = host.time()
+        streamer.running = True
+
+        microframes = round(args.duration * 8)
+        for microframe in range(microframes):
+            yield from host.wait(host.CYCLES_PER_MICROFRAME)
+            if microframe % 8 == 7:
+                print(f"\r{(microframe + 1) / 8:.0f} of {args.duration:.0f} ms", end="", file=sys.stderr, flush=True)
+        print(file=sys.stderr)
+
+        streamer.running = False
+        results["duration"] = host.time() - start
+        results["streamer"] = streamer
+
+        telemetry = yield from host.control_transfer(0xc0, VendorRequestHandlers.REQUEST_READ_TELEMETRY, 0, 0,
+                                                     4 * len(Telemetry.REGISTERS))
+        results["telemetry"] = dict(zip(Telemetry.REGISTERS, struct.unpack(f"<{len(Telemetry.REGISTERS)}I", telemetry)))
+        results["mclk"] = yield from audio_pll.configured_frequency()
+
+    sim = Simulator(fragment)
+    sim.add_clock(1/60e6, domain="usb")
+    # the model of the audio PLL does not make a clock, MCLK runs at 256 * fs of the streamed sample rate from the start
+    sim.add_clock(1/(AudioInit.MCLK_PER_SAMPLE * args.sample_rate * (1 + args.codec_ppm * 1e-6)), domain="audio")
+    sim.add_sync_process(phy.process, domain="usb")
+    sim.add_sync_process(i2c.process, domain="usb")
+    sim.add_sync_process(host_process, domain="usb")
+    sim.add_process(codec.process)
+
+    if args.vcd:
+        with sim.write_vcd("deca_usb2_audio_interface.vcd"):
+            sim.run()
+    else:
+        sim.run()
+
+    streamer = results["streamer"]
+    duration = results["duration"]
+    subslot_format = dict(USB2AudioInterface.SUBSLOT_FORMATS)
+
+    print(f"simulated {host.time() * 1e3:.2f} ms, streaming for {duration * 1e3:.2f} ms "
+          f"({streamer.microframes} microframes) at {args.sample_rate} Hz, {streamer.nr_channels} channels, "
+          f"{streamer.out_subslot} byte subslots ({subslot_format[streamer.out_subslot]} bit)")
+    print(f"playback: {streamer.out_frames} frames, {streamer.out_bytes / duration / 1e6:.3f} MB/s, "
+          f"{streamer.out_frames / duration:.0f} frames/s, {codec.dac.values} ramp samples at the DAC")
+    print(f"record:   {streamer.in_frames} frames, {streamer.in_bytes / duration / 1e6:.3f} MB/s, "
+          f"{streamer.in_frames / duration:.0f} frames/s, {streamer.record.values} ramp samples from the ADC")
+    print(f"feedback: {streamer.feedback / 2**16:.5f} frames/microframe, "
+          f"nominal {args.sample_rate * (1 + args.codec_ppm * 1e-6) / 8000:.5f}")
+
+    packet_errors = { **host.errors, "feedback_errors": streamer.feedback_errors, "partial_frames": streamer.partial_frames }
+    xruns = { "playback": codec.dac.xruns, "record": streamer.record.xruns }
+    print("packet errors: " + ", ".join(f"{name} {count}" for name, count in packet_errors.items()) + f" ({host.naks} NAKs)")
+    print("xruns: " + ", ".join(f"{name} {count}" for name, count in xruns.items()))
+    print("device telemetry: " + ", ".join(f"{name} {value}" for name, value in results["telemetry"].items()))
+    print(f"codec: {len(i2c.writes)} register writes, {len(i2c.reads)} register reads, "
+          f"NDAC = {i2c.register(0, 0x0b) & 0x7f}, MDAC = {i2c.register(0, 0x0c) & 0x7f}")
+
+    # the audio PLL has to be set up for the streamed sample rate, within the accuracy of its counters
+    mclk = results["mclk"]
+    expected_mclk = AudioInit.MCLK_PER_SAMPLE * args.sample_rate
+    mclk_ok = mclk is not None and abs(mclk / expected_mclk - 1) < 1e-4
+    print(f"audio PLL: {mclk / 1e6:.6f} MHz" if mclk is not None else "audio PLL: never configured")
+
+    if any(packet_errors.values()) or any(xruns.values()) or not codec.dac.values or not streamer.record.values \
+       or not mclk_ok:
+        sys.exit(1)
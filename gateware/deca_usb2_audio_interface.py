@@ -3,14 +3,17 @@
 # Copyright (c) 2021 Hans Baier <hansfbaier@gmail.com>
 # SPDX-License-Identifier: CERN-OHL-W-2.0
 import os
+import sys
+import argparse
+
+from math                import ceil, log2
 
 from amaranth            import *
 from amaranth.lib.cdc    import FFSynchronizer
 
 from amlib.io.i2s        import I2STransmitter, I2SReceiver
-from amlib.stream.i2c    import I2CStreamTransmitter
 from amlib.debug.ila     import StreamILA, ILACoreParameters
-from amlib.utils         import EdgeToPulse, Timer
+from amlib.utils         import EdgeToPulse
 from amlib.io.max7219    import SerialLEDArray
 from amlib.io.led        import NumberToSevenSegmentHex
 
@@ -31,15 +34,145 @@ from luna.gateware.usb.usb2.request           import USBRequestHandler, StallOnl
 
 from usb_stream_to_channels import USBStreamToChannels
 from channels_to_usb_stream import ChannelsToUSBStream
-from requesthandlers        import UAC2RequestHandlers
+from requesthandlers        import UAC2RequestHandlers, VendorRequestHandlers
 from audio_init             import AudioInit
+from i2c_controller         import I2CController
+from codec_control          import CodecCommandQueue, I2CArbiter
+from feedback               import FeedbackValueCalculator, BufferLevelFeedbackCorrection
+from jitter_buffer          import JitterBuffer
+from tdm                    import TDMTransmitter, TDMReceiver, BitClockTDMTransmitter, BitClockTDMReceiver
+from packet_scheduler       import AudioFramesScheduler
+from compressed_ila         import CompressedStreamILA
+from latency                import LatencyProbe, LatencyHistogram
+from telemetry              import Telemetry
+from monitor_mixer          import MonitorMixer
+from playback_volume        import PlaybackVolume
+from loopback               import Loopback
 
 class USB2AudioInterface(Elaboratable):
     """ USB Audio Class v2 interface """
     NR_CHANNELS = 2
-    MAX_PACKET_SIZE = 512 # NR_CHANNELS * 24 + 4
-    USE_ILA = False
+    SUPPORTED_NR_CHANNELS = [2, 8, 16, 32]
+    # alternate settings 1, 2 and 3 of both streaming interfaces:
+    # 24 bit in 4 byte subslots, packed 24 bit in 3 byte subslots and 16 bit in 2 byte subslots
+    SUBSLOT_FORMATS = [(4, 24), (3, 24), (2, 16)]
+    SAMPLE_RATES = [44100, 48000, 88200, 96000, 176400, 192000]
+    DEFAULT_SAMPLE_RATE = 48000
+    # high bandwidth isochronous endpoints carry up to three
+    # transactions of up to 1024 bytes in each microframe
+    MAX_TRANSACTION_SIZE = 1024
+    MAX_TRANSACTIONS_PER_MICROFRAME = 3
+    # make the feedback value depend on the fill level of the jitter buffer
+    USE_BUFFER_LEVEL_FEEDBACK = True
+    # target fill level of the jitter buffer in microframes, plus a margin in audio frames:
+    # low-latency is for hosts which deliver every microframe in time,
+    # safe for loaded hosts which sometimes deliver a packet late
+    JITTER_BUFFER_PRESETS = {
+        "low-latency": (1, 4),
+        "safe":        (4, 8),
+    }
+    DEFAULT_JITTER_BUFFER_PRESET = "safe"
+    # i2s: stereo codec on the board, the other channels are discarded / zero
+    # tdm: all channels on the TDM header, TDM8 or TDM16 with 32 bit slots
+    SERIAL_FORMATS = ["i2s", "tdm"]
+    DEFAULT_SERIAL_FORMAT = "i2s"
+    TDM_NR_CHANNELS = [8, 16]
+    # usb:       the serial audio cores oversample the bus clocks with the 60MHz usb clock,
+    #            which limits the bit clock to about 15MHz (TDM16 at 192kHz needs 98.3MHz)
+    # bit-clock: the serial audio cores run from the bit clock, the samples cross to usb through AsyncFIFOs
+    SERIAL_CLOCKS = ["usb", "bit-clock"]
+    DEFAULT_SERIAL_CLOCK = "usb"
+
+    # latency histograms, readable with vendor requests:
+    # 512 bins of 2**8 USB clock cycles (4.27us) cover 2.2ms
+    LATENCY_HISTOGRAM_BINS = 512
+    LATENCY_HISTOGRAM_BIN_SHIFT = 8
+
+    # the integrated logic analyzer is built with --ila <preset>, the probes are in elaborate()
+    ILA_PRESETS = ["feedback", "out-converter", "in-converter", "i2c-init"]
     ILA_MAX_PACKET_SIZE = 512
+    # block RAM for the ILA samples, 48 M9K blocks
+    ILA_MEMORY_BITS = 48 * 8 * 1024
+
+    def __init__(self, nr_channels=NR_CHANNELS, jitter_buffer_preset=DEFAULT_JITTER_BUFFER_PRESET,
+                 serial_format=DEFAULT_SERIAL_FORMAT, serial_clock=DEFAULT_SERIAL_CLOCK,
+                 ila_preset=None, ila_compression=True):
+        assert nr_channels in self.SUPPORTED_NR_CHANNELS, f"unsupported number of channels: {nr_channels}"
+        assert jitter_buffer_preset in self.JITTER_BUFFER_PRESETS, f"unknown jitter buffer preset: {jitter_buffer_preset}"
+        assert serial_format in self.SERIAL_FORMATS, f"unknown serial format: {serial_format}"
+        assert serial_format != "tdm" or nr_channels in self.TDM_NR_CHANNELS, \
+            f"TDM needs one of {self.TDM_NR_CHANNELS} channels"
+        assert serial_clock in self.SERIAL_CLOCKS, f"unknown serial clock: {serial_clock}"
+        assert ila_preset is None or ila_preset in self.ILA_PRESETS, f"unknown ILA preset: {ila_preset}"
+        self.NR_CHANNELS = nr_channels
+        self.JITTER_BUFFER_PRESET = jitter_buffer_preset
+        self.SERIAL_FORMAT = serial_format
+        self.SERIAL_CLOCK = serial_clock
+        self.ILA_PRESET = ila_preset
+        self.USE_ILA = ila_preset is not None
+        # only store the samples where a probed signal changes, to capture longer windows
+        self.ILA_COMPRESSION = ila_compression
+        # number of channels on the serial audio interface
+        self.SERIAL_NR_CHANNELS = 2 if serial_format == "i2s" else nr_channels
+        # I2S from the bit clock is done by the TDM cores with two slots
+        self.USE_TDM_CORES = serial_format == "tdm" or serial_clock == "bit-clock"
+
+        # the largest subslot size determines the bandwidth we need
+        self.MAX_SUBSLOT_SIZE = max(subslot_size for subslot_size, _ in self.SUBSLOT_FORMATS)
+
+        # only offer the sample rates whose packets fit into a microframe
+        max_bytes = self.MAX_TRANSACTION_SIZE * self.MAX_TRANSACTIONS_PER_MICROFRAME
+        self.SAMPLE_RATES = [rate for rate in self.SAMPLE_RATES
+                             if self.max_frame_bytes(rate, self.MAX_SUBSLOT_SIZE) <= max_bytes]
+        assert self.DEFAULT_SAMPLE_RATE in self.SAMPLE_RATES
+
+        self.MAX_FRAME_BYTES = max(self.max_frame_bytes(rate, self.MAX_SUBSLOT_SIZE) for rate in self.SAMPLE_RATES)
+        self.TRANSACTIONS_PER_MICROFRAME = ceil(self.MAX_FRAME_BYTES / self.MAX_TRANSACTION_SIZE)
+
+        # packet size of the endpoint hardware
+        if self.TRANSACTIONS_PER_MICROFRAME == 1:
+            self.MAX_PACKET_SIZE = self.MAX_FRAME_BYTES
+        else:
+            self.MAX_PACKET_SIZE = self.MAX_TRANSACTION_SIZE
+
+        # the jitter buffer needs room for the target level and one more microframe of samples
+        max_samples = max(ceil(rate / 8000) + 1 for rate in self.SAMPLE_RATES)
+        min_depth = max(self.jitter_buffer_target_level(rate) for rate in self.SAMPLE_RATES) + \
+                    self.SERIAL_NR_CHANNELS * max_samples
+        self.JITTER_BUFFER_DEPTH = 2**ceil(log2(min_depth))
+
+        # set by ArrowDECAPlatform.build from the build cache, otherwise they are created in elaborate
+        self.descriptors = None
+
+    def jitter_buffer_target_level(self, sample_rate):
+        """ target fill level of the jitter buffer at the given sample rate, in samples """
+        microframes, margin_frames = self.JITTER_BUFFER_PRESETS[self.JITTER_BUFFER_PRESET]
+        return self.SERIAL_NR_CHANNELS * (microframes * ceil(sample_rate / 8000) + margin_frames)
+
+    def max_frame_bytes(self, sample_rate, subslot_size):
+        """ maximum number of audio bytes in one microframe at the given sample rate """
+        # the host may send one more sample than the nominal rate
+        # in a microframe to follow our feedback
+        max_samples = ceil(sample_rate / 8000) + 1
+        return max_samples * self.NR_CHANNELS * subslot_size
+
+    def iso_endpoint_max_packet_size(self, direction, subslot_size):
+        """ wMaxPacketSize of the audio endpoints: bits 12..11 contain the number of additional transactions """
+        if (direction == USBDirection.IN) or (self.TRANSACTIONS_PER_MICROFRAME == 1):
+            # the IN endpoint splits the microframe at the packet size of the hardware
+            packet_size  = self.MAX_PACKET_SIZE
+            transactions = self.TRANSACTIONS_PER_MICROFRAME
+        else:
+            # the host sends all but the last transaction of a microframe with
+            # the maximum packet size, so make it a multiple of the audio frame size
+            # to keep the transaction boundaries on audio frame boundaries
+            audio_frame_bytes = self.NR_CHANNELS * subslot_size
+            packet_size  = (self.MAX_TRANSACTION_SIZE // audio_frame_bytes) * audio_frame_bytes
+            frame_bytes  = max(self.max_frame_bytes(rate, subslot_size) for rate in self.SAMPLE_RATES)
+            transactions = ceil(frame_bytes / packet_size)
+            assert transactions <= self.MAX_TRANSACTIONS_PER_MICROFRAME
+
+        return packet_size | ((transactions - 1) << 11)
 
     def create_descriptors(self):
         """ Creates the descriptors that describe our audio topology. """
@@ -97,8 +230,8 @@ class USB2AudioInterface(Elaboratable):
         # AudioControl Interface Descriptor (ClockSource)
         clockSource = uac2.ClockSourceDescriptorEmitter()
         clockSource.bClockID     = 1
-        clockSource.bmAttributes = uac2.ClockAttributes.INTERNAL_FIXED_CLOCK
-        clockSource.bmControls   = uac2.ClockFrequencyControl.HOST_READ_ONLY
+        clockSource.bmAttributes = uac2.ClockAttributes.INTERNAL_PROGRAMMABLE_CLOCK
+        clockSource.bmControls   = uac2.ClockFrequencyControl.HOST_PROGRAMMABLE
         audioControlInterface.add_subordinate_descriptor(clockSource)
 
 
@@ -114,11 +247,19 @@ class USB2AudioInterface(Elaboratable):
         inputTerminal.bCSourceID    = 1
         audioControlInterface.add_subordinate_descriptor(inputTerminal)
 
+        # volume and mute of each playback channel, applied in the gateware
+        featureUnit             = uac2.FeatureUnitDescriptorEmitter()
+        featureUnit.bUnitID     = UAC2RequestHandlers.FEATURE_UNIT_ID
+        featureUnit.bSourceID   = 2
+        # no master controls, host programmable mute and volume for each channel
+        featureUnit.bmaControls = [0] + [0b1111] * self.NR_CHANNELS
+        audioControlInterface.add_subordinate_descriptor(featureUnit)
+
         # audio output port from the USB interface to the outside world
         outputTerminal               = uac2.OutputTerminalDescriptorEmitter()
         outputTerminal.bTerminalID   = 3
         outputTerminal.wTerminalType = uac2.OutputTerminalTypes.SPEAKER
-        outputTerminal.bSourceID     = 2
+        outputTerminal.bSourceID     = UAC2RequestHandlers.FEATURE_UNIT_ID
         outputTerminal.bCSourceID    = 1
         audioControlInterface.add_subordinate_descriptor(outputTerminal)
 
@@ -141,7 +282,7 @@ class USB2AudioInterface(Elaboratable):
         return audioControlInterface
 
 
-    def create_output_streaming_interface(self, c, *, nr_channels, alt_setting_nr):
+    def create_output_streaming_interface(self, c, *, nr_channels, alt_setting_nr, subslot_size, bit_resolution):
         # Interface Descriptor (Streaming, OUT, active setting)
         activeAudioStreamingInterface                   = uac2.AudioStreamingInterfaceDescriptorEmitter()
         activeAudioStreamingInterface.bInterfaceNumber  = 1
@@ -159,8 +300,8 @@ class USB2AudioInterface(Elaboratable):
 
         # AudioStreaming Interface Descriptor (Type I)
         typeIStreamingInterface  = uac2.TypeIFormatTypeDescriptorEmitter()
-        typeIStreamingInterface.bSubslotSize   = 4
-        typeIStreamingInterface.bBitResolution = 24 # we use all 24 bits
+        typeIStreamingInterface.bSubslotSize   = subslot_size
+        typeIStreamingInterface.bBitResolution = bit_resolution
         c.add_subordinate_descriptor(typeIStreamingInterface)
 
         # Endpoint Descriptor (Audio out)
@@ -169,7 +310,7 @@ class USB2AudioInterface(Elaboratable):
         audioOutEndpoint.bmAttributes         = USBTransferType.ISOCHRONOUS  | \
                                                 (USBSynchronizationType.ASYNC << 2) | \
                                                 (USBUsageType.DATA << 4)
-        audioOutEndpoint.wMaxPacketSize = self.MAX_PACKET_SIZE
+        audioOutEndpoint.wMaxPacketSize = self.iso_endpoint_max_packet_size(USBDirection.OUT, subslot_size)
         audioOutEndpoint.bInterval       = 1
         c.add_subordinate_descriptor(audioOutEndpoint)
 
@@ -200,10 +341,12 @@ class USB2AudioInterface(Elaboratable):
         # we need the default alternate setting to be stereo
         # out for windows to automatically recognize
         # and use this audio interface
-        self.create_output_streaming_interface(c, nr_channels=self.NR_CHANNELS, alt_setting_nr=1)
+        for alt_setting_nr, (subslot_size, bit_resolution) in enumerate(self.SUBSLOT_FORMATS, start=1):
+            self.create_output_streaming_interface(c, nr_channels=self.NR_CHANNELS, alt_setting_nr=alt_setting_nr,
+                                                   subslot_size=subslot_size, bit_resolution=bit_resolution)
 
 
-    def create_input_streaming_interface(self, c, *, nr_channels, alt_setting_nr, channel_config=0):
+    def create_input_streaming_interface(self, c, *, nr_channels, alt_setting_nr, subslot_size, bit_resolution, channel_config=0):
         # Interface Descriptor (Streaming, IN, active setting)
         activeAudioStreamingInterface = uac2.AudioStreamingInterfaceDescriptorEmitter()
         activeAudioStreamingInterface.bInterfaceNumber  = 2
@@ -222,8 +365,8 @@ class USB2AudioInterface(Elaboratable):
 
         # AudioStreaming Interface Descriptor (Type I)
         typeIStreamingInterface  = uac2.TypeIFormatTypeDescriptorEmitter()
-        typeIStreamingInterface.bSubslotSize   = 4
-        typeIStreamingInterface.bBitResolution = 24 # we use all 24 bits
+        typeIStreamingInterface.bSubslotSize   = subslot_size
+        typeIStreamingInterface.bBitResolution = bit_resolution
         c.add_subordinate_descriptor(typeIStreamingInterface)
 
         # Endpoint Descriptor (Audio out)
@@ -232,7 +375,7 @@ class USB2AudioInterface(Elaboratable):
         audioOutEndpoint.bmAttributes         = USBTransferType.ISOCHRONOUS  | \
                                                 (USBSynchronizationType.ASYNC << 2) | \
                                                 (USBUsageType.DATA << 4)
-        audioOutEndpoint.wMaxPacketSize = self.MAX_PACKET_SIZE
+        audioOutEndpoint.wMaxPacketSize = self.iso_endpoint_max_packet_size(USBDirection.IN, subslot_size)
         audioOutEndpoint.bInterval      = 1
         c.add_subordinate_descriptor(audioOutEndpoint)
 
@@ -251,21 +394,26 @@ class USB2AudioInterface(Elaboratable):
         c.add_subordinate_descriptor(quietAudioStreamingInterface)
 
         # Windows wants a stereo pair as default setting, so let's have it
-        self.create_input_streaming_interface(c, nr_channels=self.NR_CHANNELS, alt_setting_nr=1, channel_config=0x3)
+        # multichannel builds have no spatial channel locations
+        channel_config = 0x3 if self.NR_CHANNELS == 2 else 0x0
+        for alt_setting_nr, (subslot_size, bit_resolution) in enumerate(self.SUBSLOT_FORMATS, start=1):
+            self.create_input_streaming_interface(c, nr_channels=self.NR_CHANNELS, alt_setting_nr=alt_setting_nr,
+                                                  subslot_size=subslot_size, bit_resolution=bit_resolution,
+                                                  channel_config=channel_config)
 
     def elaborate(self, platform):
         m = Module()
 
         # Generate our domain clocks/resets.
         m.submodules.car = platform.clock_domain_generator()
-        m.submodules.audio_init = audio_init = AudioInit()
+        m.submodules.audio_init = audio_init = AudioInit(self.SAMPLE_RATES, self.DEFAULT_SAMPLE_RATE)
         i2c_audio_pads = platform.request("i2c_audio")
         m.submodules.i2c = i2c = DomainRenamer("usb") \
-            (I2CStreamTransmitter(i2c_audio_pads, int(60e6/400e3), clk_stretch=False))
-        m.submodules.audio_init_delay = audio_init_delay = \
-            Timer(width=28, load=int(120e6), reload=0, allow_restart=False)
-        m.submodules.i2s_transmitter = i2s_transmitter = DomainRenamer("usb")(I2STransmitter(sample_width=24))
-        m.submodules.i2s_receiver    = i2s_receiver    = DomainRenamer("usb")(I2SReceiver(sample_width=24))
+            (I2CController(i2c_audio_pads, int(60e6/400e3), clk_stretch=False))
+        # register writes from the host, between the sequences of AudioInit
+        m.submodules.codec_commands = codec_commands = \
+            DomainRenamer("usb")(CodecCommandQueue(device_address=AudioInit.CODEC_ADDRESS))
+        m.submodules.i2c_arbiter    = i2c_arbiter    = DomainRenamer("usb")(I2CArbiter())
 
         audio = platform.request("audio")
         debug = platform.request("debug")
@@ -273,40 +421,115 @@ class USB2AudioInterface(Elaboratable):
         m.d.comb += [
             # wire up DAC/ADC
             audio.mclk.eq(ClockSignal("audio")),
-            audio.reset.eq(ResetSignal("audio")),
+            audio.reset.eq(audio_init.codec_reset),
             audio.spi_select.eq(0), # choose i2c
-            audio_init_delay.start.eq(1),
-            audio_init.start.eq(audio_init_delay.done),
-
-            # wire up I2S transmitter
-            i2s_transmitter.word_select_in.eq(audio.wclk),
-            i2s_transmitter.serial_clock_in.eq(audio.bclk),
-            audio.din_mfp1.eq(i2s_transmitter.serial_data_out),
-
-            # wire up I2S receiver
-            i2s_receiver.word_select_in.eq(audio.wclk),
-            i2s_receiver.serial_clock_in.eq(audio.bclk),
-            i2s_receiver.serial_data_in.eq(audio.dout_mfp2),
-
-            debug.bclk.eq(audio.bclk),
-            debug.wclk.eq(audio.wclk),
-            debug.adc.eq(audio.dout_mfp2),
-            debug.dac.eq(i2s_transmitter.serial_data_out),
+            # AudioInit polls the codec until it answers
+            audio_init.start.eq(1),
+
+            i2c.read_request.eq(audio_init.read_request & i2c_arbiter.init_granted),
+            i2c.read_device.eq(audio_init.read_device),
+            i2c.read_register.eq(audio_init.read_register),
+            audio_init.read_data.eq(i2c.read_data),
+            audio_init.read_ack.eq(i2c.read_ack),
+            audio_init.read_done.eq(i2c.read_done),
         ]
 
-        with m.If(~audio_init.done):
-            m.d.comb += i2c.stream_in.stream_eq(audio_init.stream_out)
-        with m.Else():
+        if self.SERIAL_FORMAT == "i2s" and self.SERIAL_CLOCK == "usb":
+            m.submodules.i2s_transmitter = serial_transmitter = DomainRenamer("usb")(I2STransmitter(sample_width=24))
+            m.submodules.i2s_receiver    = serial_receiver    = DomainRenamer("usb")(I2SReceiver(sample_width=24))
+
+            m.d.comb += [
+                # wire up I2S transmitter
+                serial_transmitter.word_select_in.eq(audio.wclk),
+                serial_transmitter.serial_clock_in.eq(audio.bclk),
+                audio.din_mfp1.eq(serial_transmitter.serial_data_out),
+
+                # wire up I2S receiver
+                serial_receiver.word_select_in.eq(audio.wclk),
+                serial_receiver.serial_clock_in.eq(audio.bclk),
+                serial_receiver.serial_data_in.eq(audio.dout_mfp2),
+
+                debug.bclk.eq(audio.bclk),
+                debug.wclk.eq(audio.wclk),
+                debug.adc.eq(audio.dout_mfp2),
+                debug.dac.eq(serial_transmitter.serial_data_out),
+            ]
+
+        elif self.SERIAL_FORMAT == "i2s":
+            # the first slot starts one bit clock after the falling edge of the word clock, like in DSP mode A
+            m.submodules.i2s_transmitter = serial_transmitter = \
+                DomainRenamer("usb")(BitClockTDMTransmitter(nr_channels=2, sample_width=24))
+            m.submodules.i2s_receiver    = serial_receiver    = \
+                DomainRenamer("usb")(BitClockTDMReceiver(nr_channels=2, sample_width=24))
+
+            m.d.comb += [
+                serial_transmitter.frame_sync_in.eq(~audio.wclk),
+                serial_transmitter.bit_clock_in.eq(audio.bclk),
+                audio.din_mfp1.eq(serial_transmitter.serial_data_out),
+
+                serial_receiver.frame_sync_in.eq(~audio.wclk),
+                serial_receiver.bit_clock_in.eq(audio.bclk),
+                serial_receiver.serial_data_in.eq(audio.dout_mfp2),
+
+                debug.bclk.eq(audio.bclk),
+                debug.wclk.eq(audio.wclk),
+                debug.adc.eq(audio.dout_mfp2),
+                debug.dac.eq(serial_transmitter.serial_data_out),
+            ]
+
+            platform.add_clock_constraint(audio.bclk.i, 64 * max(self.SAMPLE_RATES))
+
+        else:
+            # the TDM codec gets our MCLK and is the clock master of the bus
+            tdm = platform.request("tdm")
+            transmitter, receiver = (BitClockTDMTransmitter, BitClockTDMReceiver) if self.SERIAL_CLOCK == "bit-clock" \
+                                    else (TDMTransmitter, TDMReceiver)
+            m.submodules.tdm_transmitter = serial_transmitter = \
+                DomainRenamer("usb")(transmitter(nr_channels=self.NR_CHANNELS, sample_width=24))
+            m.submodules.tdm_receiver    = serial_receiver    = \
+                DomainRenamer("usb")(receiver(nr_channels=self.NR_CHANNELS, sample_width=24))
+
+            if self.SERIAL_CLOCK == "bit-clock":
+                platform.add_clock_constraint(tdm.bclk.i, self.NR_CHANNELS * 32 * max(self.SAMPLE_RATES))
+
+            m.d.comb += [
+                tdm.mclk.eq(ClockSignal("audio")),
+
+                serial_transmitter.frame_sync_in.eq(tdm.fsync),
+                serial_transmitter.bit_clock_in.eq(tdm.bclk),
+                tdm.dout.eq(serial_transmitter.serial_data_out),
+
+                serial_receiver.frame_sync_in.eq(tdm.fsync),
+                serial_receiver.bit_clock_in.eq(tdm.bclk),
+                serial_receiver.serial_data_in.eq(tdm.din),
+
+                debug.bclk.eq(tdm.bclk),
+                debug.wclk.eq(tdm.fsync),
+                debug.adc.eq(tdm.din),
+                debug.dac.eq(serial_transmitter.serial_data_out),
+            ]
+
+        # the I2C bus stays connected after initialization, for sample rate changes and codec commands
+        m.d.comb += [
+            i2c_arbiter.init_stream.stream_eq(audio_init.stream_out),
+            i2c_arbiter.init_busy.eq(audio_init.busy),
+            i2c_arbiter.queue_stream.stream_eq(codec_commands.stream_out),
+            i2c_arbiter.queue_busy.eq(codec_commands.busy),
+            i2c_arbiter.i2c_busy.eq(i2c.busy),
+            i2c.stream_in.stream_eq(i2c_arbiter.stream_out),
+        ]
+
+        with m.If(audio_init.done):
             m.d.comb += [
-                i2s_transmitter.enable_in.eq(1),
-                i2s_receiver.enable_in.eq(1),
+                serial_transmitter.enable_in.eq(1),
+                serial_receiver.enable_in.eq(1),
             ]
 
         ulpi = platform.request(platform.default_usb_connection)
         m.submodules.usb = usb = USBDevice(bus=ulpi)
 
         # Add our standard control endpoint to the device.
-        descriptors = self.create_descriptors()
+        descriptors = self.descriptors if self.descriptors is not None else self.create_descriptors()
         control_ep = usb.add_control_endpoint()
         control_ep.add_standard_request_handlers(descriptors, blacklist=[
             lambda setup:   (setup.type    == USBRequestType.STANDARD)
@@ -314,13 +537,28 @@ class USB2AudioInterface(Elaboratable):
         ])
 
         # Attach our class request handlers.
-        class_request_handler = UAC2RequestHandlers()
+        class_request_handler = UAC2RequestHandlers(self.SAMPLE_RATES, self.DEFAULT_SAMPLE_RATE, nr_channels=self.NR_CHANNELS,
+            volume_range=(PlaybackVolume.VOLUME_MIN, PlaybackVolume.VOLUME_MAX, PlaybackVolume.VOLUME_RESOLUTION))
         control_ep.add_request_handler(class_request_handler)
 
-        # Attach class-request handlers that stall any vendor or reserved requests,
+        m.d.comb += [
+            audio_init.sample_rate_index.eq(class_request_handler.sample_rate_index),
+            audio_init.set_sample_rate.eq(class_request_handler.sample_rate_changed),
+        ]
+
+        # vendor requests give the host access to our instrumentation
+        vendor_request_handler = VendorRequestHandlers(nr_histogram_bins=self.LATENCY_HISTOGRAM_BINS)
+        control_ep.add_request_handler(vendor_request_handler)
+
+        m.d.comb += [
+            codec_commands.command_in.payload.eq(vendor_request_handler.codec_command),
+            codec_commands.command_in.valid.eq(vendor_request_handler.write_codec_command),
+            vendor_request_handler.codec_queue_ready.eq(codec_commands.command_in.ready),
+        ]
+
+        # Attach class-request handlers that stall any reserved requests,
         # as we don't have or need any.
         stall_condition = lambda setup : \
-            (setup.type == USBRequestType.VENDOR) | \
             (setup.type == USBRequestType.RESERVED)
         control_ep.add_request_handler(StallOnlyRequestHandler(stall_condition))
 
@@ -339,21 +577,49 @@ class USB2AudioInterface(Elaboratable):
             max_packet_size=self.MAX_PACKET_SIZE)
         usb.add_endpoint(ep2_in)
 
-        # calculate bytes in frame for audio in
-        audio_in_frame_bytes = Signal(range(self.MAX_PACKET_SIZE), reset=24 * self.NR_CHANNELS)
-        audio_in_frame_bytes_counting = Signal()
+        m.submodules.usb_to_channel_stream = usb_to_channel_stream = \
+            DomainRenamer("usb")(USBStreamToChannels(self.NR_CHANNELS))
 
-        with m.If(ep1_out.stream.valid & ep1_out.stream.ready):
-            with m.If(audio_in_frame_bytes_counting):
-                m.d.usb += audio_in_frame_bytes.eq(audio_in_frame_bytes + 1)
+        m.submodules.channels_to_usb_stream = channels_to_usb_stream = \
+            DomainRenamer("usb")(ChannelsToUSBStream(self.NR_CHANNELS, max_packet_size=self.MAX_FRAME_BYTES))
 
-            with m.If(ep1_out.stream.first):
-                m.d.usb += [
-                    audio_in_frame_bytes.eq(1),
-                    audio_in_frame_bytes_counting.eq(1),
-                ]
-            with m.Elif(ep1_out.stream.last):
-                m.d.usb += audio_in_frame_bytes_counting.eq(0)
+        # the alternate setting of each streaming interface selects its subslot size
+        out_subslot_size = Signal(3, reset=4)
+        in_subslot_size  = Signal(3, reset=4)
+
+        for alt_setting_nr, (subslot_size, _) in enumerate(self.SUBSLOT_FORMATS, start=1):
+            with m.If(class_request_handler.output_interface_altsetting_nr == alt_setting_nr):
+                m.d.comb += out_subslot_size.eq(subslot_size)
+            with m.If(class_request_handler.input_interface_altsetting_nr == alt_setting_nr):
+                m.d.comb += in_subslot_size.eq(subslot_size)
+
+        m.d.comb += [
+            usb_to_channel_stream.subslot_size.eq(out_subslot_size),
+            channels_to_usb_stream.subslot_size.eq(in_subslot_size),
+        ]
+
+        # calculate bytes in frame for audio in
+        # the IN packets follow the real sample clock, independent of the OUT stream:
+        # the scheduler spreads the measured number of samples per microframe
+        # over the packets and only sends audio frames the ADC already captured
+        max_samples_per_microframe = max(ceil(rate / 8000) + 1 for rate in self.SAMPLE_RATES)
+        m.submodules.audio_in_scheduler = audio_in_scheduler = \
+            DomainRenamer("usb")(AudioFramesScheduler(max_frames_per_microframe=max_samples_per_microframe))
+
+        audio_in_frame_bytes = Signal(range(self.MAX_FRAME_BYTES + 1))
+        m.d.comb += [
+            audio_in_scheduler.start_of_frame.eq(usb.sof_detected),
+            audio_in_scheduler.frames_available.eq(channels_to_usb_stream.frames_available),
+            audio_in_scheduler.reset_schedule.eq(class_request_handler.sample_rate_changed),
+        ]
+
+        # the IN endpoint latches bytes_in_frame in the SOF cycle, the frames of the same packet
+        # are handed over in that cycle, before the scheduler sets the size of the next one
+        m.d.comb += [
+            channels_to_usb_stream.start_packet.eq(usb.sof_detected),
+            channels_to_usb_stream.packet_frames.eq(audio_in_scheduler.frames_in_packet),
+            audio_in_frame_bytes.eq(channels_to_usb_stream.packet_frames_handed * self.NR_CHANNELS * in_subslot_size),
+        ]
 
         # Connect our device as a high speed device
         m.d.comb += [
@@ -364,19 +630,22 @@ class USB2AudioInterface(Elaboratable):
         ]
 
         # feedback endpoint
-        feedbackValue      = Signal(32, reset=0x60000)
         bitPos             = Signal(5)
 
-        # this tracks the number of audio frames since the last USB frame
-        # 12.288MHz / 8kHz = 1536, so we need at least 11 bits = 2048
-        # we need to capture 32 micro frames to get to the precision
-        # required by the USB standard, so and that is 0xc000, so we
-        # need 16 bits here
-        audio_clock_counter = Signal(16)
-        sof_counter         = Signal(5)
+        sample_rates = sorted(self.SAMPLE_RATES)
+
+        # MCLK is 256 * fs, at 2x and 4x speed it is divided down to 256 * base rate,
+        # which the usb domain can still sample
+        mclk_divider = Signal(2)
+        mclk_divided = Signal()
+        m.d.audio += mclk_divider.eq(mclk_divider + 1)
+        m.d.comb  += mclk_divided.eq(
+            Array([ClockSignal("audio"), mclk_divider[0], mclk_divider[1]]) \
+                [Array(Const(AudioInit.rate_family(rate)[1].bit_length() - 1, 2) for rate in sample_rates) \
+                    [class_request_handler.sample_rate_index]])
 
         audio_clock_usb = Signal()
-        m.submodules.audio_clock_usb_sync = FFSynchronizer(ClockSignal("audio"), audio_clock_usb, o_domain="usb")
+        m.submodules.audio_clock_usb_sync = FFSynchronizer(mclk_divided, audio_clock_usb, o_domain="usb")
         m.submodules.audio_clock_usb_pulse = audio_clock_usb_pulse = DomainRenamer("usb")(EdgeToPulse())
         audio_clock_tick = Signal()
         m.d.usb += [
@@ -384,61 +653,302 @@ class USB2AudioInterface(Elaboratable):
             audio_clock_tick.eq(audio_clock_usb_pulse.pulse_out),
         ]
 
-        with m.If(audio_clock_tick):
-            m.d.usb += audio_clock_counter.eq(audio_clock_counter + 1)
-
-        with m.If(usb.sof_detected):
-            m.d.usb += sof_counter.eq(sof_counter + 1)
-
-            # according to USB2 standard chapter 5.12.4.2
-            # we need 2**13 / 2**8 = 2**5 = 32 SOF-frames of
-            # sample master frequency counter to get enough
-            # precision for the sample frequency estimate
-            # / 2**8 because the ADAT-clock = 256 times = 2**8
-            # the sample frequency and sof_counter is 5 bits
-            # so it wraps automatically every 32 SOFs
-            with m.If(sof_counter == 0):
-                m.d.usb += [
-                    feedbackValue.eq(audio_clock_counter << 3),
-                    audio_clock_counter.eq(0),
+        # 12.288MHz / 8kHz = 1536 MCLK ticks per microframe at 48kHz.
+        # The estimator averages over a sliding window of 128 microframes,
+        # which gives more precision than the 2**13 / 2**8 = 32 frames
+        # required by USB2 chapter 5.12.4.2, and updates every microframe
+        m.submodules.feedback = feedback = DomainRenamer("usb")(
+            FeedbackValueCalculator(window_log2=7, max_ticks_per_microframe=2048))
+
+        # the codec derives the sample clock from MCLK,
+        # so the tick count has to be scaled by fs / (256 * base rate) for each sample rate
+        scale_bits = FeedbackValueCalculator.SCALE_FRACTIONAL_BITS
+        m.d.comb += [
+            feedback.start_of_frame.eq(usb.sof_detected),
+            feedback.clock_tick.eq(audio_clock_tick),
+            feedback.scale.eq(
+                Array(Const(round(AudioInit.rate_family(rate)[1] / AudioInit.MCLK_PER_SAMPLE * 2**scale_bits), 32)
+                      for rate in sample_rates) \
+                    [class_request_handler.sample_rate_index]),
+            feedback.nominal_value.eq(
+                Array(Const(round(rate / 8000 * 2**16), 32) for rate in sample_rates) \
+                    [class_request_handler.sample_rate_index]),
+            feedback.reset_estimate.eq(class_request_handler.sample_rate_changed),
+            # the ADC runs from the same clock as the DAC
+            audio_in_scheduler.samples_per_microframe.eq(feedback.feedback_value),
+        ]
+
+        # wire USB to the serial audio transmitter through the jitter buffer
+        m.submodules.jitter_buffer = jitter_buffer = \
+            DomainRenamer("usb")(JitterBuffer(depth=self.JITTER_BUFFER_DEPTH, nr_channels=self.SERIAL_NR_CHANNELS))
+
+        jitter_buffer_target_level = Array(Const(self.jitter_buffer_target_level(rate), jitter_buffer.level.width)
+                                           for rate in sample_rates)
+        m.d.comb += [
+            jitter_buffer.target_level.eq(jitter_buffer_target_level[class_request_handler.sample_rate_index]),
+            jitter_buffer.flush.eq(class_request_handler.sample_rate_changed),
+        ]
+
+        dac_stream = usb_to_channel_stream.channel_stream_out
+        if self.NR_CHANNELS == self.SERIAL_NR_CHANNELS:
+            m.d.comb += [
+                jitter_buffer.stream_in.stream_eq(dac_stream),
+                jitter_buffer.stream_in.channel_no.eq(dac_stream.channel_no),
+            ]
+        else:
+            # the codec only has two channels, the others are discarded
+            with m.If(dac_stream.channel_no < 2):
+                m.d.comb += [
+                    jitter_buffer.stream_in.payload.eq(dac_stream.payload),
+                    jitter_buffer.stream_in.channel_no.eq(dac_stream.channel_no),
+                    jitter_buffer.stream_in.valid.eq(dac_stream.valid),
+                    jitter_buffer.stream_in.first.eq(dac_stream.channel_no == 0),
+                    jitter_buffer.stream_in.last.eq(dac_stream.channel_no == 1),
+                    dac_stream.ready.eq(jitter_buffer.stream_in.ready),
                 ]
+            with m.Else():
+                m.d.comb += dac_stream.ready.eq(1)
+
+        # the volume and mute of the feature unit
+        m.submodules.playback_volume = playback_volume = \
+            DomainRenamer("usb")(PlaybackVolume(nr_channels=self.SERIAL_NR_CHANNELS))
+
+        # direct monitoring: the ADC samples are mixed into the playback samples on their way to the DAC.
+        # The mixer sends one DAC sample for each ADC sample, so the serial receiver paces the playback:
+        # the DAC only gets samples while the codec delivers ADC samples to serial_receiver.stream_out
+        m.submodules.monitor_mixer = monitor_mixer = \
+            DomainRenamer("usb")(MonitorMixer(nr_channels=self.SERIAL_NR_CHANNELS))
+
+        # round-trip latency measurements, the analog marker goes in after the monitor mix
+        m.submodules.loopback = loopback = DomainRenamer("usb")(Loopback(nr_channels=self.SERIAL_NR_CHANNELS))
 
         m.d.comb += [
-            bitPos.eq(ep1_in.address << 3),
-            ep1_in.value.eq(0xff & (feedbackValue >> bitPos)),
+            playback_volume.stream_in.stream_eq(jitter_buffer.stream_out),
+            playback_volume.stream_in.channel_no.eq(jitter_buffer.stream_out.channel_no),
+            monitor_mixer.playback_in.stream_eq(playback_volume.stream_out),
+            monitor_mixer.playback_in.channel_no.eq(playback_volume.stream_out.channel_no),
+            loopback.stream_in.stream_eq(monitor_mixer.stream_out),
+            loopback.stream_in.channel_no.eq(monitor_mixer.stream_out.channel_no),
+            serial_transmitter.stream_in.stream_eq(loopback.stream_out),
+
+            monitor_mixer.gain_channel.eq(vendor_request_handler.monitor_gain_channel),
+            monitor_mixer.gain_value.eq(vendor_request_handler.monitor_gain_value),
+            monitor_mixer.gain_write.eq(vendor_request_handler.set_monitor_gain),
+            monitor_mixer.read_address.eq(vendor_request_handler.read_address),
+            vendor_request_handler.monitor_gain_data.eq(monitor_mixer.read_data),
+            playback_volume.mute.eq(class_request_handler.mute),
         ]
+        m.d.comb += [playback_volume.volume[channel].eq(class_request_handler.volume[channel])
+                     for channel in range(self.SERIAL_NR_CHANNELS)]
+        if self.USE_TDM_CORES:
+            m.d.comb += serial_transmitter.stream_in.channel_no.eq(loopback.stream_out.channel_no)
 
-        m.submodules.usb_to_channel_stream = usb_to_channel_stream = \
-            DomainRenamer("usb")(USBStreamToChannels(self.NR_CHANNELS))
+        m.d.comb += [
+            loopback.mode_in.eq(vendor_request_handler.loopback_mode),
+            loopback.set_mode.eq(vendor_request_handler.set_loopback),
+            loopback.read_address.eq(vendor_request_handler.read_address),
+            vendor_request_handler.loopback_data.eq(loopback.read_data),
+        ]
 
-        m.submodules.channels_to_usb_stream = channels_to_usb_stream = \
-            DomainRenamer("usb")(ChannelsToUSBStream(self.NR_CHANNELS))
+        # steer the jitter buffer level towards its target level,
+        # so clock drift and host jitter cannot make it run empty over time
+        if self.USE_BUFFER_LEVEL_FEEDBACK:
+            m.submodules.feedback_correction = feedback_correction = \
+                DomainRenamer("usb")(BufferLevelFeedbackCorrection(level_width=jitter_buffer.level.width))
+
+            m.d.comb += [
+                feedback_correction.start_of_frame.eq(usb.sof_detected),
+                feedback_correction.enable.eq((class_request_handler.output_interface_altsetting_nr != 0) &
+                                              ~jitter_buffer.prefilling),
+                feedback_correction.buffer_level.eq(jitter_buffer.level),
+                feedback_correction.target_level.eq(jitter_buffer.target_level),
+                feedback_correction.feedback_in.eq(feedback.feedback_value),
+            ]
+            feedbackValue = feedback_correction.feedback_out
+        else:
+            feedbackValue = feedback.feedback_value
+
+        m.d.comb += [
+            bitPos.eq(ep1_in.address << 3),
+            ep1_in.value.eq(0xff & (feedbackValue >> bitPos)),
+        ]
 
         m.d.comb += [
-            # wire USB to I2S transmitter
             usb_to_channel_stream.usb_stream_in.stream_eq(ep1_out.stream),
-            i2s_transmitter.stream_in.stream_eq(usb_to_channel_stream.channel_stream_out),
-            # wire I2S receiver to USB
-            channels_to_usb_stream.channel_stream_in.stream_eq(i2s_receiver.stream_out),
-            channels_to_usb_stream.channel_stream_in.channel_no.eq(~i2s_receiver.stream_out.first),
             ep2_in.stream.stream_eq(channels_to_usb_stream.usb_stream_out),
         ]
 
-        if self.USE_ILA:
-            sof_wrap = Signal()
-            m.d.comb += sof_wrap.eq(sof_counter == 0)
+        adc_channel_no = Signal(range(self.SERIAL_NR_CHANNELS))
+        if self.USE_TDM_CORES:
+            m.d.comb += adc_channel_no.eq(serial_receiver.stream_out.channel_no)
+        else:
+            m.d.comb += adc_channel_no.eq(~serial_receiver.stream_out.first)
+
+        # digital loopback: the samples from USB go straight back to USB, the codec gets none
+        with m.If(loopback.digital):
+            m.d.comb += [
+                channels_to_usb_stream.channel_stream_in.stream_eq(dac_stream),
+                channels_to_usb_stream.channel_stream_in.channel_no.eq(dac_stream.channel_no),
+                jitter_buffer.stream_in.valid.eq(0),
+            ]
 
-            signals = [
+        # wire the serial audio receiver to USB, ChannelsToUSBStream fills the remaining channels with zeros
+        with m.Else():
+            m.d.comb += [
+                channels_to_usb_stream.channel_stream_in.stream_eq(serial_receiver.stream_out),
+                channels_to_usb_stream.channel_stream_in.channel_no.eq(adc_channel_no),
             ]
 
-            signals_bits = sum([s.width for s in signals])
-            depth = 3 * 8 * 1024 #int(33*8*1024/signals_bits)
-            m.submodules.ila = ila = \
-                StreamILA(
-                    signals=signals,
-                    sample_depth=depth,
-                    domain="usb", o_domain="usb",
-                    samples_pretrigger=1024)
+        # the ADC samples go to USB, to the monitor mix and to the analog loopback
+        m.d.comb += [
+            monitor_mixer.monitor_in.valid.eq(serial_receiver.stream_out.valid),
+            monitor_mixer.monitor_in.payload.eq(serial_receiver.stream_out.payload),
+            monitor_mixer.monitor_in.channel_no.eq(adc_channel_no),
+
+            loopback.adc_in.valid.eq(serial_receiver.stream_out.valid),
+            loopback.adc_in.payload.eq(serial_receiver.stream_out.payload),
+            loopback.adc_in.channel_no.eq(adc_channel_no),
+        ]
+
+        #
+        # latency instrumentation
+        #
+        # playback: from the first byte of an OUT packet until its first sample leaves the serial transmitter
+        # record:   from an ADC sample of channel 0 until the first byte of its frame goes out on EP2 IN
+        m.submodules.playback_latency   = playback_latency   = DomainRenamer("usb")(LatencyProbe())
+        m.submodules.record_latency     = record_latency     = DomainRenamer("usb")(LatencyProbe())
+        m.submodules.playback_histogram = playback_histogram = DomainRenamer("usb")(
+            LatencyHistogram(nr_bins=self.LATENCY_HISTOGRAM_BINS, bin_shift=self.LATENCY_HISTOGRAM_BIN_SHIFT))
+        m.submodules.record_histogram   = record_histogram   = DomainRenamer("usb")(
+            LatencyHistogram(nr_bins=self.LATENCY_HISTOGRAM_BINS, bin_shift=self.LATENCY_HISTOGRAM_BIN_SHIFT))
+
+        # samples in the FIFO of the serial transmitter
+        transmitter_backlog = Signal(16)
+        transmitter_sample_in  = Signal()
+        transmitter_sample_out = Signal()
+
+        if not self.USE_TDM_CORES:
+            # the I2S transmitter takes a sample from its FIFO at each word select edge
+            word_select      = Signal()
+            word_select_last = Signal()
+            m.submodules.word_select_sync = FFSynchronizer(audio.wclk, word_select, o_domain="usb")
+            m.d.usb += word_select_last.eq(word_select)
+            m.d.comb += transmitter_sample_out.eq((word_select != word_select_last) & (transmitter_backlog != 0))
+        else:
+            m.d.comb += transmitter_sample_out.eq(serial_transmitter.sample_out)
+
+        m.d.comb += transmitter_sample_in.eq(serial_transmitter.stream_in.valid & serial_transmitter.stream_in.ready)
+        m.d.usb += transmitter_backlog.eq(transmitter_backlog + transmitter_sample_in - transmitter_sample_out)
+
+        record_stream = channels_to_usb_stream.channel_stream_in
+        m.d.comb += [
+            playback_latency.start.eq(ep1_out.stream.valid & ep1_out.stream.ready & ep1_out.stream.first),
+            playback_latency.ahead.eq(jitter_buffer.level + transmitter_backlog),
+            playback_latency.item_out.eq(transmitter_sample_out),
+            playback_latency.abort.eq(jitter_buffer.flush),
+
+            record_latency.start.eq(record_stream.valid & record_stream.ready & (record_stream.channel_no == 0)),
+            record_latency.ahead.eq(channels_to_usb_stream.frames_queued),
+            record_latency.item_out.eq(channels_to_usb_stream.frame_sent),
+            record_latency.abort.eq(channels_to_usb_stream.frames_dropped),
+
+            playback_histogram.latency.eq(playback_latency.latency),
+            playback_histogram.latency_valid.eq(playback_latency.latency_valid),
+            record_histogram.latency.eq(record_latency.latency),
+            record_histogram.latency_valid.eq(record_latency.latency_valid),
+
+            playback_histogram.clear.eq(vendor_request_handler.clear_histograms),
+            record_histogram.clear.eq(vendor_request_handler.clear_histograms),
+            playback_histogram.read_address.eq(vendor_request_handler.read_address),
+            record_histogram.read_address.eq(vendor_request_handler.read_address),
+            vendor_request_handler.histogram_data.eq(Mux(vendor_request_handler.histogram_select,
+                                                         record_histogram.read_data, playback_histogram.read_data)),
+        ]
+
+        if self.USE_ILA:
+            # named copies of the probed signals, so they can be told apart on the host
+            def probes(*named_signals):
+                signals = []
+                for name, signal in named_signals:
+                    probe = Signal.like(signal, name=name)
+                    m.d.comb += probe.eq(signal)
+                    signals.append(probe)
+                return signals
+
+            if self.ILA_PRESET == "feedback":
+                signals = probes(
+                    ("sof",                    usb.sof_detected),
+                    ("value_updated",          feedback.value_updated),
+                    ("feedback_value",         feedback.feedback_value),
+                    ("feedback_sent",          feedbackValue),
+                    ("jitter_buffer_level",    jitter_buffer.level),
+                    ("jitter_buffer_underrun", jitter_buffer.underrun),
+                )
+                # as soon as the host starts playing
+                trigger = class_request_handler.output_interface_altsetting_nr != 0
+
+            elif self.ILA_PRESET == "out-converter":
+                signals = probes(
+                    ("usb_valid",           ep1_out.stream.valid),
+                    ("usb_first",           ep1_out.stream.first),
+                    ("usb_last",            ep1_out.stream.last),
+                    ("usb_payload",         ep1_out.stream.payload),
+                    ("channel_valid",       dac_stream.valid),
+                    ("channel_ready",       dac_stream.ready),
+                    ("channel_no",          dac_stream.channel_no),
+                    ("channel_payload",     dac_stream.payload),
+                    ("jitter_buffer_level", jitter_buffer.level),
+                    ("underflow",           serial_transmitter.underflow_out),
+                )
+                trigger = ep1_out.stream.valid & ep1_out.stream.first
+
+            elif self.ILA_PRESET == "in-converter":
+                signals = probes(
+                    ("adc_valid",        record_stream.valid),
+                    ("adc_channel_no",   record_stream.channel_no),
+                    ("adc_payload",      record_stream.payload),
+                    ("frames_available", channels_to_usb_stream.frames_available),
+                    ("start_packet",     channels_to_usb_stream.start_packet),
+                    ("packet_frames",    channels_to_usb_stream.packet_frames),
+                    ("frames_dropped",   channels_to_usb_stream.frames_dropped),
+                    ("usb_valid",        ep2_in.stream.valid),
+                    ("usb_ready",        ep2_in.stream.ready),
+                    ("usb_first",        ep2_in.stream.first),
+                    ("usb_last",         ep2_in.stream.last),
+                    ("usb_payload",      ep2_in.stream.payload),
+                )
+                trigger = channels_to_usb_stream.start_packet
+
+            elif self.ILA_PRESET == "i2c-init":
+                signals = probes(
+                    ("init_start",  audio_init.start),
+                    ("init_done",   audio_init.done),
+                    ("i2c_valid",   i2c.stream_in.valid),
+                    ("i2c_ready",   i2c.stream_in.ready),
+                    ("i2c_first",   i2c.stream_in.first),
+                    ("i2c_last",    i2c.stream_in.last),
+                    ("i2c_payload", i2c.stream_in.payload),
+                    ("scl_oe",      i2c_audio_pads.scl.oe),
+                    ("sda_oe",      i2c_audio_pads.sda.oe),
+                    ("sda_in",      i2c_audio_pads.sda.i),
+                )
+                trigger = audio_init.start
+
+            if self.ILA_COMPRESSION:
+                repeat_width = 8
+                entry_bits = sum(len(s) for s in signals) + repeat_width
+                depth = 2**int(log2(self.ILA_MEMORY_BITS // entry_bits))
+                m.submodules.ila = ila = DomainRenamer("usb")(
+                    CompressedStreamILA(signals=signals, sample_depth=depth, repeat_width=repeat_width))
+            else:
+                entry_bits = sum(len(s) for s in signals)
+                depth = 2**int(log2(self.ILA_MEMORY_BITS // entry_bits))
+                m.submodules.ila = ila = \
+                    StreamILA(
+                        signals=signals,
+                        sample_depth=depth,
+                        domain="usb", o_domain="usb",
+                        samples_pretrigger=1024)
 
             stream_ep = USBMultibyteStreamInEndpoint(
                 endpoint_number=3, # EP 3 IN
@@ -449,7 +959,7 @@ class USB2AudioInterface(Elaboratable):
 
             m.d.comb += [
                 stream_ep.stream.stream_eq(ila.stream),
-                ila.trigger.eq(audio_init_delay.done),
+                ila.trigger.eq(trigger),
             ]
 
             ILACoreParameters(ila).pickle()
@@ -460,12 +970,39 @@ class USB2AudioInterface(Elaboratable):
             leds[1].eq(usb.rx_activity_led),
             leds[2].eq(usb.suspended),
             leds[3].eq(usb.reset_detected),
-            leds[4].eq(audio_init_delay.done),
+            leds[4].eq(audio_init.done),
+        ]
+
+        # health counters for the host
+        m.submodules.telemetry = telemetry = DomainRenamer("usb")(Telemetry())
+        # the monitor mixer keeps the transmitter fed, while the output interface is active
+        # a missing playback sample is an underflow as well, unless the digital loopback takes the playback.
+        # While the jitter buffer prefills after a flush, an alt setting change or an underrun
+        # (which counts as jitter_buffer_underruns), the gaps are expected
+        underflow = Signal()
+        m.d.comb += underflow.eq(~usb.suspended &
+            (serial_transmitter.underflow_out |
+             (monitor_mixer.playback_missing & (class_request_handler.output_interface_altsetting_nr != 0) &
+              ~jitter_buffer.prefilling & ~loopback.digital)))
+
+        m.d.comb += [
+            telemetry.underflow.eq(underflow),
+            telemetry.jitter_buffer_underrun.eq(jitter_buffer.underrun),
+            telemetry.record_overflow.eq(channels_to_usb_stream.frames_dropped),
+            telemetry.jitter_buffer_level.eq(jitter_buffer.level),
+            telemetry.transmitter_level.eq(transmitter_backlog),
+            telemetry.record_level.eq(channels_to_usb_stream.frames_queued),
+            telemetry.feedback_value.eq(feedbackValue),
+            telemetry.start_of_frame.eq(usb.sof_detected),
+            telemetry.altsetting_changed.eq(class_request_handler.interface_settings_changed),
+            telemetry.clear.eq(vendor_request_handler.clear_telemetry),
+            telemetry.read_address.eq(vendor_request_handler.read_address),
+            vendor_request_handler.telemetry_data.eq(telemetry.read_data),
         ]
 
         underflow_count = Signal(16)
 
-        with m.If(~usb.suspended & i2s_transmitter.underflow_out):
+        with m.If(underflow):
             m.d.sync += underflow_count.eq(underflow_count + 1)
 
         spi = platform.request("spi")
@@ -482,5 +1019,29 @@ class USB2AudioInterface(Elaboratable):
         return m
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--channels", type=int, default=USB2AudioInterface.NR_CHANNELS,
+                        choices=USB2AudioInterface.SUPPORTED_NR_CHANNELS,
+                        help="number of audio channels in each direction")
+    parser.add_argument("--jitter-buffer", default=USB2AudioInterface.DEFAULT_JITTER_BUFFER_PRESET,
+                        choices=USB2AudioInterface.JITTER_BUFFER_PRESETS.keys(),
+                        help="latency / robustness trade-off of the playback jitter buffer")
+    parser.add_argument("--serial-format", default=USB2AudioInterface.DEFAULT_SERIAL_FORMAT,
+                        choices=USB2AudioInterface.SERIAL_FORMATS,
+                        help="i2s to the codec on the board, or tdm on the TDM header (8 or 16 channels)")
+    parser.add_argument("--serial-clock", default=USB2AudioInterface.DEFAULT_SERIAL_CLOCK,
+                        choices=USB2AudioInterface.SERIAL_CLOCKS,
+                        help="clock the serial audio cores from the usb clock (oversampling) or the bit clock")
+    parser.add_argument("--ila", default=None, choices=USB2AudioInterface.ILA_PRESETS,
+                        help="build the integrated logic analyzer on EP3 with these probes")
+    parser.add_argument("--ila-uncompressed", action="store_true",
+                        help="store every ILA sample instead of only the changes")
+    args, remaining_args = parser.parse_known_args()
+    # leave the remaining arguments to the LUNA command line interface
+    sys.argv = sys.argv[:1] + remaining_args
+
     os.environ["LUNA_PLATFORM"] = "arrow_deca:ArrowDECAPlatform"
-    top_level_cli(USB2AudioInterface)
+    top_level_cli(USB2AudioInterface, nr_channels=args.channels,
+                  jitter_buffer_preset=args.jitter_buffer,
+                  serial_format=args.serial_format, serial_clock=args.serial_clock,
+                  ila_preset=args.ila, ila_compression=not args.ila_uncompressed)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+import argparse
+
+from feedback import FeedbackValueCalculator
+from amaranth.sim import Simulator, Tick
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="convergence and steady state error of the feedback value")
+    parser.add_argument("--vcd", metavar="FILE", help="write the waveforms to FILE")
+    args = parser.parse_args()
+
+    # scaled down microframe to keep the simulation short:
+    # 200 clock cycles per microframe, 64 audio clock ticks per microframe
+    # and 6 samples per microframe at the nominal audio clock
+    CYCLES_PER_MICROFRAME = 200
+    TICKS_PER_MICROFRAME  = 64
+    SAMPLES_PER_MICROFRAME = 6
+    WINDOW_LOG2 = 5
+    # the audio clock is off by this much, and drifts away slowly
+    AUDIO_CLOCK_OFFSET_PPM = 1000
+    AUDIO_CLOCK_DRIFT_PPM_PER_MICROFRAME = 1
+    MICROFRAMES = 400
+    # the estimate is reset in the middle of these microframes, like after a sample rate change
+    RESET_MICROFRAMES = [0, 200]
+    # a microframe count is off by up to one tick, which is this much for a full window.
+    # Converged means within WINDOW_ERROR, the average error has to be below TOLERANCE
+    SAMPLES_PER_TICK = SAMPLES_PER_MICROFRAME / TICKS_PER_MICROFRAME
+    WINDOW_ERROR = SAMPLES_PER_TICK / 2**WINDOW_LOG2
+    TOLERANCE = 2**-10
+
+    dut = FeedbackValueCalculator(window_log2=WINDOW_LOG2, max_ticks_per_microframe=128)
+    scale = round(SAMPLES_PER_MICROFRAME / TICKS_PER_MICROFRAME * 2**dut.SCALE_FRACTIONAL_BITS)
+
+    def audio_clock_ppm(microframe):
+        return AUDIO_CLOCK_OFFSET_PPM + microframe * AUDIO_CLOCK_DRIFT_PPM_PER_MICROFRAME
+
+    def expected_value(microframe):
+        return SAMPLES_PER_MICROFRAME * (1 + audio_clock_ppm(microframe) * 1e-6)
+
+    def process():
+        yield dut.scale.eq(scale)
+        yield dut.nominal_value.eq(SAMPLES_PER_MICROFRAME << 16)
+
+        phase = 0.0
+        # (microframe of the reset, first estimate, microframe it converged at)
+        estimates = []
+        errors = []
+        for microframe in range(MICROFRAMES):
+            ticks_per_cycle = TICKS_PER_MICROFRAME * (1 + audio_clock_ppm(microframe) * 1e-6) / CYCLES_PER_MICROFRAME
+            for cycle in range(CYCLES_PER_MICROFRAME):
+                phase += ticks_per_cycle
+                yield dut.clock_tick.eq(int(phase) > 0)
+                phase -= int(phase)
+                yield dut.start_of_frame.eq(cycle == 0)
+                reset = (microframe in RESET_MICROFRAMES) and (cycle == CYCLES_PER_MICROFRAME // 2)
+                yield dut.reset_estimate.eq(reset)
+                yield
+
+                if reset:
+                    estimates.append([microframe, None, None])
+
+                if estimates and estimates[-1][1] is None and (yield dut.value_updated):
+                    estimates[-1][1] = (yield dut.feedback_value) / 2**16
+
+            value = (yield dut.feedback_value) / 2**16
+            error = value - expected_value(microframe)
+            # until the first complete microframe is measured, the nominal value is reported
+            if estimates[-1][1] is None:
+                assert value == SAMPLES_PER_MICROFRAME, \
+                    f"microframe {microframe}: {value} reported before the first estimate"
+
+            if estimates[-1][2] is None and abs(error) <= WINDOW_ERROR:
+                estimates[-1][2] = microframe
+            if estimates[-1][2] is not None and microframe >= estimates[-1][0] + 2**WINDOW_LOG2:
+                errors.append(error)
+
+        for reset_at, first_estimate, converged_at in estimates:
+            print(f"reset in microframe {reset_at}: first estimate {first_estimate}, "
+                  f"converged to within {WINDOW_ERROR:.6f} samples after {converged_at - reset_at} microframes")
+
+            # the first estimate is one complete microframe
+            assert first_estimate is not None, f"no estimate after the reset in microframe {reset_at}"
+            assert abs(first_estimate - expected_value(reset_at)) <= SAMPLES_PER_TICK, \
+                f"first estimate {first_estimate} after the reset in microframe {reset_at} is off by more than one tick"
+            # the window is full one microframe after the first complete one
+            assert converged_at is not None and converged_at - reset_at <= 2**WINDOW_LOG2 + 1, \
+                f"no convergence within a window after the reset in microframe {reset_at}"
+
+        mean  = sum(errors) / len(errors)
+        worst = max(abs(e) for e in errors)
+        print(f"steady state error: mean {mean:.6f}, max {worst:.6f} samples per microframe")
+        assert abs(mean) < TOLERANCE, f"steady state error has a bias of {mean}"
+        assert worst <= WINDOW_ERROR, f"steady state error {worst} is more than one tick per window"
+
+    sim = Simulator(dut)
+    sim.add_clock(1.0/60e6,)
+    sim.add_sync_process(process)
+
+    if args.vcd:
+        with sim.write_vcd(args.vcd):
+            sim.run()
+    else:
+        sim.run()
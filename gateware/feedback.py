@@ -0,0 +1,216 @@
+from amaranth       import *
+from amaranth.build import Platform
+
+class FeedbackValueCalculator(Elaboratable):
+    """ calculates the isochronous feedback value (samples per microframe, 16.16)
+        from the number of audio clock ticks in a sliding window of microframes.
+
+        The window is updated at every SOF, so the value follows the audio clock
+        continuously instead of once per window. After a reset, the ticks are only counted
+        from the next SOF on, so only complete microframes go into the window. The window then grows
+        in powers of two, so the first estimate is there after one complete microframe,
+        until then nominal_value is reported.
+        The estimate is kept with 8 more fractional bits than the 16.16 output,
+        the truncation error is carried over to the next output value,
+        so the average of the reported values has the full resolution.
+    """
+    FRACTIONAL_BITS       = 16
+    EXTRA_FRACTIONAL_BITS = 8
+    SCALE_FRACTIONAL_BITS = 32
+
+    def __init__(self, window_log2=7, max_ticks_per_microframe=2048, scale_width=32):
+        # parameters
+        self._window_log2 = window_log2
+        self._window      = 2**window_log2
+        self._count_bits  = Shape.cast(range(max_ticks_per_microframe)).width
+        self._scale_width = scale_width
+
+        # ports
+        self.start_of_frame   = Signal()
+        self.clock_tick       = Signal()
+        # samples per audio clock tick, with SCALE_FRACTIONAL_BITS fractional bits
+        self.scale            = Signal(scale_width)
+        # reported until the first measurement, eg. after a sample rate change
+        self.nominal_value    = Signal(32)
+        self.reset_estimate   = Signal()
+
+        self.feedback_value   = Signal(32)
+        # 16.24 estimate before the truncation to 16.16
+        self.fine_value       = Signal(32 + self.EXTRA_FRACTIONAL_BITS)
+        self.value_updated    = Signal()
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        window_log2 = self._window_log2
+        count_bits  = self._count_bits
+        sum_bits    = count_bits + window_log2
+
+        history = Memory(width=count_bits, depth=self._window, name="history")
+        m.submodules.history_read  = history_read  = history.read_port(transparent=False)
+        m.submodules.history_write = history_write = history.write_port()
+
+        tick_count     = Signal(count_bits)
+        window_sum     = Signal(sum_bits)
+        history_pos    = Signal(window_log2)
+        # number of microframes in the window, saturates at the window size
+        fill_level     = Signal(range(self._window + 1))
+        # the window length used for the estimate is 2**(window_log2 - window_shift),
+        # the sum is shifted up to the full window
+        window_shift   = Signal(range(window_log2 + 1))
+        window_full    = Signal()
+        # the ticks before the first SOF after a reset belong to a partial microframe
+        counting       = Signal()
+        have_estimate  = Signal()
+
+        calculate      = Signal()
+        product_valid  = Signal()
+        product        = Signal(sum_bits + self._scale_width)
+        rounding_error = Signal(self.EXTRA_FRACTIONAL_BITS)
+
+        # the oldest microframe count is at the write position
+        m.d.comb += [
+            window_full.eq(fill_level == self._window),
+            history_read.addr.eq(history_pos),
+            history_write.addr.eq(history_pos),
+            history_write.data.eq(tick_count),
+        ]
+
+        m.d.sync += [
+            calculate.eq(0),
+            product_valid.eq(0),
+            self.value_updated.eq(0),
+        ]
+
+        with m.If(~have_estimate):
+            m.d.sync += [
+                self.feedback_value.eq(self.nominal_value),
+                self.fine_value.eq(self.nominal_value << self.EXTRA_FRACTIONAL_BITS),
+            ]
+
+        with m.If(self.reset_estimate):
+            m.d.sync += [
+                counting.eq(0),
+                have_estimate.eq(0),
+                tick_count.eq(0),
+                window_sum.eq(0),
+                fill_level.eq(0),
+                window_shift.eq(window_log2),
+                rounding_error.eq(0),
+            ]
+
+        with m.Elif(self.start_of_frame & ~counting):
+            m.d.sync += [
+                counting.eq(1),
+                tick_count.eq(self.clock_tick),
+            ]
+
+        with m.Elif(self.start_of_frame):
+            m.d.comb += history_write.en.eq(1)
+
+            m.d.sync += [
+                tick_count.eq(self.clock_tick),
+                window_sum.eq(window_sum + tick_count - Mux(window_full, history_read.data, 0)),
+                history_pos.eq(history_pos + 1),
+            ]
+
+            with m.If(~window_full):
+                m.d.sync += fill_level.eq(fill_level + 1)
+
+            # while the window fills up, we only have an estimate,
+            # when the number of microframes is a power of two
+            with m.If(window_full):
+                m.d.sync += calculate.eq(1)
+            for i in range(window_log2 + 1):
+                with m.Elif(fill_level + 1 == 2**i):
+                    m.d.sync += [
+                        window_shift.eq(window_log2 - i),
+                        calculate.eq(1),
+                    ]
+
+        with m.Elif(self.clock_tick & counting):
+            m.d.sync += tick_count.eq(tick_count + 1)
+
+        # first pipeline stage: scale the window sum
+        with m.If(calculate):
+            m.d.sync += [
+                product.eq((window_sum << window_shift) * self.scale),
+                product_valid.eq(1),
+            ]
+
+        # second pipeline stage: (sum / window) * scale, with the extra fractional bits
+        fine_value = product >> (window_log2 + self.SCALE_FRACTIONAL_BITS
+                                 - self.FRACTIONAL_BITS - self.EXTRA_FRACTIONAL_BITS)
+        with m.If(product_valid & ~self.reset_estimate):
+            rounded = Signal.like(self.fine_value)
+            m.d.comb += rounded.eq(fine_value + rounding_error)
+            m.d.sync += [
+                self.fine_value.eq(fine_value),
+                self.feedback_value.eq(rounded >> self.EXTRA_FRACTIONAL_BITS),
+                rounding_error.eq(rounded[:self.EXTRA_FRACTIONAL_BITS]),
+                self.value_updated.eq(1),
+                have_estimate.eq(1),
+            ]
+
+        return m
+
+class BufferLevelFeedbackCorrection(Elaboratable):
+    """ adds a correction term to the measured feedback value,
+        which steers the fill level of the playback buffer towards a target level.
+
+        The buffer level is sampled at every SOF and low pass filtered,
+        the correction is proportional to the distance from the target level
+        and is limited to max_correction (16.16), so a buffer running dry
+        while the host is not streaming cannot pull the feedback value too far.
+    """
+    FILTER_SHIFT = 4
+
+    def __init__(self, level_width=16, gain_log2=7, max_correction=0x2000):
+        # parameters
+        self._level_width    = level_width
+        # correction per buffer entry, 16.16
+        self._gain_log2      = gain_log2
+        self._max_correction = max_correction
+
+        # ports
+        self.start_of_frame  = Signal()
+        self.enable          = Signal()
+        self.buffer_level    = Signal(level_width)
+        self.target_level    = Signal(level_width)
+        self.feedback_in     = Signal(32)
+
+        self.feedback_out    = Signal(32)
+        self.correction      = Signal(signed(32))
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        level_error     = Signal(signed(self._level_width + 1))
+        # FILTER_SHIFT fractional bits
+        filtered_error  = Signal(signed(self._level_width + 1 + self.FILTER_SHIFT))
+        correction      = Signal(signed(32))
+
+        m.d.comb += level_error.eq(self.target_level - self.buffer_level)
+
+        with m.If(~self.enable):
+            m.d.sync += filtered_error.eq(0)
+        with m.Elif(self.start_of_frame):
+            m.d.sync += filtered_error.eq(filtered_error
+                + (((level_error << self.FILTER_SHIFT) - filtered_error) >> self.FILTER_SHIFT))
+
+        shift = self._gain_log2 - self.FILTER_SHIFT
+        if shift >= 0:
+            m.d.comb += correction.eq(filtered_error << shift)
+        else:
+            m.d.comb += correction.eq(filtered_error >> -shift)
+
+        with m.If(correction > self._max_correction):
+            m.d.sync += self.correction.eq(self._max_correction)
+        with m.Elif(correction < -self._max_correction):
+            m.d.sync += self.correction.eq(-self._max_correction)
+        with m.Else():
+            m.d.sync += self.correction.eq(correction)
+
+        m.d.comb += self.feedback_out.eq(self.feedback_in + self.correction)
+
+        return m
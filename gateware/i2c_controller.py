@@ -0,0 +1,156 @@
+from amaranth       import *
+from amaranth.build import Platform
+
+from amlib.io.i2c   import I2CInitiator
+from amlib.stream   import StreamInterface
+
+class I2CController(Elaboratable):
+    """ I2C initiator which writes packets and reads single registers
+
+        stream_in takes the same packets as I2CStreamTransmitter:
+        the device address byte first, followed by the bytes to write, the last byte ends the transaction.
+        A register read is started when read_request is high and no packet is in progress,
+        so read_request is held until read_done. The read writes read_register to read_device and
+        reads one byte back after a repeated start. read_done strobes when read_data is valid,
+        read_ack is low if the device did not acknowledge.
+    """
+    def __init__(self, pads, period_cyc, clk_stretch=True):
+        # parameters
+        self._pads        = pads
+        self._period_cyc  = period_cyc
+        self._clk_stretch = clk_stretch
+
+        # ports
+        self.stream_in     = StreamInterface()
+
+        self.read_request  = Signal()
+        # address of the device in the write direction, eg. 0x30
+        self.read_device   = Signal(8)
+        self.read_register = Signal(8)
+        self.read_data     = Signal(8)
+        self.read_ack      = Signal()
+        self.read_done     = Signal()
+
+        self.busy          = Signal()
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        m.submodules.i2c = i2c = I2CInitiator(self._pads, self._period_cyc, self._clk_stretch)
+
+        device    = Signal(8)
+        register  = Signal(8)
+        last_byte = Signal()
+
+        m.d.sync += self.read_done.eq(0)
+
+        with m.FSM() as fsm:
+            m.d.comb += self.busy.eq(~fsm.ongoing("IDLE"))
+
+            with m.State("IDLE"):
+                with m.If(~i2c.busy):
+                    with m.If(self.stream_in.valid & self.stream_in.first):
+                        m.d.comb += i2c.start.eq(1)
+                        m.next = "WRITE"
+                    with m.Elif(self.stream_in.valid):
+                        # not the start of a packet, drop it
+                        m.d.comb += self.stream_in.ready.eq(1)
+                    with m.Elif(self.read_request):
+                        m.d.sync += [
+                            device.eq(self.read_device),
+                            register.eq(self.read_register),
+                            self.read_ack.eq(1),
+                        ]
+                        m.d.comb += i2c.start.eq(1)
+                        m.next = "READ_DEVICE"
+
+            #
+            # write packets, the acknowledge bits are ignored like in I2CStreamTransmitter
+            #
+            with m.State("WRITE"):
+                with m.If(~i2c.busy & self.stream_in.valid):
+                    m.d.comb += [
+                        i2c.data_i.eq(self.stream_in.payload),
+                        i2c.write.eq(1),
+                        self.stream_in.ready.eq(1),
+                    ]
+                    m.d.sync += last_byte.eq(self.stream_in.last)
+                    m.next = "WRITE_WAIT"
+
+            with m.State("WRITE_WAIT"):
+                with m.If(~i2c.busy):
+                    with m.If(last_byte):
+                        m.d.comb += i2c.stop.eq(1)
+                        m.next = "IDLE"
+                    with m.Else():
+                        m.next = "WRITE"
+
+            #
+            # register reads: device address, register, repeated start,
+            # device address for reading, one byte without acknowledge
+            #
+            with m.State("READ_DEVICE"):
+                with m.If(~i2c.busy):
+                    m.d.comb += [
+                        i2c.data_i.eq(device),
+                        i2c.write.eq(1),
+                    ]
+                    m.next = "READ_REGISTER"
+
+            with m.State("READ_REGISTER"):
+                with m.If(~i2c.busy):
+                    with m.If(~i2c.ack_o):
+                        m.next = "READ_FAILED"
+                    with m.Else():
+                        m.d.comb += [
+                            i2c.data_i.eq(register),
+                            i2c.write.eq(1),
+                        ]
+                        m.next = "READ_RESTART"
+
+            with m.State("READ_RESTART"):
+                with m.If(~i2c.busy):
+                    with m.If(~i2c.ack_o):
+                        m.next = "READ_FAILED"
+                    with m.Else():
+                        m.d.comb += i2c.start.eq(1)
+                        m.next = "READ_DEVICE_READ"
+
+            with m.State("READ_DEVICE_READ"):
+                with m.If(~i2c.busy):
+                    m.d.comb += [
+                        i2c.data_i.eq(device | 1),
+                        i2c.write.eq(1),
+                    ]
+                    m.next = "READ_DATA"
+
+            with m.State("READ_DATA"):
+                with m.If(~i2c.busy):
+                    with m.If(~i2c.ack_o):
+                        m.next = "READ_FAILED"
+                    with m.Else():
+                        m.d.comb += [
+                            i2c.ack_i.eq(0),
+                            i2c.read.eq(1),
+                        ]
+                        m.next = "READ_STOP"
+
+            with m.State("READ_STOP"):
+                with m.If(~i2c.busy):
+                    m.d.comb += i2c.stop.eq(1)
+                    m.d.sync += [
+                        self.read_data.eq(i2c.data_o),
+                        self.read_done.eq(1),
+                    ]
+                    m.next = "IDLE"
+
+            with m.State("READ_FAILED"):
+                with m.If(~i2c.busy):
+                    m.d.comb += i2c.stop.eq(1)
+                    m.d.sync += [
+                        self.read_ack.eq(0),
+                        self.read_done.eq(1),
+                    ]
+                    m.next = "IDLE"
+
+        return m
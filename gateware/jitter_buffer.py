@@ -0,0 +1,72 @@
+from amaranth          import *
+from amaranth.build    import Platform
+from amaranth.lib.fifo import SyncFIFOBuffered
+from amlib.stream      import StreamInterface
+
+class JitterBuffer(Elaboratable):
+    """ elastic block RAM sample buffer between the USB side and the serial audio transmitter
+
+        After a reset, a flush or when it ran empty, the buffer holds back its output
+        until it is filled up to target_level, so a late packet from the host
+        does not immediately cause an underflow in the DAC.
+    """
+    def __init__(self, depth, sample_width=24, nr_channels=2):
+        # parameters
+        self._depth        = depth
+        self._sample_width = sample_width
+        self._channel_bits = Shape.cast(range(nr_channels)).width
+
+        # ports
+        self.stream_in     = StreamInterface(name="jitter_buffer_in",  payload_width=sample_width, extra_fields=[("channel_no", self._channel_bits)])
+        self.stream_out    = StreamInterface(name="jitter_buffer_out", payload_width=sample_width, extra_fields=[("channel_no", self._channel_bits)])
+        self.target_level  = Signal(range(depth + 1))
+        self.flush         = Signal()
+
+        self.level         = Signal(range(depth + 1))
+        self.prefilling    = Signal(reset=1)
+        # strobes when the buffer runs empty after prefill
+        self.underrun      = Signal()
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        # an entry holds one sample, its first / last flags and its channel number
+        m.submodules.fifo = fifo = \
+            ResetInserter(self.flush)(SyncFIFOBuffered(width=self._sample_width + 2 + self._channel_bits, depth=self._depth))
+
+        sample_width = self._sample_width
+        m.d.comb += [
+            self.level.eq(fifo.level),
+
+            fifo.w_data.eq(Cat(self.stream_in.payload, self.stream_in.first, self.stream_in.last, self.stream_in.channel_no)),
+            fifo.w_en.eq(self.stream_in.valid),
+            self.stream_in.ready.eq(fifo.w_rdy),
+
+            self.stream_out.payload.eq(fifo.r_data[:sample_width]),
+            self.stream_out.first.eq(fifo.r_data[sample_width]),
+            self.stream_out.last.eq(fifo.r_data[sample_width + 1]),
+            self.stream_out.channel_no.eq(fifo.r_data[sample_width + 2:]),
+        ]
+
+        m.d.sync += self.underrun.eq(0)
+
+        with m.If(self.flush):
+            m.d.sync += self.prefilling.eq(1)
+
+        with m.Elif(self.prefilling):
+            with m.If(fifo.level >= self.target_level):
+                m.d.sync += self.prefilling.eq(0)
+
+        with m.Else():
+            m.d.comb += [
+                self.stream_out.valid.eq(fifo.r_rdy),
+                fifo.r_en.eq(self.stream_out.ready),
+            ]
+
+            with m.If(~fifo.r_rdy):
+                m.d.sync += [
+                    self.prefilling.eq(1),
+                    self.underrun.eq(1),
+                ]
+
+        return m
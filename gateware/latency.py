@@ -0,0 +1,133 @@
+from amaranth       import *
+from amaranth.build import Platform
+
+class LatencyProbe(Elaboratable):
+    """ measures how many cycles an item takes through a queue
+
+        When idle, the probe tags the item signalled by start and counts the cycles from there.
+        ahead is the number of items in the queue in front of the tagged one,
+        item_out strobes when an item leaves the queue. When the tagged item leaves,
+        the measured latency is output with latency_valid and the probe tags the next one.
+    """
+    def __init__(self, width=24, ahead_width=16):
+        # ports
+        self.start          = Signal()
+        self.ahead          = Signal(ahead_width)
+        self.item_out       = Signal()
+        # the queue dropped items, the measurement is discarded
+        self.abort          = Signal()
+
+        self.latency        = Signal(width)
+        self.latency_valid  = Signal()
+        self.busy           = Signal()
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        remaining = Signal.like(self.ahead)
+
+        m.d.sync += self.latency_valid.eq(0)
+
+        with m.If(self.abort):
+            m.d.sync += self.busy.eq(0)
+
+        with m.Elif(~self.busy):
+            with m.If(self.start):
+                m.d.sync += [
+                    self.busy.eq(1),
+                    self.latency.eq(0),
+                    remaining.eq(self.ahead),
+                ]
+
+        with m.Else():
+            # saturate, a lost item ends up in the last histogram bin
+            with m.If(self.latency != 2**len(self.latency) - 1):
+                m.d.sync += self.latency.eq(self.latency + 1)
+
+            with m.If(self.item_out):
+                m.d.sync += remaining.eq(remaining - 1)
+
+                with m.If(remaining == 0):
+                    m.d.sync += [
+                        self.busy.eq(0),
+                        self.latency_valid.eq(1),
+                    ]
+
+        return m
+
+
+class LatencyHistogram(Elaboratable):
+    """ block RAM histogram of measured latencies
+
+        Bin n counts the latencies from n * 2**bin_shift to (n + 1) * 2**bin_shift - 1 cycles,
+        the last bin also counts all longer latencies. The counters saturate.
+        clear sets all bins to zero, this takes one cycle per bin.
+    """
+    def __init__(self, nr_bins=256, bin_shift=6, latency_width=24, counter_width=32):
+        # parameters
+        self._nr_bins       = nr_bins
+        self._bin_shift     = bin_shift
+        self._counter_width = counter_width
+
+        # ports
+        self.latency        = Signal(latency_width)
+        self.latency_valid  = Signal()
+        self.clear          = Signal()
+
+        # host side read port
+        self.read_address   = Signal(range(nr_bins))
+        self.read_data      = Signal(counter_width)
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        nr_bins = self._nr_bins
+        bins = Memory(width=self._counter_width, depth=nr_bins)
+        m.submodules.bins_read  = bins_read  = bins.read_port(transparent=False)
+        m.submodules.bins_write = bins_write = bins.write_port()
+        m.submodules.host_read  = host_read  = bins.read_port(transparent=False)
+
+        m.d.comb += [
+            host_read.addr.eq(self.read_address),
+            self.read_data.eq(host_read.data),
+        ]
+
+        bin_no    = Signal(range(nr_bins))
+        max_count = 2**self._counter_width - 1
+
+        m.d.comb += bins_write.addr.eq(bin_no)
+
+        with m.FSM():
+            with m.State("IDLE"):
+                with m.If(self.clear):
+                    m.d.sync += bin_no.eq(0)
+                    m.next = "CLEAR"
+
+                with m.Elif(self.latency_valid):
+                    with m.If((self.latency >> self._bin_shift) >= nr_bins - 1):
+                        m.d.sync += bin_no.eq(nr_bins - 1)
+                    with m.Else():
+                        m.d.sync += bin_no.eq(self.latency >> self._bin_shift)
+                    m.next = "READ"
+
+            with m.State("READ"):
+                m.d.comb += bins_read.addr.eq(bin_no)
+                m.next = "INCREMENT"
+
+            with m.State("INCREMENT"):
+                m.d.comb += [
+                    bins_write.data.eq(bins_read.data + 1),
+                    bins_write.en.eq(bins_read.data != max_count),
+                ]
+                m.next = "IDLE"
+
+            with m.State("CLEAR"):
+                m.d.comb += [
+                    bins_write.data.eq(0),
+                    bins_write.en.eq(1),
+                ]
+                m.d.sync += bin_no.eq(bin_no + 1)
+                with m.If(bin_no == nr_bins - 1):
+                    m.next = "IDLE"
+
+        return m
@@ -0,0 +1,134 @@
+from amaranth       import *
+from amaranth.build import Platform
+from amlib.stream   import StreamInterface
+
+class Loopback(Elaboratable):
+    """ loopback modes to measure the round-trip latency, selected by the host at runtime
+
+        MODE_DIGITAL: the top level sends the samples from USB straight back to USB, bypassing the codec.
+        The host tool plays a marker and finds it in the recording.
+
+        MODE_ANALOG: the DAC stream is replaced by a marker pulse on the first channel every MARKER_PERIOD frames,
+        and the ADC samples of the first channel are searched for it, which needs a cable from the line out
+        to the line in. latency holds the number of frames from the marker entering the serial transmitter
+        until it was seen at the ADC. A marker which was not seen within its period counts as a timeout.
+
+        Setting the mode clears the measurements. read_data follows read_address after one cycle.
+    """
+    MODE_OFF     = 0
+    MODE_DIGITAL = 1
+    MODE_ANALOG  = 2
+
+    MARKER_PERIOD = 2**14
+    MARKER_LENGTH = 4
+
+    # register numbers, the host reads them with loopback-latency.py in the project root
+    REGISTERS = [
+        "mode",          # current loopback mode
+        "latency",       # frames from the last marker to its detection
+        "measurements",  # markers detected since the mode was set
+        "timeouts",      # markers not detected within MARKER_PERIOD frames
+    ]
+
+    def __init__(self, nr_channels=2, sample_width=24):
+        # parameters
+        self._sample_width = sample_width
+        self._channel_bits = Shape.cast(range(nr_channels)).width
+        # the marker is sent at half full scale and detected above -24dBFS,
+        # with either polarity, which leaves room for the gain settings of the codec
+        self._marker_level = 2**(sample_width - 2)
+        self._threshold    = 2**(sample_width - 5)
+
+        # ports
+        self.mode_in      = Signal(2)
+        self.set_mode     = Signal()
+        self.mode         = Signal(2)
+        self.digital      = Signal()
+
+        # the stream to the serial transmitter
+        self.stream_in    = StreamInterface(name="loopback_in", payload_width=sample_width,
+                                            extra_fields=[("channel_no", self._channel_bits)])
+        self.stream_out   = StreamInterface(name="loopback_out", payload_width=sample_width,
+                                            extra_fields=[("channel_no", self._channel_bits)])
+        # only valid, payload and channel_no are used
+        self.adc_in       = StreamInterface(name="loopback_adc_in", payload_width=sample_width,
+                                            extra_fields=[("channel_no", self._channel_bits)])
+
+        self.read_address = Signal(range(len(self.REGISTERS)))
+        self.read_data    = Signal(32)
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        registers = { name: Signal(32, name=name) for name in self.REGISTERS }
+        analog    = Signal()
+
+        frame_no    = Signal(range(self.MARKER_PERIOD))
+        elapsed     = Signal(range(self.MARKER_PERIOD))
+        marker_left = Signal(range(self.MARKER_LENGTH + 1))
+        waiting     = Signal()
+        adc_frame   = Signal()
+        detected    = Signal()
+
+        adc_sample  = Signal(signed(self._sample_width))
+
+        m.d.comb += [
+            self.digital.eq(self.mode == self.MODE_DIGITAL),
+            analog.eq(self.mode == self.MODE_ANALOG),
+            registers["mode"].eq(self.mode),
+
+            self.stream_out.stream_eq(self.stream_in),
+            self.stream_out.channel_no.eq(self.stream_in.channel_no),
+
+            adc_sample.eq(self.adc_in.payload),
+            adc_frame.eq(self.adc_in.valid & (self.adc_in.channel_no == 0)),
+            detected.eq((adc_sample >= self._threshold) | (adc_sample <= -self._threshold)),
+        ]
+
+        # the marker replaces the playback and the direct monitoring
+        with m.If(analog):
+            m.d.comb += self.stream_out.payload.eq(
+                Mux((self.stream_in.channel_no == 0) & (marker_left != 0), self._marker_level, 0))
+
+        with m.If(self.stream_out.valid & self.stream_out.ready &
+                  (self.stream_in.channel_no == 0) & (marker_left != 0)):
+            m.d.sync += marker_left.eq(marker_left - 1)
+
+        # frames are counted at the ADC, which paces the DAC stream
+        with m.If(self.set_mode):
+            m.d.sync += [
+                self.mode.eq(self.mode_in),
+                registers["latency"].eq(0),
+                registers["measurements"].eq(0),
+                registers["timeouts"].eq(0),
+                frame_no.eq(0),
+                marker_left.eq(0),
+                waiting.eq(0),
+            ]
+
+        with m.Elif(analog & adc_frame):
+            m.d.sync += [
+                frame_no.eq(frame_no + 1),
+                elapsed.eq(elapsed + 1),
+            ]
+
+            with m.If(waiting & detected):
+                m.d.sync += [
+                    waiting.eq(0),
+                    registers["latency"].eq(elapsed + 1),
+                    registers["measurements"].eq(registers["measurements"] + 1),
+                ]
+
+            # send the next marker, it goes out with the DAC samples of this frame
+            with m.If(frame_no == 0):
+                m.d.sync += [
+                    marker_left.eq(self.MARKER_LENGTH),
+                    waiting.eq(1),
+                    elapsed.eq(0),
+                ]
+                with m.If(waiting & ~detected):
+                    m.d.sync += registers["timeouts"].eq(registers["timeouts"] + 1)
+
+        m.d.sync += self.read_data.eq(Array(registers[name] for name in self.REGISTERS)[self.read_address])
+
+        return m
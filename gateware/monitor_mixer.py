@@ -0,0 +1,119 @@
+from amaranth       import *
+from amaranth.build import Platform
+from amlib.stream   import StreamInterface
+
+class MonitorMixer(Elaboratable):
+    """ zero latency direct monitoring: mixes the ADC samples into the DAC stream
+
+        Each ADC sample, scaled with the monitor gain of its channel, is added to the
+        playback sample of the same channel, so the input reaches the DAC within one audio frame.
+        The output is paced by the ADC, which runs from the same clock as the DAC:
+        when the jitter buffer has no playback sample for the channel (no playback or an underrun),
+        the ADC sample goes out alone. The mixer only listens to the ADC stream, it never stalls it.
+        Without ADC samples there is no output at all, so the playback stops when the ADC stream does.
+
+        The gains are unsigned 1.15 fixed point, UNITY_GAIN is 0dB
+        and 0 (the default) switches the monitoring of a channel off.
+    """
+    GAIN_WIDTH = 16
+    UNITY_GAIN = 0x8000
+
+    def __init__(self, nr_channels=2, sample_width=24):
+        # parameters
+        self._nr_channels  = nr_channels
+        self._sample_width = sample_width
+        self._channel_bits = Shape.cast(range(nr_channels)).width
+
+        # ports
+        self.playback_in      = StreamInterface(name="monitor_mixer_playback_in", payload_width=sample_width,
+                                                extra_fields=[("channel_no", self._channel_bits)])
+        # only valid, payload and channel_no are used
+        self.monitor_in       = StreamInterface(name="monitor_mixer_monitor_in", payload_width=sample_width,
+                                                extra_fields=[("channel_no", self._channel_bits)])
+        self.stream_out       = StreamInterface(name="monitor_mixer_out", payload_width=sample_width,
+                                                extra_fields=[("channel_no", self._channel_bits)])
+
+        self.gain_channel     = Signal(self._channel_bits)
+        self.gain_value       = Signal(self.GAIN_WIDTH)
+        self.gain_write       = Signal()
+
+        # read port of the gains, the data follows the address after one cycle
+        self.read_address     = Signal(8)
+        self.read_data        = Signal(32)
+
+        # strobes when an ADC sample went out without a playback sample
+        self.playback_missing = Signal()
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        sample_width = self._sample_width
+        max_sample   =  2**(sample_width - 1) - 1
+        min_sample   = -2**(sample_width - 1)
+
+        gains = Array(Signal(self.GAIN_WIDTH, name=f"gain_{channel}") for channel in range(self._nr_channels))
+
+        with m.If(self.gain_write & (self.gain_channel < self._nr_channels)):
+            m.d.sync += gains[self.gain_channel].eq(self.gain_value)
+
+        with m.If(self.read_address < self._nr_channels):
+            m.d.sync += self.read_data.eq(gains[self.read_address])
+        with m.Else():
+            m.d.sync += self.read_data.eq(0)
+
+        channel   = Signal(self._channel_bits)
+        sample    = Signal(signed(sample_width))
+        gain      = Signal(self.GAIN_WIDTH)
+        product   = Signal(signed(sample_width + self.GAIN_WIDTH + 1))
+        playback  = Signal(signed(sample_width))
+        mix       = Signal(signed(sample_width + 2))
+
+        m.d.sync += self.playback_missing.eq(0)
+        m.d.comb += [
+            mix.eq(playback + (product >> (self.GAIN_WIDTH - 1))),
+            self.stream_out.channel_no.eq(channel),
+            self.stream_out.first.eq(channel == 0),
+            self.stream_out.last.eq(channel == self._nr_channels - 1),
+        ]
+
+        with m.FSM():
+            with m.State("IDLE"):
+                with m.If(self.monitor_in.valid):
+                    m.d.sync += [
+                        channel.eq(self.monitor_in.channel_no),
+                        sample.eq(self.monitor_in.payload),
+                        gain.eq(gains[self.monitor_in.channel_no]),
+                    ]
+                    m.next = "MULTIPLY"
+
+            with m.State("MULTIPLY"):
+                m.d.sync += product.eq(sample * gain)
+
+                # take the playback sample of this channel, if there is one
+                with m.If(self.playback_in.valid & (self.playback_in.channel_no == channel)):
+                    m.d.comb += self.playback_in.ready.eq(1)
+                    m.d.sync += playback.eq(self.playback_in.payload)
+                with m.Else():
+                    m.d.sync += [
+                        playback.eq(0),
+                        self.playback_missing.eq(1),
+                    ]
+
+                m.next = "MIX"
+
+            with m.State("MIX"):
+                with m.If(mix > max_sample):
+                    m.d.sync += self.stream_out.payload.eq(max_sample)
+                with m.Elif(mix < min_sample):
+                    m.d.sync += self.stream_out.payload.eq(min_sample)
+                with m.Else():
+                    m.d.sync += self.stream_out.payload.eq(mix)
+
+                m.next = "SEND"
+
+            with m.State("SEND"):
+                m.d.comb += self.stream_out.valid.eq(1)
+                with m.If(self.stream_out.ready):
+                    m.next = "IDLE"
+
+        return m
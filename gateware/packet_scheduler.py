@@ -0,0 +1,79 @@
+from amaranth       import *
+from amaranth.build import Platform
+
+class AudioFramesScheduler(Elaboratable):
+    """ decides how many audio frames go into each isochronous IN packet
+
+        A phase accumulator adds the (fractional, 16.16) number of samples per
+        microframe at each SOF, the integer part is sent. At 44.1kHz this gives
+        5 and 6 frame packets in the exact ratio of 5.5125 frames per microframe,
+        and the total number of frames sent never is more than one frame away from the ideal.
+        A packet never contains more frames than are available,
+        the missing frames are sent in the next packets.
+
+        frames_in_packet is set at an SOF and is the size of the packet which is handed
+        to the IN endpoint at the next SOF, so the endpoint and ChannelsToUSBStream both
+        take the same value in the SOF cycle. The frames of the packet handed over
+        in that cycle are still counted in frames_available, they are not scheduled again.
+    """
+    FRACTIONAL_BITS = 16
+
+    def __init__(self, max_frames_per_microframe):
+        # parameters
+        self._max_frames = max_frames_per_microframe
+
+        # ports
+        self.start_of_frame             = Signal()
+        # 16.16, eg. the measured feedback value
+        self.samples_per_microframe     = Signal(32)
+        # complete audio frames which can go into the next packet
+        self.frames_available           = Signal(16)
+        self.reset_schedule             = Signal()
+
+        self.frames_in_packet           = Signal(range(max_frames_per_microframe + 1))
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        max_frames = self._max_frames
+
+        # the accumulator holds the frames owed to the host, with fractional bits
+        accumulator = Signal(Shape.cast(range(2 * max_frames + 1)).width + self.FRACTIONAL_BITS)
+        owed        = Signal.like(accumulator)
+        wanted      = Signal(range(2 * max_frames + 1))
+        frames      = Signal(range(max_frames + 1))
+        available   = Signal.like(self.frames_available)
+
+        m.d.comb += [
+            available.eq(Mux(self.frames_available > self.frames_in_packet,
+                             self.frames_available - self.frames_in_packet, 0)),
+            owed.eq(accumulator + self.samples_per_microframe),
+            wanted.eq(owed >> self.FRACTIONAL_BITS),
+        ]
+
+        # send what is owed, but never more than is available
+        # and never more than fits into a packet
+        with m.If((wanted > available) & (available <= max_frames)):
+            m.d.comb += frames.eq(available)
+        with m.Elif(wanted > max_frames):
+            m.d.comb += frames.eq(max_frames)
+        with m.Else():
+            m.d.comb += frames.eq(wanted)
+
+        with m.If(self.reset_schedule):
+            m.d.sync += [
+                accumulator.eq(0),
+                self.frames_in_packet.eq(0),
+            ]
+
+        with m.Elif(self.start_of_frame):
+            m.d.sync += self.frames_in_packet.eq(frames)
+
+            # when no frames come in, eg. when the ADC is not running,
+            # do not let the debt grow without bounds
+            with m.If((owed - (frames << self.FRACTIONAL_BITS)) < (2 << self.FRACTIONAL_BITS)):
+                m.d.sync += accumulator.eq(owed - (frames << self.FRACTIONAL_BITS))
+            with m.Else():
+                m.d.sync += accumulator.eq(owed[:self.FRACTIONAL_BITS] | (1 << self.FRACTIONAL_BITS))
+
+        return m
@@ -0,0 +1,92 @@
+from math           import log2
+
+from amaranth       import *
+from amaranth.build import Platform
+from amlib.stream   import StreamInterface
+
+class PlaybackVolume(Elaboratable):
+    """ applies the playback volume and mute of the UAC2 feature unit to a channel stream
+
+        The volume of each channel is looked up in a ROM of linear gains in unsigned 1.16 fixed point,
+        so at 0dB (the default) and unmuted the samples are passed through bit for bit.
+        After a sample left, the next one goes out two cycles later.
+    """
+    # range of the playback volume in 1/256 dB, as announced by the feature unit
+    VOLUME_MIN        = -96 * 256
+    VOLUME_MAX        = 0
+    VOLUME_RESOLUTION = 128
+    # the linear volume is unsigned 1.16 fixed point, so 0dB is exact
+    VOLUME_GAIN_WIDTH = 17
+
+    def __init__(self, nr_channels=2, sample_width=24):
+        # parameters
+        self._nr_channels  = nr_channels
+        self._sample_width = sample_width
+        self._channel_bits = Shape.cast(range(nr_channels)).width
+
+        # ports
+        self.stream_in  = StreamInterface(name="playback_volume_in", payload_width=sample_width,
+                                          extra_fields=[("channel_no", self._channel_bits)])
+        self.stream_out = StreamInterface(name="playback_volume_out", payload_width=sample_width,
+                                          extra_fields=[("channel_no", self._channel_bits)])
+
+        # volume (VOLUME_MIN to VOLUME_MAX) and mute of each channel
+        self.volume     = [Signal(signed(16), name=f"volume_{channel}") for channel in range(nr_channels)]
+        self.mute       = Signal(nr_channels)
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        sample_width = self._sample_width
+
+        # linear gain for each volume step, from VOLUME_MAX down to VOLUME_MIN
+        resolution_bits = int(log2(self.VOLUME_RESOLUTION))
+        assert 2**resolution_bits == self.VOLUME_RESOLUTION
+        nr_steps   = (self.VOLUME_MAX - self.VOLUME_MIN) // self.VOLUME_RESOLUTION + 1
+        unity      = 2**(self.VOLUME_GAIN_WIDTH - 1)
+        volume_rom = Memory(width=self.VOLUME_GAIN_WIDTH, depth=nr_steps,
+                            init=[round(unity * 10**((self.VOLUME_MAX - step * self.VOLUME_RESOLUTION) / 256 / 20))
+                                  for step in range(nr_steps)])
+        m.submodules.volume_read = volume_read = volume_rom.read_port()
+
+        volume  = Array(self.volume)
+        channel = Signal(self._channel_bits)
+        first   = Signal()
+        last    = Signal()
+        sample  = Signal(signed(sample_width))
+        gain    = Signal(self.VOLUME_GAIN_WIDTH)
+        product = Signal(signed(sample_width + self.VOLUME_GAIN_WIDTH + 1))
+
+        m.d.comb += [
+            # the gain of the incoming sample is read while it is taken
+            volume_read.addr.eq((self.VOLUME_MAX - volume[self.stream_in.channel_no]) >> resolution_bits),
+            gain.eq(Mux(self.mute.bit_select(channel, 1), 0, volume_read.data)),
+
+            self.stream_out.payload.eq(product >> (self.VOLUME_GAIN_WIDTH - 1)),
+            self.stream_out.channel_no.eq(channel),
+            self.stream_out.first.eq(first),
+            self.stream_out.last.eq(last),
+        ]
+
+        with m.FSM():
+            with m.State("IDLE"):
+                m.d.comb += self.stream_in.ready.eq(1)
+                with m.If(self.stream_in.valid):
+                    m.d.sync += [
+                        channel.eq(self.stream_in.channel_no),
+                        first.eq(self.stream_in.first),
+                        last.eq(self.stream_in.last),
+                        sample.eq(self.stream_in.payload),
+                    ]
+                    m.next = "MULTIPLY"
+
+            with m.State("MULTIPLY"):
+                m.d.sync += product.eq(sample * gain)
+                m.next = "SEND"
+
+            with m.State("SEND"):
+                m.d.comb += self.stream_out.valid.eq(1)
+                with m.If(self.stream_out.ready):
+                    m.next = "IDLE"
+
+        return m
@@ -3,28 +3,82 @@ from luna.gateware.usb.usb2.request   import USBRequestHandler
 from luna.gateware.stream.generator   import StreamSerializer
 
 from usb_protocol.types                       import USBRequestType, USBRequestRecipient, USBTransferType, USBSynchronizationType, USBUsageType, USBDirection, USBStandardRequests
-from usb_protocol.types.descriptors.uac2      import AudioClassSpecificRequestCodes
+from usb_protocol.types.descriptors.uac2      import AudioClassSpecificRequestCodes, FeatureUnitControlSelectors
 from luna.gateware.usb.stream                 import USBInStreamInterface
 
 class UAC2RequestHandlers(USBRequestHandler):
-    """ request handlers to implement UAC2 functionality. """
-    def __init__(self):
+    """ request handlers to implement UAC2 functionality.
+
+        The feature unit has a volume and a mute control for each channel, but no master controls.
+        Volumes are in 1/256 dB, volume_range is (MIN, MAX, RES) of the volume control.
+    """
+    FEATURE_UNIT_ID = 6
+
+    def __init__(self, sample_rates=[48000], default_sample_rate=48000, nr_channels=2, volume_range=(-96 * 256, 0, 128)):
         super().__init__()
 
+        assert default_sample_rate in sample_rates
+        self._sample_rates = sorted(sample_rates)
+        self._nr_channels  = nr_channels
+        self._volume_range = volume_range
+
         self.output_interface_altsetting_nr = Signal(3)
         self.input_interface_altsetting_nr  = Signal(3)
         self.interface_settings_changed     = Signal()
 
+        # index into sample_rates of the currently selected sample rate
+        self.sample_rate_index              = Signal(range(len(self._sample_rates)),
+                                                     reset=self._sample_rates.index(default_sample_rate))
+        self.sample_rate_changed            = Signal()
+
+        # feature unit controls, volume[0] and mute[0] belong to channel 1
+        self.volume                         = [Signal(signed(16), name=f"volume_{channel}") for channel in range(nr_channels)]
+        self.mute                           = Signal(nr_channels)
+
     def elaborate(self, platform):
         m = Module()
 
         interface         = self.interface
         setup             = self.interface.setup
 
+        sample_rates      = self._sample_rates
+        volume_min, volume_max, volume_resolution = self._volume_range
+
+        # two bytes wNumSubRanges followed by (MIN, MAX, RES) for each sample rate
+        range_length      = 2 + 3 * 4 * len(sample_rates)
+
         m.submodules.transmitter = transmitter = \
-            StreamSerializer(data_length=14, domain="usb", stream_type=USBInStreamInterface, max_length_width=14)
+            StreamSerializer(data_length=range_length, domain="usb", stream_type=USBInStreamInterface, max_length_width=14)
+
+        current_sample_rate = Signal(32)
+        m.d.comb += current_sample_rate.eq(Array(Const(rate, 32) for rate in sample_rates)[self.sample_rate_index])
+
+        # feature unit requests: wIndex is the unit ID, the high byte of wValue the control and the low byte the channel
+        volume            = Array(self.volume)
+        channel_index     = Signal(8)
+        request_feature   = (setup.index == (self.FEATURE_UNIT_ID << 8)) & \
+                            (setup.value[0:8] >= 1) & (setup.value[0:8] <= self._nr_channels)
+        request_volume    = request_feature & (setup.value[8:16] == FeatureUnitControlSelectors.FU_VOLUME_CONTROL)
+        request_mute      = request_feature & (setup.value[8:16] == FeatureUnitControlSelectors.FU_MUTE_CONTROL)
+        m.d.comb += channel_index.eq(setup.value[0:8] - 1)
 
-        m.d.usb += self.interface_settings_changed.eq(0)
+        # receive buffer for the data sent by SET CUR
+        rx_data           = Signal(32)
+        rx_byte_counter   = Signal(3)
+        rx_volume         = Signal(signed(16))
+        rx_rate_supported = Signal()
+        m.d.comb += [
+            rx_volume.eq(rx_data[0:16]),
+            rx_rate_supported.eq(Cat(rx_data == rate for rate in sample_rates).any()),
+        ]
+
+        with m.If(setup.received):
+            m.d.usb += rx_byte_counter.eq(0)
+
+        m.d.usb += [
+            self.interface_settings_changed.eq(0),
+            self.sample_rate_changed.eq(0),
+        ]
 
         #
         # Class request handlers.
@@ -65,12 +119,22 @@ class UAC2RequestHandlers(USBRequestHandler):
                     with m.If(request_clock_freq):
                         m.d.comb += [
                             Cat(transmitter.data).eq(
-                                Cat(Const(0x1, 16), # no triples
-                                    Const(48000, 32), # MIN
-                                    Const(48000, 32), # MAX
-                                    Const(0, 32))),   # RES
+                                Cat(Const(len(sample_rates), 16), # number of triples
+                                    *[Cat(Const(rate, 32), # MIN
+                                          Const(rate, 32), # MAX
+                                          Const(0, 32))    # RES
+                                      for rate in sample_rates])),
                             transmitter.max_length.eq(setup.length)
                         ]
+                    with m.Elif(request_volume):
+                        m.d.comb += [
+                            Cat(transmitter.data[0:8]).eq(
+                                Cat(Const(1, 16),                  # one subrange
+                                    Const(volume_min, 16),         # MIN
+                                    Const(volume_max, 16),         # MAX
+                                    Const(volume_resolution, 16))), # RES
+                            transmitter.max_length.eq(Mux(setup.length > 8, 8, setup.length))
+                        ]
                     with m.Else():
                         m.d.comb += interface.handshakes_out.stall.eq(1)
 
@@ -83,23 +147,264 @@ class UAC2RequestHandlers(USBRequestHandler):
                         m.d.comb += interface.handshakes_out.ack.eq(1)
 
                 with m.Case(AudioClassSpecificRequestCodes.CUR):
-                    m.d.comb += transmitter.stream.attach(self.interface.tx)
-                    with m.If(request_clock_freq & (setup.length == 4)):
-                        m.d.comb += [
-                            Cat(transmitter.data[0:4]).eq(Const(48000, 32)),
-                            transmitter.max_length.eq(4)
-                        ]
+                    with m.If(setup.is_in_request):
+                        m.d.comb += transmitter.stream.attach(self.interface.tx)
+                        with m.If(request_clock_freq & (setup.length == 4)):
+                            m.d.comb += [
+                                Cat(transmitter.data[0:4]).eq(current_sample_rate),
+                                transmitter.max_length.eq(4)
+                            ]
+                        with m.Elif(request_volume & (setup.length == 2)):
+                            m.d.comb += [
+                                Cat(transmitter.data[0:2]).eq(volume[channel_index]),
+                                transmitter.max_length.eq(2)
+                            ]
+                        with m.Elif(request_mute & (setup.length == 1)):
+                            m.d.comb += [
+                                transmitter.data[0].eq(self.mute.bit_select(channel_index, 1)),
+                                transmitter.max_length.eq(1)
+                            ]
+                        with m.Else():
+                            m.d.comb += interface.handshakes_out.stall.eq(1)
+
+                        # ... trigger it to respond when data's requested...
+                        with m.If(interface.data_requested):
+                            m.d.comb += transmitter.start.eq(1)
+
+                        # ... and ACK our status stage.
+                        with m.If(interface.status_requested):
+                            m.d.comb += interface.handshakes_out.ack.eq(1)
+
+                    # SET CUR: the host selects a new sample rate, volume or mute
                     with m.Else():
+                        with m.If((request_clock_freq & (setup.length == 4)) |
+                                  (request_volume     & (setup.length == 2)) |
+                                  (request_mute       & (setup.length == 1))):
+                            # collect the little endian bytes of the value...
+                            with m.If(interface.rx.valid & interface.rx.next & (rx_byte_counter < 4)):
+                                m.d.usb += [
+                                    rx_data.word_select(rx_byte_counter[0:2], 8).eq(interface.rx.payload),
+                                    rx_byte_counter.eq(rx_byte_counter + 1),
+                                ]
+
+                            # ... ACK the data out...
+                            with m.If(interface.rx_ready_for_response):
+                                m.d.comb += interface.handshakes_out.ack.eq(1)
+
+                            # ... stall a sample rate we do not support, so the host knows it was not set...
+                            with m.If(interface.status_requested & request_clock_freq & ~rx_rate_supported):
+                                m.d.comb += interface.handshakes_out.stall.eq(1)
+
+                            with m.Elif(interface.status_requested):
+                                m.d.comb += self.send_zlp()
+
+                                # ... and switch to the new sample rate...
+                                with m.If(request_clock_freq):
+                                    for index, rate in enumerate(sample_rates):
+                                        with m.If(rx_data == rate):
+                                            m.d.usb += [
+                                                self.sample_rate_index.eq(index),
+                                                self.sample_rate_changed.eq(1),
+                                            ]
+
+                                # ... or set the volume, limited to our range...
+                                with m.If(request_volume):
+                                    with m.If(rx_volume > volume_max):
+                                        m.d.usb += volume[channel_index].eq(volume_max)
+                                    with m.Elif(rx_volume < volume_min):
+                                        m.d.usb += volume[channel_index].eq(volume_min)
+                                    with m.Else():
+                                        m.d.usb += volume[channel_index].eq(rx_volume)
+
+                                # ... or mute the channel.
+                                with m.If(request_mute):
+                                    m.d.usb += self.mute.bit_select(channel_index, 1).eq(rx_data[0])
+                        with m.Else():
+                            with m.If(interface.status_requested | interface.data_requested):
+                                m.d.comb += interface.handshakes_out.stall.eq(1)
+
+                with m.Case():
+                    #
+                    # Stall unhandled requests.
+                    #
+                    with m.If(interface.status_requested | interface.data_requested):
                         m.d.comb += interface.handshakes_out.stall.eq(1)
 
-                    # ... trigger it to respond when data's requested...
-                    with m.If(interface.data_requested):
-                        m.d.comb += transmitter.start.eq(1)
+                return m
 
-                    # ... and ACK our status stage.
+
+class VendorRequestHandlers(USBRequestHandler):
+    """ vendor requests to read our instrumentation, to set up direct monitoring,
+        to write codec registers and to select the loopback mode from the host
+
+        IN data stages are limited to one packet of 64 bytes,
+        longer requests are stalled, the host reads in chunks.
+    """
+    # IN, wValue: histogram (0: playback, 1: record), wIndex: first bin,
+    # returns the bin counters as 32 bit little endian words
+    REQUEST_READ_HISTOGRAM   = 0x01
+    # OUT without data stage, clears all histograms
+    REQUEST_CLEAR_HISTOGRAMS = 0x02
+    # IN, wIndex: first register, returns the telemetry registers as 32 bit little endian words
+    REQUEST_READ_TELEMETRY   = 0x03
+    # OUT without data stage, clears the telemetry counters and high-water marks
+    REQUEST_CLEAR_TELEMETRY  = 0x04
+    # OUT without data stage, wValue: gain (1.15 fixed point, 0x8000 is 0dB), wIndex: channel,
+    # sets the gain of the direct monitoring of an input channel
+    REQUEST_SET_MONITOR_GAIN   = 0x05
+    # IN, wIndex: first channel, returns the direct monitoring gains as 32 bit little endian words
+    REQUEST_READ_MONITOR_GAINS = 0x06
+    # OUT without data stage, wValue: codec page << 8 | register, wIndex: value,
+    # queues a codec register write, stalls when the queue is full
+    REQUEST_WRITE_CODEC        = 0x07
+    # OUT without data stage, wValue: loopback mode (0: off, 1: digital, 2: analog)
+    REQUEST_SET_LOOPBACK       = 0x08
+    # IN, wIndex: first register, returns the loopback registers as 32 bit little endian words
+    REQUEST_READ_LOOPBACK      = 0x09
+
+    MAX_PACKET_SIZE = 64
+
+    def __init__(self, nr_histogram_bins=512):
+        super().__init__()
+
+        # read port of the histograms and the telemetry registers,
+        # the data follows the address after one cycle
+        self.read_address      = Signal(range(max(nr_histogram_bins, 256)))
+        self.histogram_select  = Signal()
+        self.histogram_data    = Signal(32)
+        self.telemetry_data    = Signal(32)
+        self.monitor_gain_data = Signal(32)
+        self.loopback_data     = Signal(32)
+
+        self.clear_histograms  = Signal()
+        self.clear_telemetry   = Signal()
+
+        self.monitor_gain_channel = Signal(8)
+        self.monitor_gain_value   = Signal(16)
+        self.set_monitor_gain     = Signal()
+
+        # (page, register, value) of a codec register write
+        self.codec_command        = Signal(24)
+        self.write_codec_command  = Signal()
+        self.codec_queue_ready    = Signal()
+
+        self.loopback_mode        = Signal(2)
+        self.set_loopback         = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        interface  = self.interface
+        setup      = self.interface.setup
+        tx         = self.interface.tx
+
+        word_no    = Signal.like(self.read_address)
+        read_byte  = Signal(2)
+        bytes_left = Signal(range(self.MAX_PACKET_SIZE + 1))
+        advance    = Signal()
+        sending    = Signal()
+        first_byte = Signal()
+
+        read_data  = Signal(32)
+
+        m.d.usb += [
+            self.clear_histograms.eq(0),
+            self.clear_telemetry.eq(0),
+            self.set_monitor_gain.eq(0),
+            self.write_codec_command.eq(0),
+            self.set_loopback.eq(0),
+        ]
+        m.d.comb += [
+            self.histogram_select.eq(setup.value[0]),
+            self.monitor_gain_channel.eq(setup.index),
+            self.monitor_gain_value.eq(setup.value),
+            self.codec_command.eq(Cat(setup.index[0:8], setup.value)),
+            self.loopback_mode.eq(setup.value),
+            advance.eq(tx.ready & (read_byte == 3)),
+            # fetch the next word while the last byte of the current one goes out
+            self.read_address.eq(Mux(sending, Mux(advance, word_no + 1, word_no), setup.index)),
+        ]
+
+        with m.Switch(setup.request):
+            with m.Case(self.REQUEST_READ_TELEMETRY):
+                m.d.comb += read_data.eq(self.telemetry_data)
+            with m.Case(self.REQUEST_READ_MONITOR_GAINS):
+                m.d.comb += read_data.eq(self.monitor_gain_data)
+            with m.Case(self.REQUEST_READ_LOOPBACK):
+                m.d.comb += read_data.eq(self.loopback_data)
+            with m.Case():
+                m.d.comb += read_data.eq(self.histogram_data)
+
+        with m.If(sending):
+            m.d.comb += [
+                tx.valid.eq(1),
+                tx.payload.eq(read_data.word_select(read_byte, 8)),
+                tx.first.eq(first_byte),
+                tx.last.eq(bytes_left == 1),
+            ]
+
+            with m.If(tx.ready):
+                m.d.usb += [
+                    read_byte.eq(read_byte + 1),
+                    bytes_left.eq(bytes_left - 1),
+                    first_byte.eq(0),
+                ]
+                with m.If(advance):
+                    m.d.usb += word_no.eq(word_no + 1)
+                with m.If(bytes_left == 1):
+                    m.d.usb += sending.eq(0)
+
+        with m.If(setup.type == USBRequestType.VENDOR):
+            with m.Switch(setup.request):
+                with m.Case(self.REQUEST_READ_HISTOGRAM, self.REQUEST_READ_TELEMETRY, self.REQUEST_READ_MONITOR_GAINS,
+                            self.REQUEST_READ_LOOPBACK):
+                    # the first word is fetched during the setup stage
+                    with m.If(interface.data_requested & ~sending):
+                        with m.If(setup.length == 0):
+                            m.d.comb += self.send_zlp()
+                        with m.Elif(setup.length > self.MAX_PACKET_SIZE):
+                            m.d.comb += interface.handshakes_out.stall.eq(1)
+                        with m.Else():
+                            m.d.usb += [
+                                sending.eq(1),
+                                first_byte.eq(1),
+                                word_no.eq(setup.index),
+                                read_byte.eq(0),
+                                bytes_left.eq(setup.length),
+                            ]
+
+                    # ACK our status stage
                     with m.If(interface.status_requested):
                         m.d.comb += interface.handshakes_out.ack.eq(1)
 
+                with m.Case(self.REQUEST_CLEAR_HISTOGRAMS):
+                    with m.If(interface.status_requested):
+                        m.d.comb += self.send_zlp()
+                        m.d.usb += self.clear_histograms.eq(1)
+
+                with m.Case(self.REQUEST_CLEAR_TELEMETRY):
+                    with m.If(interface.status_requested):
+                        m.d.comb += self.send_zlp()
+                        m.d.usb += self.clear_telemetry.eq(1)
+
+                with m.Case(self.REQUEST_SET_MONITOR_GAIN):
+                    with m.If(interface.status_requested):
+                        m.d.comb += self.send_zlp()
+                        m.d.usb += self.set_monitor_gain.eq(1)
+
+                with m.Case(self.REQUEST_WRITE_CODEC):
+                    with m.If(interface.status_requested):
+                        with m.If(self.codec_queue_ready):
+                            m.d.comb += self.send_zlp()
+                            m.d.usb += self.write_codec_command.eq(1)
+                        with m.Else():
+                            m.d.comb += interface.handshakes_out.stall.eq(1)
+
+                with m.Case(self.REQUEST_SET_LOOPBACK):
+                    with m.If(interface.status_requested):
+                        m.d.comb += self.send_zlp()
+                        m.d.usb += self.set_loopback.eq(1)
+
                 with m.Case():
                     #
                     # Stall unhandled requests.
@@ -107,4 +412,4 @@ class UAC2RequestHandlers(USBRequestHandler):
                     with m.If(interface.status_requested | interface.data_requested):
                         m.d.comb += interface.handshakes_out.stall.eq(1)
 
-                return m
+        return m
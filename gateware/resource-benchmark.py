@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+#
+# area and fmax benchmark of the gateware blocks with the open toolchain:
+# every block is synthesized on its own with yosys at each channel count,
+# and its LUTs, flip-flops, block RAMs and estimated fmax are compared against the stored baseline.
+# A block missing from the baseline is an error, --update-baseline adds it
+#
+# usage: resource-benchmark.py [--target max10|generic] [--channels N [N ...]] [--block NAME]
+#                              [--tolerance PERCENT] [--update-baseline]
+#
+# yosys is taken from $YOSYS, the PATH or yowasp-yosys
+#
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+from amaranth             import *
+from amaranth.hdl.rec     import Record
+from amaranth.back        import rtlil
+
+from deca_usb2_audio_interface import USB2AudioInterface
+from usb_stream_to_channels    import USBStreamToChannels
+from channels_to_usb_stream    import ChannelsToUSBStream
+from requesthandlers           import UAC2RequestHandlers
+from audio_init                import AudioInit
+from feedback                  import FeedbackValueCalculator, BufferLevelFeedbackCorrection
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "resource-baseline.json")
+METRICS = ["luts", "ffs", "brams", "lut_levels", "fmax_mhz"]
+
+# the fmax estimate only counts LUT levels on the longest register to register path.
+# It is meant to compare revisions, the timing analysis of Quartus is what counts.
+# MAX 10 (C8): clock to out, setup and clock skew, LUT plus local routing per level
+REGISTER_OVERHEAD_NS = 2.0
+LUT_LEVEL_NS         = 1.2
+
+TARGETS = {
+    # MAX 10 logic elements, M9K block RAM.
+    # The M9K techmap of yosys does not take the INIT parameter which memory_bram sets,
+    # so map_bram of synth_intel is done here without it
+    "max10": {
+        "script":     ["synth_intel -family max10 -top top -run :map_bram",
+                       "memory_bram -rules +/intel/common/brams_m9k.txt",
+                       "setparam -unset INIT t:$__M9K_ALTSYNCRAM_SINGLEPORT_FULL",
+                       "techmap -map +/intel/common/brams_map_m9k.v",
+                       "synth_intel -family max10 -top top -run map_ffram:"],
+        "luts":       ["fiftyfivenm_lcell_comb"],
+        "ffs":        ["dffeas"],
+        "brams":      ["altsyncram"],
+    },
+    # technology independent 4-input LUTs, memories are kept as they are
+    "generic": {
+        "script":     ["synth -flatten -top top -run :fine", "opt -full", "techmap", "opt -fast",
+                       "abc -lut 4", "opt_clean"],
+        "luts":       ["$lut"],
+        "ffs":        ["$_DFF", "$_SDFF", "$_ALDFF", "$_DLATCH"],
+        "brams":      ["$mem_v2"],
+    },
+}
+
+class BenchmarkTop(Elaboratable):
+    """ clocks a block from a single clock, usb and sync are the same domain like on the board """
+    def __init__(self, block):
+        self.block = block
+        self.sync  = ClockDomain("sync")
+
+    def elaborate(self, platform):
+        m = Module()
+        m.domains.sync = self.sync
+        m.domains.usb  = ClockDomain("usb")
+        m.d.comb += [
+            ClockSignal("usb").eq(ClockSignal("sync")),
+            ResetSignal("usb").eq(ResetSignal("sync")),
+        ]
+        m.submodules.block = self.block
+        return m
+
+def blackboxes(fragment):
+    """ verilog black boxes of the vendor primitives in a design, like the ALTPLL of AudioInit,
+        so yosys keeps the logic around them
+    """
+    primitives = {}
+    def collect(fragment):
+        if isinstance(fragment, Instance):
+            ports, parameters = primitives.setdefault(fragment.type, ({}, set()))
+            ports.update({ name: (len(value), direction) for name, (value, direction) in fragment.named_ports.items() })
+            parameters.update(fragment.parameters)
+        for subfragment, _ in fragment.subfragments:
+            collect(subfragment)
+    collect(fragment)
+
+    directions = { "i": "input", "o": "output", "io": "inout" }
+    modules = []
+    for name, (ports, parameters) in sorted(primitives.items()):
+        modules += [f"(* blackbox *)", f"module {name}({', '.join(sorted(ports))});"]
+        modules += [f"    parameter {parameter} = 0;" for parameter in sorted(parameters)]
+        modules += [f"    {directions[direction]} [{width - 1}:0] {port};" for port, (width, direction) in sorted(ports.items())]
+        modules += ["endmodule"]
+    return "\n".join(modules) + "\n"
+
+def block_ports(block):
+    """ all signals of the public attributes of a block, which become the ports of the netlist """
+    ports = []
+    seen  = set()
+    def collect(value):
+        if isinstance(value, (Signal, Record)):
+            ports.extend(value._lhs_signals())
+        elif isinstance(value, (list, tuple)):
+            for item in value:
+                collect(item)
+        # interface objects which hold records, like the request handler interface of LUNA
+        elif hasattr(value, "__dict__") and not isinstance(value, Elaboratable) and id(value) not in seen:
+            seen.add(id(value))
+            for name, item in vars(value).items():
+                if not name.startswith("_"):
+                    collect(item)
+
+    for name, value in vars(block).items():
+        if not name.startswith("_"):
+            collect(value)
+    return ports
+
+def feedback_block(channels):
+    m = Module()
+    m.submodules.calculator = calculator = FeedbackValueCalculator(window_log2=7, max_ticks_per_microframe=2048)
+    m.submodules.correction = correction = BufferLevelFeedbackCorrection()
+    m.d.comb += correction.feedback_in.eq(calculator.feedback_value)
+    return m, block_ports(calculator) + block_ports(correction)
+
+def uac2_request_handlers(channels):
+    top = USB2AudioInterface(nr_channels=channels)
+    return UAC2RequestHandlers(top.SAMPLE_RATES, top.DEFAULT_SAMPLE_RATE, nr_channels=channels)
+
+def channels_to_usb_stream(channels):
+    top = USB2AudioInterface(nr_channels=channels)
+    return ChannelsToUSBStream(channels, max_packet_size=top.MAX_FRAME_BYTES)
+
+# the blocks, and whether they depend on the number of channels
+BLOCKS = {
+    "usb_stream_to_channels": (lambda channels: USBStreamToChannels(channels),                       True),
+    "channels_to_usb_stream": (channels_to_usb_stream,                                               True),
+    "uac2_request_handlers":  (uac2_request_handlers,                                                True),
+    "audio_init":             (lambda channels: AudioInit(USB2AudioInterface(channels).SAMPLE_RATES), False),
+    "feedback":               (feedback_block,                                                       False),
+}
+
+def find_yosys():
+    for candidate in [os.environ.get("YOSYS"), "yosys", "yowasp-yosys"]:
+        if candidate and shutil.which(candidate):
+            return shutil.which(candidate)
+    sys.exit("yosys not found, install it or yowasp-yosys, or point $YOSYS at it")
+
+def synthesize(yosys, target, block, ports):
+    """ runs yosys on one block, returns the metrics """
+    settings = TARGETS[target]
+    top      = BenchmarkTop(block)
+    fragment = Fragment.get(top, None)
+    netlist  = rtlil.convert(fragment, ports=[top.sync.clk, top.sync.rst, *ports])
+
+    # yowasp-yosys only sees the working directory
+    with tempfile.TemporaryDirectory() as directory:
+        with open(os.path.join(directory, "top.il"), "w") as f:
+            f.write(netlist)
+        with open(os.path.join(directory, "blackboxes.v"), "w") as f:
+            f.write(blackboxes(fragment))
+
+        # the logic depth is taken from the 4-input LUT mapping for every target,
+        # the LEs of the MAX 10 are 4-input LUTs as well
+        script = ["read_verilog -lib blackboxes.v", "read_rtlil top.il", "design -save rtl", *settings["script"],
+                  "tee -q -o stat.json stat -json",
+                  "design -load rtl", *TARGETS["generic"]["script"],
+                  "tee -q -o ltp.log ltp -noff"]
+        subprocess.run([yosys, "-q", "-p", "; ".join(script)], cwd=directory, check=True)
+
+        with open(os.path.join(directory, "stat.json")) as f:
+            stat = json.load(f)
+        with open(os.path.join(directory, "ltp.log")) as f:
+            ltp = f.read()
+
+    cells = stat["design"]["num_cells_by_type"]
+    def count(prefixes):
+        return sum(number for cell, number in cells.items() if any(cell.startswith(prefix) for prefix in prefixes))
+
+    # "Longest topological path in top (length=N):"
+    lut_levels = max(int(ltp.split("length=")[1].split(")")[0]), 0)
+
+    return {
+        "luts":       count(settings["luts"]),
+        "ffs":        count(settings["ffs"]),
+        "brams":      count(settings["brams"]),
+        "lut_levels": lut_levels,
+        "fmax_mhz":   round(1000 / (REGISTER_OVERHEAD_NS + lut_levels * LUT_LEVEL_NS), 1),
+    }
+
+def compare(result, baseline, tolerance):
+    """ formats the metrics with their change against the baseline, returns the text and whether it regressed """
+    columns   = []
+    regressed = False
+    for metric in METRICS:
+        value = result[metric]
+        if baseline is None or metric not in baseline:
+            columns.append(f"{value:>10}{'':9}")
+            continue
+
+        old    = baseline[metric]
+        change = (value - old) / old * 100 if old else (0 if value == old else 100)
+        # fewer resources are better, a lower fmax is worse
+        worse  = -change if metric == "fmax_mhz" else change
+        if worse > tolerance:
+            regressed = True
+        columns.append(f"{value:>10} ({change:+5.1f}%)" if change else f"{value:>10}{'':9}")
+
+    return " ".join(columns), regressed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="yosys area and fmax benchmark of the gateware blocks")
+    parser.add_argument("--target", default="max10", choices=TARGETS.keys(),
+                        help="max10 with synth_intel, or generic 4-input LUTs")
+    parser.add_argument("--channels", type=int, nargs="+", default=USB2AudioInterface.SUPPORTED_NR_CHANNELS,
+                        choices=USB2AudioInterface.SUPPORTED_NR_CHANNELS,
+                        help="channel counts of the blocks which depend on them")
+    parser.add_argument("--block", action="append", choices=BLOCKS.keys(),
+                        help="only benchmark this block (can be given more than once)")
+    parser.add_argument("--tolerance", type=float, default=2.0,
+                        help="percentage by which a metric may get worse than the baseline")
+    parser.add_argument("--update-baseline", action="store_true",
+                        help="store the results as the new baseline")
+    args = parser.parse_args()
+
+    yosys = find_yosys()
+
+    baselines = {}
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE) as f:
+            baselines = json.load(f)
+
+    # without a baseline nothing would be compared, the check would always pass
+    if not args.update_baseline:
+        if args.target not in baselines:
+            sys.exit(f"no {args.target} baseline in {BASELINE_FILE}, create it with --update-baseline")
+        keys = [f"{name}/{channels}" if BLOCKS[name][1] else name
+                for name in args.block or BLOCKS
+                for channels in (args.channels if BLOCKS[name][1] else [None])]
+        missing = [key for key in keys if key not in baselines[args.target]]
+        if missing:
+            sys.exit(f"not in the {args.target} baseline: " + ", ".join(missing) + ", add them with --update-baseline")
+    baseline = baselines.setdefault(args.target, {})
+
+    print(f"{'block':<24} {'channels':>8} " + " ".join(f"{metric:>10}{'':9}" for metric in METRICS))
+
+    regressions = []
+    for name in args.block or BLOCKS:
+        factory, per_channel = BLOCKS[name]
+        for channels in (args.channels if per_channel else [None]):
+            block = factory(channels or USB2AudioInterface.NR_CHANNELS)
+            if isinstance(block, tuple):
+                block, ports = block
+            else:
+                ports = block_ports(block)
+
+            key    = f"{name}/{channels}" if per_channel else name
+            result = synthesize(yosys, args.target, block, ports)
+
+            text, regressed = compare(result, baseline.get(key), args.tolerance)
+            print(f"{name:<24} {channels or '-':>8} {text}", flush=True)
+            if regressed:
+                regressions.append(key)
+
+            if args.update_baseline:
+                baseline[key] = result
+
+    if args.update_baseline:
+        with open(BASELINE_FILE, "w") as f:
+            json.dump(baselines, f, indent=4, sort_keys=True)
+            f.write("\n")
+        print(f"baseline for {args.target} written to {BASELINE_FILE}")
+
+    elif regressions:
+        print(f"worse than the baseline by more than {args.tolerance}%: " + ", ".join(regressions))
+        sys.exit(1)
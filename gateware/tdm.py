@@ -0,0 +1,399 @@
+from amaranth          import *
+from amaranth.build    import Platform
+from amaranth.lib.cdc  import FFSynchronizer, PulseSynchronizer, ResetSynchronizer
+from amaranth.lib.fifo import SyncFIFOBuffered, AsyncFIFO
+from amlib.stream      import StreamInterface
+
+class TDMClockEdges(Elaboratable):
+    """ synchronizes the bit clock and frame sync of a TDM bus
+        and detects the start of a frame
+
+        Like I2S, the first bit of slot 0 follows one bit clock after
+        the rising edge of the frame sync (DSP mode A). The frame sync
+        has to be high for at least one bit clock.
+
+        With oversampled=False the domain is clocked by the bit clock itself:
+        every cycle is a rising edge, and the falling edge strobes with it, see TDMTransmitter.
+    """
+    def __init__(self, oversampled=True):
+        # parameters
+        self._oversampled   = oversampled
+
+        # ports
+        self.bit_clock_in   = Signal()
+        self.frame_sync_in  = Signal()
+
+        self.rising_edge    = Signal()
+        self.falling_edge   = Signal()
+        # strobes with rising_edge, the next bit is the first bit of slot 0
+        self.frame_start    = Signal()
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        bit_clock       = Signal()
+        bit_clock_last  = Signal()
+        frame_sync      = Signal()
+        frame_sync_last = Signal()
+
+        if self._oversampled:
+            m.submodules.bit_clock_sync  = FFSynchronizer(self.bit_clock_in,  bit_clock)
+            m.submodules.frame_sync_sync = FFSynchronizer(self.frame_sync_in, frame_sync)
+
+            m.d.sync += bit_clock_last.eq(bit_clock)
+            m.d.comb += [
+                self.rising_edge.eq(bit_clock & ~bit_clock_last),
+                self.falling_edge.eq(~bit_clock & bit_clock_last),
+            ]
+
+        else:
+            m.d.comb += [
+                frame_sync.eq(self.frame_sync_in),
+                self.rising_edge.eq(1),
+                self.falling_edge.eq(1),
+            ]
+
+        m.d.comb += self.frame_start.eq(self.rising_edge & frame_sync & ~frame_sync_last)
+
+        with m.If(self.rising_edge):
+            m.d.sync += frame_sync_last.eq(frame_sync)
+
+        return m
+
+
+class TDMReceiver(Elaboratable):
+    """ receives the slots of a TDM frame (eg. TDM8, TDM16) as a channel_no tagged stream
+
+        The samples are left justified in the slots, MSB first.
+        With oversampled=False, the receiver is clocked by the bit clock, see BitClockTDMReceiver.
+    """
+    def __init__(self, nr_channels=8, sample_width=24, slot_width=32, oversampled=True):
+        assert sample_width <= slot_width
+
+        # parameters
+        self._oversampled  = oversampled
+        self._nr_channels  = nr_channels
+        self._channel_bits = Shape.cast(range(nr_channels)).width
+        self._sample_width = sample_width
+        self._slot_width   = slot_width
+
+        # ports
+        self.enable_in      = Signal()
+        self.bit_clock_in   = Signal()
+        self.frame_sync_in  = Signal()
+        self.serial_data_in = Signal()
+        self.stream_out     = StreamInterface(name="tdm_receiver_out", payload_width=sample_width, extra_fields=[("channel_no", self._channel_bits)])
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        m.submodules.clock_edges = clock_edges = TDMClockEdges(self._oversampled)
+        serial_data = Signal()
+        if self._oversampled:
+            m.submodules.serial_data_sync = FFSynchronizer(self.serial_data_in, serial_data)
+        else:
+            m.d.comb += serial_data.eq(self.serial_data_in)
+
+        m.d.comb += [
+            clock_edges.bit_clock_in.eq(self.bit_clock_in),
+            clock_edges.frame_sync_in.eq(self.frame_sync_in),
+        ]
+
+        slot_word    = Signal(self._slot_width)
+        bit_no       = Signal(range(self._slot_width))
+        slot_no      = Signal(self._channel_bits)
+        in_frame     = Signal()
+
+        last_channel = self._nr_channels - 1
+        last_bit     = self._slot_width - 1
+
+        m.d.sync += self.stream_out.valid.eq(0)
+
+        with m.If(~self.enable_in):
+            m.d.sync += in_frame.eq(0)
+
+        with m.Elif(clock_edges.rising_edge):
+            with m.If(in_frame):
+                m.d.sync += [
+                    slot_word.eq(Cat(serial_data, slot_word[:-1])),
+                    bit_no.eq(bit_no + 1),
+                ]
+
+                with m.If(bit_no == last_bit):
+                    m.d.sync += [
+                        self.stream_out.payload.eq(Cat(serial_data, slot_word[:-1])[-self._sample_width:]),
+                        self.stream_out.channel_no.eq(slot_no),
+                        self.stream_out.first.eq(slot_no == 0),
+                        self.stream_out.last.eq(slot_no == last_channel),
+                        self.stream_out.valid.eq(1),
+                        bit_no.eq(0),
+                        slot_no.eq(slot_no + 1),
+                    ]
+
+                    # the slots after the last channel are ignored
+                    with m.If(slot_no == last_channel):
+                        m.d.sync += in_frame.eq(0)
+
+            # the last bit of a full frame comes with the frame sync of the next one
+            with m.If(clock_edges.frame_start):
+                m.d.sync += [
+                    in_frame.eq(1),
+                    bit_no.eq(0),
+                    slot_no.eq(0),
+                ]
+
+        return m
+
+
+class TDMTransmitter(Elaboratable):
+    """ sends a channel_no tagged stream in the slots of a TDM frame (eg. TDM8, TDM16)
+
+        The samples are left justified in the slots, MSB first.
+        Slots without a sample for their channel are sent as zeros.
+        With oversampled=False, the transmitter is clocked by the bit clock and shifts at its rising edge,
+        serial_data_out has to be registered at the falling edge, see BitClockTDMTransmitter.
+    """
+    def __init__(self, nr_channels=8, sample_width=24, slot_width=32, fifo_depth=None, oversampled=True):
+        assert sample_width <= slot_width
+
+        # parameters
+        self._oversampled  = oversampled
+        self._nr_channels  = nr_channels
+        self._channel_bits = Shape.cast(range(nr_channels)).width
+        self._sample_width = sample_width
+        self._slot_width   = slot_width
+        self._fifo_depth   = fifo_depth if fifo_depth is not None else 2 * nr_channels
+
+        # ports
+        self.enable_in       = Signal()
+        self.bit_clock_in    = Signal()
+        self.frame_sync_in   = Signal()
+        self.serial_data_out = Signal()
+        self.stream_in       = StreamInterface(name="tdm_transmitter_in", payload_width=sample_width, extra_fields=[("channel_no", self._channel_bits)])
+        self.underflow_out   = Signal()
+        # strobes when a sample is taken out of the FIFO
+        self.sample_out      = Signal()
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        m.submodules.clock_edges = clock_edges = TDMClockEdges(self._oversampled)
+        m.submodules.fifo = fifo = SyncFIFOBuffered(width=self._sample_width + self._channel_bits, depth=self._fifo_depth)
+
+        sample_width = self._sample_width
+        fifo_sample  = Signal(sample_width)
+        fifo_channel = Signal(self._channel_bits)
+
+        m.d.comb += [
+            clock_edges.bit_clock_in.eq(self.bit_clock_in),
+            clock_edges.frame_sync_in.eq(self.frame_sync_in),
+
+            fifo.w_data.eq(Cat(self.stream_in.payload, self.stream_in.channel_no)),
+            fifo.w_en.eq(self.stream_in.valid),
+            self.stream_in.ready.eq(fifo.w_rdy),
+
+            fifo_sample.eq(fifo.r_data[:sample_width]),
+            fifo_channel.eq(fifo.r_data[sample_width:]),
+        ]
+
+        slot_word     = Signal(self._slot_width)
+        bit_no        = Signal(range(self._slot_width))
+        slot_no       = Signal(self._channel_bits)
+        in_frame      = Signal()
+        frame_pending = Signal()
+        start_frame   = Signal()
+        load_slot     = Signal()
+
+        last_channel = self._nr_channels - 1
+        last_bit     = self._slot_width - 1
+
+        m.d.sync += self.underflow_out.eq(0)
+
+        # without oversampling, the falling edge strobes together with the frame start
+        m.d.comb += start_frame.eq(frame_pending | (clock_edges.frame_start & self.enable_in))
+        with m.If(clock_edges.frame_start & self.enable_in & ~clock_edges.falling_edge):
+            m.d.sync += frame_pending.eq(1)
+
+        # the data changes at the falling edge, the receiver samples it at the rising edge
+        with m.If(clock_edges.falling_edge):
+            with m.If(start_frame):
+                m.d.comb += load_slot.eq(1)
+                m.d.sync += [
+                    frame_pending.eq(0),
+                    in_frame.eq(1),
+                    bit_no.eq(0),
+                    slot_no.eq(0),
+                ]
+
+            with m.Elif(in_frame):
+                m.d.sync += [
+                    slot_word.eq(slot_word << 1),
+                    bit_no.eq(bit_no + 1),
+                ]
+
+                with m.If(bit_no == last_bit):
+                    m.d.sync += [
+                        bit_no.eq(0),
+                        slot_no.eq(slot_no + 1),
+                    ]
+                    with m.If(slot_no == last_channel):
+                        m.d.sync += [
+                            in_frame.eq(0),
+                            slot_word.eq(0),
+                        ]
+                    with m.Else():
+                        m.d.comb += load_slot.eq(1)
+
+        # the channel of the slot which is loaded now
+        load_channel = Signal(self._channel_bits)
+        m.d.comb += load_channel.eq(Mux(start_frame, 0, slot_no + 1))
+
+        with m.If(load_slot):
+            with m.If(~fifo.r_rdy):
+                m.d.sync += [
+                    slot_word.eq(0),
+                    self.underflow_out.eq(1),
+                ]
+
+            with m.Elif(fifo_channel == load_channel):
+                m.d.comb += fifo.r_en.eq(1)
+                m.d.sync += slot_word.eq(fifo_sample << (self._slot_width - sample_width))
+
+            # a stale sample from an earlier slot, drop it
+            with m.Elif(fifo_channel < load_channel):
+                m.d.comb += fifo.r_en.eq(1)
+                m.d.sync += slot_word.eq(0)
+
+            # the sample for this slot is missing
+            with m.Else():
+                m.d.sync += slot_word.eq(0)
+
+        m.d.comb += [
+            self.serial_data_out.eq(slot_word[-1] & in_frame),
+            self.sample_out.eq(fifo.r_en),
+        ]
+
+        return m
+
+
+class BitClockTDMReceiver(Elaboratable):
+    """ TDMReceiver clocked by the bit clock of the bus instead of oversampling it
+
+        The samples cross into the sync domain through an AsyncFIFO, so the bit clock
+        is only limited by the fabric and not by the sync clock frequency.
+        stream_out.valid strobes for one cycle per sample, like the one of TDMReceiver.
+    """
+    def __init__(self, nr_channels=8, sample_width=24, slot_width=32, fifo_depth=None):
+        # parameters
+        self._nr_channels  = nr_channels
+        self._channel_bits = Shape.cast(range(nr_channels)).width
+        self._sample_width = sample_width
+        self._slot_width   = slot_width
+        self._fifo_depth   = fifo_depth if fifo_depth is not None else 2 * nr_channels
+
+        # ports
+        self.enable_in      = Signal()
+        self.bit_clock_in   = Signal()
+        self.frame_sync_in  = Signal()
+        self.serial_data_in = Signal()
+        self.stream_out     = StreamInterface(name="tdm_receiver_out", payload_width=sample_width, extra_fields=[("channel_no", self._channel_bits)])
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        m.domains.bit_clock = ClockDomain("bit_clock", local=True)
+        m.d.comb += ClockSignal("bit_clock").eq(self.bit_clock_in)
+        m.submodules.reset_sync  = ResetSynchronizer(ResetSignal("sync"), domain="bit_clock")
+
+        m.submodules.receiver    = receiver = DomainRenamer("bit_clock")(
+            TDMReceiver(self._nr_channels, self._sample_width, self._slot_width, oversampled=False))
+        m.submodules.enable_sync = FFSynchronizer(self.enable_in, receiver.enable_in, o_domain="bit_clock")
+
+        stream = receiver.stream_out
+        m.submodules.fifo = fifo = AsyncFIFO(width=len(Cat(stream.payload, stream.channel_no, stream.first, stream.last)),
+                                             depth=self._fifo_depth, r_domain="sync", w_domain="bit_clock")
+
+        m.d.comb += [
+            receiver.frame_sync_in.eq(self.frame_sync_in),
+            receiver.serial_data_in.eq(self.serial_data_in),
+
+            fifo.w_data.eq(Cat(stream.payload, stream.channel_no, stream.first, stream.last)),
+            fifo.w_en.eq(stream.valid),
+
+            fifo.r_en.eq(fifo.r_rdy),
+            Cat(self.stream_out.payload, self.stream_out.channel_no,
+                self.stream_out.first, self.stream_out.last).eq(fifo.r_data),
+            self.stream_out.valid.eq(fifo.r_rdy),
+        ]
+
+        return m
+
+
+class BitClockTDMTransmitter(Elaboratable):
+    """ TDMTransmitter clocked by the bit clock of the bus instead of oversampling it
+
+        The samples cross from the sync domain through an AsyncFIFO,
+        serial_data_out changes at the falling edge of the bit clock.
+        underflow_out and sample_out are strobes in the sync domain.
+    """
+    def __init__(self, nr_channels=8, sample_width=24, slot_width=32, fifo_depth=None):
+        # parameters
+        self._nr_channels  = nr_channels
+        self._channel_bits = Shape.cast(range(nr_channels)).width
+        self._sample_width = sample_width
+        self._slot_width   = slot_width
+        self._fifo_depth   = fifo_depth if fifo_depth is not None else 2 * nr_channels
+
+        # ports
+        self.enable_in       = Signal()
+        self.bit_clock_in    = Signal()
+        self.frame_sync_in   = Signal()
+        self.serial_data_out = Signal()
+        self.stream_in       = StreamInterface(name="tdm_transmitter_in", payload_width=sample_width, extra_fields=[("channel_no", self._channel_bits)])
+        self.underflow_out   = Signal()
+        # strobes when a sample is taken out of the FIFO of the transmitter
+        self.sample_out      = Signal()
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        m.domains.bit_clock     = ClockDomain("bit_clock", local=True)
+        m.domains.bit_clock_neg = ClockDomain("bit_clock_neg", clk_edge="neg", reset_less=True, local=True)
+        m.d.comb += [
+            ClockSignal("bit_clock").eq(self.bit_clock_in),
+            ClockSignal("bit_clock_neg").eq(self.bit_clock_in),
+        ]
+        m.submodules.reset_sync  = ResetSynchronizer(ResetSignal("sync"), domain="bit_clock")
+
+        m.submodules.transmitter = transmitter = DomainRenamer("bit_clock")(
+            TDMTransmitter(self._nr_channels, self._sample_width, self._slot_width, oversampled=False))
+        m.submodules.enable_sync = FFSynchronizer(self.enable_in, transmitter.enable_in, o_domain="bit_clock")
+
+        m.submodules.fifo = fifo = AsyncFIFO(width=self._sample_width + self._channel_bits,
+                                             depth=self._fifo_depth, r_domain="bit_clock", w_domain="sync")
+
+        m.submodules.underflow_sync = underflow_sync = PulseSynchronizer(i_domain="bit_clock", o_domain="sync")
+        m.submodules.sample_sync    = sample_sync    = PulseSynchronizer(i_domain="bit_clock", o_domain="sync")
+
+        stream = transmitter.stream_in
+        m.d.comb += [
+            transmitter.frame_sync_in.eq(self.frame_sync_in),
+
+            fifo.w_data.eq(Cat(self.stream_in.payload, self.stream_in.channel_no)),
+            fifo.w_en.eq(self.stream_in.valid),
+            self.stream_in.ready.eq(fifo.w_rdy),
+
+            Cat(stream.payload, stream.channel_no).eq(fifo.r_data),
+            stream.valid.eq(fifo.r_rdy),
+            fifo.r_en.eq(stream.ready),
+
+            underflow_sync.i.eq(transmitter.underflow_out),
+            self.underflow_out.eq(underflow_sync.o),
+            sample_sync.i.eq(transmitter.sample_out),
+            self.sample_out.eq(sample_sync.o),
+        ]
+
+        # the transmitter shifts at the rising edge, the receiver samples at the next one
+        m.d.bit_clock_neg += self.serial_data_out.eq(transmitter.serial_data_out)
+
+        return m
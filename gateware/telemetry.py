@@ -0,0 +1,73 @@
+from amaranth       import *
+from amaranth.build import Platform
+
+class Telemetry(Elaboratable):
+    """ register file of health counters, read by the host with vendor requests
+
+        All registers are 32 bit wide. The counters saturate,
+        clear resets them and the high-water marks. read_data follows read_address after one cycle.
+    """
+    # register numbers, the host reads them with telemetry-monitor.py in the project root
+    REGISTERS = [
+        "underflows",                # serial transmitter had no sample for a slot
+        "jitter_buffer_underruns",   # jitter buffer ran empty and started prefilling again
+        "record_overflows",          # recorded frames were dropped before going out on EP2 IN
+        "jitter_buffer_high_water",  # highest jitter buffer level, in samples
+        "transmitter_high_water",    # highest number of samples in the serial transmitter FIFO
+        "record_high_water",         # highest number of recorded frames waiting for EP2 IN
+        "feedback_value",            # current feedback value sent to the host, 16.16
+        "sof_count",                 # start of frames received
+        "altsetting_changes",        # SET_INTERFACE requests on the streaming interfaces
+    ]
+
+    def __init__(self):
+        # ports
+        self.underflow              = Signal()
+        self.jitter_buffer_underrun = Signal()
+        self.record_overflow        = Signal()
+        self.jitter_buffer_level    = Signal(32)
+        self.transmitter_level      = Signal(32)
+        self.record_level           = Signal(32)
+        self.feedback_value         = Signal(32)
+        self.start_of_frame         = Signal()
+        self.altsetting_changed     = Signal()
+        self.clear                  = Signal()
+
+        self.read_address           = Signal(range(len(self.REGISTERS)))
+        self.read_data              = Signal(32)
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        registers = { name: Signal(32, name=name) for name in self.REGISTERS }
+        max_value = 2**32 - 1
+
+        def count(name, strobe):
+            register = registers[name]
+            with m.If(self.clear):
+                m.d.sync += register.eq(0)
+            with m.Elif(strobe & (register != max_value)):
+                m.d.sync += register.eq(register + 1)
+
+        def high_water(name, level):
+            register = registers[name]
+            with m.If(self.clear):
+                m.d.sync += register.eq(0)
+            with m.Elif(level > register):
+                m.d.sync += register.eq(level)
+
+        count("underflows",              self.underflow)
+        count("jitter_buffer_underruns", self.jitter_buffer_underrun)
+        count("record_overflows",        self.record_overflow)
+        count("sof_count",               self.start_of_frame)
+        count("altsetting_changes",      self.altsetting_changed)
+
+        high_water("jitter_buffer_high_water", self.jitter_buffer_level)
+        high_water("transmitter_high_water",   self.transmitter_level)
+        high_water("record_high_water",        self.record_level)
+
+        m.d.comb += registers["feedback_value"].eq(self.feedback_value)
+
+        m.d.sync += self.read_data.eq(Array(registers[name] for name in self.REGISTERS)[self.read_address])
+
+        return m
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+#
+# tests the feature unit volume and mute of the playback stream
+#
+# run with: python -m pytest test_playback_volume.py
+#
+import pytest
+
+from amaranth.sim import Simulator
+
+from playback_volume import PlaybackVolume
+
+NR_CHANNELS = 2
+SAMPLES     = [0, 1, -1, 0x123456, -0x123456, 2**23 - 1, -2**23]
+
+def run(volume, mute, samples):
+    """ sends the samples through alternating channels, returns (channel, sample) of the output """
+    dut = PlaybackVolume(nr_channels=NR_CHANNELS)
+    output = []
+
+    def process():
+        for channel in range(NR_CHANNELS):
+            yield dut.volume[channel].eq(volume[channel])
+        yield dut.mute.eq(mute)
+        yield dut.stream_out.ready.eq(1)
+
+        sent = 0
+        while len(output) < len(samples):
+            if sent < len(samples):
+                yield dut.stream_in.valid.eq(1)
+                yield dut.stream_in.payload.eq(samples[sent])
+                yield dut.stream_in.channel_no.eq(sent % NR_CHANNELS)
+            else:
+                yield dut.stream_in.valid.eq(0)
+            yield
+
+            if sent < len(samples) and (yield dut.stream_in.ready):
+                sent += 1
+            if (yield dut.stream_out.valid):
+                payload = yield dut.stream_out.payload
+                output.append(((yield dut.stream_out.channel_no), payload - 2**24 if payload & 2**23 else payload))
+
+    sim = Simulator(dut)
+    sim.add_clock(1e-6)
+    sim.add_sync_process(process)
+    sim.run()
+    return output
+
+def test_unity_volume_is_bit_exact():
+    samples = [sample for sample in SAMPLES for _ in range(NR_CHANNELS)]
+    assert run([0, 0], 0b00, samples) == [(n % NR_CHANNELS, sample) for n, sample in enumerate(samples)]
+
+@pytest.mark.parametrize("volume_db", [-6, -20, -96])
+def test_volume_and_mute(volume_db):
+    samples = [sample for sample in SAMPLES for _ in range(NR_CHANNELS)]
+    # channel 0 at the volume, channel 1 muted
+    output  = run([volume_db * 256, 0], 0b10, samples)
+
+    # the gain is rounded to 16 fractional bits and the product is truncated
+    gain = 10**(volume_db / 20)
+    for n, (channel, sample) in enumerate(output):
+        assert channel == n % NR_CHANNELS
+        if channel == 1:
+            assert sample == 0
+        else:
+            assert abs(sample - samples[n] * gain) <= abs(samples[n]) * 2**-17 + 1
@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+#
+# throughput / latency regression tests for the USB <-> channel stream converters
+#
+# run with: python -m pytest -s test_stream_converters.py
+#
+import random
+import pytest
+
+from amaranth     import *
+from amaranth.sim import Simulator, Settle
+
+from usb_stream_to_channels import USBStreamToChannels
+from channels_to_usb_stream import ChannelsToUSBStream
+from packet_scheduler       import AudioFramesScheduler
+
+NR_CHANNELS   = [2, 8, 32]
+SUBSLOT_SIZES = [4, 3, 2]
+
+# probability of valid / ready being asserted in a cycle
+# when the other side applies back-pressure
+BACK_PRESSURE = 0.7
+
+# the limits the converters have to meet, measured with margin
+USB_TO_CHANNELS_LIMITS = {
+    # back-pressure: (min bytes per cycle, max latency in cycles, max stalls per frame per channel)
+    False: (0.99, 1, 0),
+    True:  (0.45, 8, 4),
+}
+
+CHANNELS_TO_USB_LIMITS = {
+    # back-pressure: (min bytes per cycle, max frame completion latency per channel, max stalls per frame per channel)
+    False: (0.85, 1, 0),
+    True:  (0.55, 1, 0),
+}
+
+def sample_value(frame, channel):
+    return ((frame << 12) | (channel << 4) | 0x5) & 0xffffff
+
+def subslot_bytes(sample, subslot_size):
+    if subslot_size == 4:
+        return [0, sample & 0xff, (sample >> 8) & 0xff, sample >> 16]
+    if subslot_size == 3:
+        return [sample & 0xff, (sample >> 8) & 0xff, sample >> 16]
+    return [(sample >> 8) & 0xff, sample >> 16]
+
+def report(record_property, name, **metrics):
+    print(f"\n{name}: " + ", ".join(f"{key} {value:.3f}" for key, value in metrics.items()))
+    for key, value in metrics.items():
+        record_property(key, value)
+
+@pytest.mark.parametrize("back_pressure", [False, True])
+@pytest.mark.parametrize("subslot_size", SUBSLOT_SIZES)
+@pytest.mark.parametrize("nr_channels", NR_CHANNELS)
+def test_usb_stream_to_channels(nr_channels, subslot_size, back_pressure, record_property):
+    dut = USBStreamToChannels(nr_channels)
+    rng = random.Random(nr_channels * 100 + subslot_size)
+
+    nr_frames = max(64 // nr_channels, 4)
+    frames_per_packet = 2
+
+    # (payload, first, index of the sample completed by this byte)
+    usb_bytes = []
+    expected  = []
+    for frame in range(nr_frames):
+        for channel in range(nr_channels):
+            sample = sample_value(frame, channel)
+            for pos, byte in enumerate(subslot_bytes(sample, subslot_size)):
+                first = (frame % frames_per_packet == 0) and (channel == 0) and (pos == 0)
+                completes = len(expected) if pos == subslot_size - 1 else None
+                usb_bytes.append((byte, first, completes))
+            expected.append((sample if subslot_size != 2 else sample & 0xffff00, channel))
+
+    received    = []
+    metrics     = dict(cycles=0, stalls=0, worst_latency=0)
+    completed_at = {}
+
+    def process():
+        yield dut.subslot_size.eq(subslot_size)
+        pos = 0
+        cycle = 0
+        while len(received) < len(expected):
+            assert cycle < 20 * len(usb_bytes), "converter stopped"
+            yield Settle()
+            in_valid  = pos < len(usb_bytes) and (not back_pressure or rng.random() < BACK_PRESSURE)
+            out_ready = not back_pressure or rng.random() < BACK_PRESSURE
+
+            if in_valid:
+                byte, first, _ = usb_bytes[pos]
+                yield dut.usb_stream_in.payload.eq(byte)
+                yield dut.usb_stream_in.first.eq(first)
+            yield dut.usb_stream_in.valid.eq(in_valid)
+            yield dut.channel_stream_out.ready.eq(out_ready)
+
+            if (yield dut.channel_stream_out.valid) and out_ready:
+                index = len(received)
+                received.append(((yield dut.channel_stream_out.payload), (yield dut.channel_stream_out.channel_no)))
+                metrics["worst_latency"] = max(metrics["worst_latency"], cycle - completed_at[index])
+
+            # the converter is ready for the USB stream when its output is ready
+            if in_valid:
+                if out_ready:
+                    if usb_bytes[pos][2] is not None:
+                        completed_at[usb_bytes[pos][2]] = cycle
+                    pos += 1
+                    metrics["cycles"] = cycle + 1
+                else:
+                    metrics["stalls"] += 1
+
+            cycle += 1
+            yield
+
+    sim = Simulator(dut)
+    sim.add_clock(1.0/60e6,)
+    sim.add_sync_process(process)
+    sim.run()
+
+    assert received == expected
+
+    bytes_per_cycle  = len(usb_bytes) / metrics["cycles"]
+    stalls_per_frame = metrics["stalls"] / nr_frames
+    report(record_property, f"USBStreamToChannels {nr_channels}ch {subslot_size} byte subslots, back-pressure {back_pressure}",
+           bytes_per_cycle=bytes_per_cycle, worst_latency=metrics["worst_latency"], stalls_per_frame=stalls_per_frame)
+
+    min_bytes_per_cycle, max_latency, max_stalls = USB_TO_CHANNELS_LIMITS[back_pressure]
+    assert bytes_per_cycle >= min_bytes_per_cycle
+    assert metrics["worst_latency"] <= max_latency
+    assert stalls_per_frame <= max_stalls * nr_channels
+
+
+@pytest.mark.parametrize("back_pressure", [False, True])
+@pytest.mark.parametrize("subslot_size", SUBSLOT_SIZES)
+@pytest.mark.parametrize("nr_channels", NR_CHANNELS)
+def test_channels_to_usb_stream(nr_channels, subslot_size, back_pressure, record_property):
+    frames_per_packet = 4
+    dut = ChannelsToUSBStream(nr_channels, max_packet_size=2 * frames_per_packet * nr_channels * 4)
+    rng = random.Random(nr_channels * 100 + subslot_size + 1)
+
+    # like the I2S receiver, only two channels come in, the rest is filled with zeros
+    input_channels    = min(nr_channels, 2)
+    nr_frames         = 4 * frames_per_packet
+    frame_bytes       = nr_channels * subslot_size
+    # the input frame rate is chosen such that the output needs about half the cycles
+    cycles_per_frame  = 2 * nr_channels * 4
+    microframe_cycles = frames_per_packet * cycles_per_frame
+
+    samples = [(sample_value(frame, channel), channel)
+               for frame in range(nr_frames) for channel in range(input_channels)]
+    expected = []
+    for frame in range(nr_frames):
+        for channel in range(nr_channels):
+            sample = sample_value(frame, channel) if channel < input_channels else 0
+            expected += subslot_bytes(sample, subslot_size)
+
+    received = []
+    metrics  = dict(busy_cycles=0, stalls=0, worst_latency=0)
+
+    def process():
+        yield dut.subslot_size.eq(subslot_size)
+        pos = 0
+        cycle = 0
+        # cycle in which the last input sample of each frame was accepted
+        frame_done_at = []
+        frames_complete = 0
+        last_available = 0
+        last_handed = 0
+        bytes_left = 0
+
+        while len(received) < len(expected):
+            assert cycle < 10 * nr_frames * cycles_per_frame, "converter stopped"
+            yield Settle()
+
+            # count the frames which were completed in the last cycle
+            available = (yield dut.frames_available)
+            for _ in range(available - last_available + last_handed):
+                metrics["worst_latency"] = max(metrics["worst_latency"], cycle - frame_done_at[frames_complete])
+                frames_complete += 1
+            last_available = available
+
+            # the samples of a frame arrive at the start of its frame period
+            frame_due = (pos // input_channels) * cycles_per_frame <= cycle
+            in_valid  = pos < len(samples) and frame_due and (not back_pressure or rng.random() < BACK_PRESSURE)
+            out_ready = not back_pressure or rng.random() < BACK_PRESSURE
+
+            # hand all complete frames over at each microframe
+            last_handed = 0
+            if (cycle % microframe_cycles == 0) and cycle > 0:
+                assert bytes_left == 0, "packet was not sent within a microframe"
+                last_handed = available
+                bytes_left  = available * frame_bytes
+            yield dut.start_packet.eq(last_handed > 0)
+            yield dut.packet_frames.eq(last_handed)
+
+            if in_valid:
+                sample, channel = samples[pos]
+                yield dut.channel_stream_in.payload.eq(sample)
+                yield dut.channel_stream_in.channel_no.eq(channel)
+                yield dut.channel_stream_in.last.eq(channel == input_channels - 1)
+            yield dut.channel_stream_in.valid.eq(in_valid)
+            yield dut.usb_stream_out.ready.eq(out_ready)
+            yield Settle()
+
+            if in_valid:
+                if (yield dut.channel_stream_in.ready):
+                    if samples[pos][1] == input_channels - 1:
+                        frame_done_at.append(cycle)
+                    pos += 1
+                else:
+                    metrics["stalls"] += 1
+
+            if bytes_left > 0:
+                metrics["busy_cycles"] += 1
+                if (yield dut.usb_stream_out.valid) and out_ready:
+                    received.append((yield dut.usb_stream_out.payload))
+                    bytes_left -= 1
+
+            cycle += 1
+            yield
+
+    sim = Simulator(dut)
+    sim.add_clock(1.0/60e6,)
+    sim.add_sync_process(process)
+    sim.run()
+
+    assert received == expected
+
+    bytes_per_cycle  = len(received) / metrics["busy_cycles"]
+    stalls_per_frame = metrics["stalls"] / nr_frames
+    report(record_property, f"ChannelsToUSBStream {nr_channels}ch {subslot_size} byte subslots, back-pressure {back_pressure}",
+           bytes_per_cycle=bytes_per_cycle, worst_latency=metrics["worst_latency"], stalls_per_frame=stalls_per_frame)
+
+    min_bytes_per_cycle, max_latency, max_stalls = CHANNELS_TO_USB_LIMITS[back_pressure]
+    assert bytes_per_cycle >= min_bytes_per_cycle
+    assert metrics["worst_latency"] <= max_latency * nr_channels
+    assert stalls_per_frame <= max_stalls * nr_channels
+
+
+class InPacketPath(Elaboratable):
+    """ the audio IN packet path, wired like in deca_usb2_audio_interface.py """
+    def __init__(self, nr_channels, max_frames):
+        self.scheduler = AudioFramesScheduler(max_frames_per_microframe=max_frames)
+        self.stream    = ChannelsToUSBStream(nr_channels, max_packet_size=max_frames * nr_channels * 4)
+        self.sof       = Signal()
+        self.bytes_in_frame = Signal(16)
+        self._nr_channels = nr_channels
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.scheduler = scheduler = self.scheduler
+        m.submodules.stream    = stream    = self.stream
+        m.d.comb += [
+            scheduler.start_of_frame.eq(self.sof),
+            scheduler.frames_available.eq(stream.frames_available),
+            stream.start_packet.eq(self.sof),
+            stream.packet_frames.eq(scheduler.frames_in_packet),
+            self.bytes_in_frame.eq(stream.packet_frames_handed * self._nr_channels * stream.subslot_size),
+        ]
+        return m
+
+def test_in_packet_schedule(record_property):
+    """ at 44.1kHz the packets alternate between 5 and 6 frames, the IN endpoint
+        has to send exactly the frames ChannelsToUSBStream hands over at the same SOF
+    """
+    nr_channels        = 2
+    subslot_size       = 4
+    microframe_cycles  = 400
+    frames_per_uframe  = 44100 / 8000
+    nr_microframes     = 120
+    dut = InPacketPath(nr_channels, max_frames=7)
+
+    packet_sizes = []
+    received     = []
+    dropped      = []
+
+    def process():
+        yield dut.scheduler.samples_per_microframe.eq(round(frames_per_uframe * 2**16))
+        frame = 0
+        channel = 0
+        bytes_left = 0
+        for cycle in range(nr_microframes * microframe_cycles):
+            sof = cycle % microframe_cycles == 0
+
+            # the ADC frames come in at the sample rate
+            in_valid = frame < (cycle + 1) * frames_per_uframe / microframe_cycles
+            if in_valid:
+                yield dut.stream.channel_stream_in.channel_no.eq(channel)
+                yield dut.stream.channel_stream_in.payload.eq(sample_value(frame, channel))
+                yield dut.stream.channel_stream_in.last.eq(channel == nr_channels - 1)
+            yield dut.stream.channel_stream_in.valid.eq(in_valid)
+
+            yield dut.sof.eq(sof)
+            # the endpoint model latches the packet size in the SOF cycle and sends it after the IN token
+            yield dut.stream.usb_stream_out.ready.eq(bytes_left > 0 and cycle % microframe_cycles > 20)
+            yield Settle()
+            if sof:
+                assert bytes_left == 0, "the packet was not sent completely"
+                bytes_left = (yield dut.bytes_in_frame)
+                packet_sizes.append(bytes_left // (nr_channels * subslot_size))
+
+            if (yield dut.stream.frames_dropped):
+                dropped.append(cycle)
+            if (yield dut.stream.usb_stream_out.ready) and (yield dut.stream.usb_stream_out.valid):
+                received.append((yield dut.stream.usb_stream_out.payload))
+                bytes_left -= 1
+                assert ((yield dut.stream.usb_stream_out.last) == 1) == (bytes_left == 0), \
+                    "the stream packet does not end with the IN packet"
+
+            if in_valid and (yield dut.stream.channel_stream_in.ready):
+                if channel == nr_channels - 1:
+                    frame += 1
+                channel = (channel + 1) % nr_channels
+            yield
+
+    sim = Simulator(dut)
+    sim.add_clock(1.0/60e6,)
+    sim.add_sync_process(process)
+    sim.run()
+
+    # skip the first packets, while the schedule starts up
+    steady = packet_sizes[4:]
+    report(record_property, "IN packets at 44.1kHz",
+           frames_per_packet=sum(steady) / len(steady), dropped=len(dropped))
+
+    assert not dropped, f"frames dropped in cycles {dropped}"
+    assert set(steady) == {5, 6}
+    assert abs(sum(steady) / len(steady) - frames_per_uframe) < 0.05
+
+    frames   = len(received) // (nr_channels * subslot_size)
+    expected = [byte for frame in range(frames) for channel in range(nr_channels)
+                for byte in subslot_bytes(sample_value(frame, channel), subslot_size)]
+    assert received == expected
+
+def test_packet_larger_than_available():
+    """ the scheduler may ask for more frames than are available while it pays back its debt,
+        the packet has to be shortened to the available frames without corrupting frames_available
+    """
+    nr_channels  = 2
+    subslot_size = 4
+    max_frames   = 4
+    dut = ChannelsToUSBStream(nr_channels, max_packet_size=max_frames * nr_channels * 4)
+
+    packets = []
+
+    def write_frames(first_frame, nr_frames):
+        for frame in range(first_frame, first_frame + nr_frames):
+            for channel in range(nr_channels):
+                yield dut.channel_stream_in.payload.eq(sample_value(frame, channel))
+                yield dut.channel_stream_in.channel_no.eq(channel)
+                yield dut.channel_stream_in.last.eq(channel == nr_channels - 1)
+                yield dut.channel_stream_in.valid.eq(1)
+                yield
+                while not (yield dut.channel_stream_in.ready):
+                    yield
+        yield dut.channel_stream_in.valid.eq(0)
+        yield
+
+    def send_packet(packet_frames):
+        """ starts a packet and returns (frames handed over, bytes received) """
+        yield dut.packet_frames.eq(packet_frames)
+        yield dut.start_packet.eq(1)
+        yield Settle()
+        handed = (yield dut.packet_frames_handed)
+        yield
+        yield dut.start_packet.eq(0)
+
+        received = []
+        for _ in range(4 * max_frames * nr_channels * subslot_size):
+            yield Settle()
+            if (yield dut.usb_stream_out.valid):
+                received.append((yield dut.usb_stream_out.payload))
+                if (yield dut.usb_stream_out.last):
+                    break
+            yield
+        yield
+        return handed, received
+
+    def process():
+        yield dut.subslot_size.eq(subslot_size)
+        yield dut.usb_stream_out.ready.eq(1)
+
+        # two frames in the ring, the scheduler asks for all of a packet
+        yield from write_frames(0, 2)
+        assert (yield dut.frames_available) == 2
+        packets.append((yield from send_packet(max_frames)))
+        assert (yield dut.frames_available) == 0, "frames_available wrapped"
+
+        # an empty ring still gives an empty packet
+        packets.append((yield from send_packet(max_frames)))
+        assert (yield dut.frames_available) == 0, "frames_available wrapped"
+
+        # the following frames are sent in order
+        yield from write_frames(2, 3)
+        assert (yield dut.frames_available) == 3
+        packets.append((yield from send_packet(3)))
+        assert (yield dut.frames_available) == 0
+
+    sim = Simulator(dut)
+    sim.add_clock(1.0/60e6,)
+    sim.add_sync_process(process)
+    sim.run()
+
+    def frame_bytes(frames):
+        return [byte for frame in frames for channel in range(nr_channels)
+                for byte in subslot_bytes(sample_value(frame, channel), subslot_size)]
+
+    assert packets == [
+        (2, frame_bytes([0, 1])),
+        (0, []),
+        (3, frame_bytes([2, 3, 4])),
+    ]
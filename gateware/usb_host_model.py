@@ -0,0 +1,493 @@
+import struct
+from collections import deque
+
+from amaranth.sim import Passive
+
+#
+# simulation models of a ULPI PHY and a high speed USB host,
+# used by deca_usb2_audio_interface-bench.py
+#
+
+# packet identifiers, with their check nibble
+PID_OUT   = 0xe1
+PID_IN    = 0x69
+PID_SOF   = 0xa5
+PID_SETUP = 0x2d
+PID_DATA0 = 0xc3
+PID_DATA1 = 0x4b
+PID_DATA2 = 0x87
+PID_MDATA = 0x0f
+PID_ACK   = 0xd2
+PID_NAK   = 0x5a
+PID_STALL = 0x1e
+PID_NYET  = 0x96
+
+DATA_PIDS = [PID_DATA0, PID_DATA1, PID_DATA2, PID_MDATA]
+
+def crc5(value, nr_bits=11):
+    """ token CRC, over the address and endpoint or the frame number, LSB first """
+    crc = 0x1f
+    for bit_no in range(nr_bits):
+        if (crc ^ (value >> bit_no)) & 1:
+            crc = (crc >> 1) ^ 0x14
+        else:
+            crc >>= 1
+    return crc ^ 0x1f
+
+def crc16(data):
+    """ data packet CRC, returned in the order it goes on the bus """
+    crc = 0xffff
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0xa001
+            else:
+                crc >>= 1
+    return struct.pack("<H", crc ^ 0xffff)
+
+def token_packet(pid, address=0, endpoint=0):
+    field = address | (endpoint << 7)
+    return bytes([pid]) + struct.pack("<H", field | (crc5(field) << 11))
+
+def sof_packet(frame_number):
+    field = frame_number & 0x7ff
+    return bytes([PID_SOF]) + struct.pack("<H", field | (crc5(field) << 11))
+
+def data_packet(pid, payload):
+    payload = bytes(payload)
+    return bytes([pid]) + payload + crc16(payload)
+
+
+class USBStall(Exception):
+    """ the device stalled a control transfer """
+
+
+class ULPIPHYModel:
+    """ behavioral model of the ULPI side of a PHY like the USB3300 on the DECA
+
+        Packets queued by the host with send() go to the link as receive transfers,
+        the packets the link transmits are collected in received. Changes of the line state
+        are reported with RX CMDs. Must run as a sync process in the usb domain:
+        the link outputs are read as they were before the clock edge.
+    """
+    # ULPI commands, in the top two bits of the byte the link sends
+    COMMAND_TRANSMIT       = 0b01
+    COMMAND_REGISTER_WRITE = 0b10
+    COMMAND_REGISTER_READ  = 0b11
+
+    # registers come in groups of write, set and clear addresses, starting at this address
+    FIRST_WRITABLE_REGISTER = 0x04
+    FUNCTION_CONTROL        = 0x04
+    REGISTER_DEFAULTS       = { 0x00: 0x24, 0x01: 0x04, 0x02: 0x04, 0x03: 0x00, 0x04: 0x41, 0x07: 0x00, 0x0a: 0x06 }
+
+    LINE_STATE_SE0 = 0b00
+    LINE_STATE_J   = 0b01
+    LINE_STATE_K   = 0b10
+    RX_CMD_VBUS_VALID = 0b11 << 2
+    RX_CMD_RX_ACTIVE  = 1 << 4
+
+    OPERATING_MODE_CHIRP = 0b10
+
+    def __init__(self, ulpi):
+        self._ulpi          = ulpi
+        self.registers      = dict(self.REGISTER_DEFAULTS)
+        # the pull-up of the device makes the host see a J after power up
+        self.line_state     = self.LINE_STATE_J
+        self.vbus_valid     = True
+        self.received       = deque()
+        # number of high speed chirps the device sent
+        self.chirps         = 0
+
+        self._to_link        = deque()
+        self._receiving      = False
+        self._rx_cmd_pending = True
+
+    @property
+    def operating_mode(self):
+        return (self.registers[self.FUNCTION_CONTROL] >> 3) & 0b11
+
+    @property
+    def high_speed(self):
+        """ the link switched the transceiver to high speed, with high speed terminations """
+        return (self.registers[self.FUNCTION_CONTROL] & 0b111) == 0
+
+    def idle(self):
+        return not self._to_link and not self._receiving
+
+    def send(self, packet):
+        """ queues a packet from the host for the link """
+        self._to_link.append(bytes(packet))
+
+    def set_line_state(self, line_state):
+        self.line_state      = line_state
+        self._rx_cmd_pending = True
+
+    def _rx_cmd(self, line_state, rx_active=False):
+        return line_state | (self.RX_CMD_VBUS_VALID if self.vbus_valid else 0) | \
+               (self.RX_CMD_RX_ACTIVE if rx_active else 0)
+
+    def process(self):
+        ulpi = self._ulpi
+        # the simulation ends when the host is done
+        yield Passive()
+        yield ulpi.dir.i.eq(0)
+        yield ulpi.nxt.i.eq(0)
+
+        while True:
+            command = yield ulpi.data.o
+            # commands of the link take priority, we only turn the bus around when it is idle
+            if command != 0:
+                command_type = command >> 6
+                if command_type == self.COMMAND_TRANSMIT:
+                    yield from self._link_transmit(command & 0xf)
+                elif command_type == self.COMMAND_REGISTER_WRITE:
+                    yield from self._register_write(command & 0x3f)
+                elif command_type == self.COMMAND_REGISTER_READ:
+                    yield from self._register_read(command & 0x3f)
+                else:
+                    yield
+            elif self._to_link:
+                self._receiving = True
+                yield from self._link_receive(self._to_link.popleft())
+                self._receiving = False
+            elif self._rx_cmd_pending:
+                yield from self._send_rx_cmd()
+            else:
+                yield
+
+    def _link_transmit(self, pid):
+        ulpi = self._ulpi
+        # the transmit command carries the PID, or none for the chirp
+        packet = [pid | ((~pid & 0xf) << 4)] if pid else []
+        yield ulpi.nxt.i.eq(1)
+        yield
+
+        while True:
+            yield
+            stop = yield ulpi.stp.o
+            if stop:
+                break
+            if pid:
+                packet.append((yield ulpi.data.o))
+
+        yield ulpi.nxt.i.eq(0)
+
+        if pid:
+            self.received.append(bytes(packet))
+        elif self.operating_mode == self.OPERATING_MODE_CHIRP:
+            self.chirps += 1
+
+    def _register_address(self, address):
+        offset = (address - self.FIRST_WRITABLE_REGISTER) % 3 if address >= self.FIRST_WRITABLE_REGISTER else 0
+        return address - offset, offset
+
+    def _register_write(self, address):
+        ulpi = self._ulpi
+        yield ulpi.nxt.i.eq(1)
+        yield
+        yield
+        value = yield ulpi.data.o
+        yield ulpi.nxt.i.eq(0)
+        yield
+        assert (yield ulpi.stp.o), "register write without stop"
+
+        register, operation = self._register_address(address)
+        current = self.registers.get(register, 0)
+        self.registers[register] = [value, current | value, current & ~value][operation]
+
+    def _register_read(self, address):
+        ulpi = self._ulpi
+        register, _ = self._register_address(address)
+        yield ulpi.nxt.i.eq(1)
+        yield
+        # turnaround
+        yield ulpi.nxt.i.eq(0)
+        yield ulpi.dir.i.eq(1)
+        yield
+        yield ulpi.data.i.eq(self.registers.get(register, 0))
+        yield
+        yield ulpi.dir.i.eq(0)
+        yield
+
+    def _send_rx_cmd(self):
+        ulpi = self._ulpi
+        self._rx_cmd_pending = False
+        yield ulpi.dir.i.eq(1)
+        yield
+        yield ulpi.data.i.eq(self._rx_cmd(self.line_state))
+        yield
+        yield ulpi.dir.i.eq(0)
+        yield
+
+    def _link_receive(self, packet):
+        ulpi = self._ulpi
+        # DIR and NXT together start the receive, followed by the turnaround cycle
+        yield ulpi.dir.i.eq(1)
+        yield ulpi.nxt.i.eq(1)
+        yield
+        # the line leaves squelch
+        yield ulpi.nxt.i.eq(0)
+        yield ulpi.data.i.eq(self._rx_cmd(self.LINE_STATE_J, rx_active=True))
+        yield
+        yield ulpi.nxt.i.eq(1)
+        for byte in packet:
+            yield ulpi.data.i.eq(byte)
+            yield
+        # end of packet: RxActive drops
+        yield ulpi.nxt.i.eq(0)
+        yield ulpi.data.i.eq(self._rx_cmd(self.line_state))
+        yield
+        yield ulpi.dir.i.eq(0)
+        yield
+
+
+class USBHostModel:
+    """ high speed host which talks to the device through a ULPIPHYModel
+
+        Runs in a sync process of the usb domain. Once the bus reset is done, a SOF
+        starts every microframe and the periodic handlers run right after it,
+        in between the control transactions, like a host controller schedules them.
+        A periodic handler is a generator function which gets the microframe number.
+    """
+    CYCLES_PER_MICROFRAME  = 7500
+    # the device has to answer within 192 bit times,
+    # plus the delays of the PHYs
+    RESPONSE_TIMEOUT       = 128
+    MAX_RETRIES            = 16
+    CONTROL_MAX_PACKET_SIZE = 64
+
+    # bus reset: SE0 until the device chirps, then this many K-J pairs of 3us
+    HOST_CHIRP_PAIRS       = 8
+    HOST_CHIRP_CYCLES      = 180
+    DEVICE_CHIRP_TIMEOUT   = 5 * 60000
+
+    def __init__(self, phy):
+        self._phy       = phy
+        self.cycle      = 0
+        self.address    = 0
+        self.microframe = 0
+        self.periodic   = []
+        self.errors     = { "timeouts": 0, "crc_errors": 0, "pid_errors": 0, "toggle_errors": 0, "late_microframes": 0 }
+        self.naks       = 0
+
+        self._next_sof    = None
+        self._in_periodic = False
+
+    def tick(self):
+        yield
+        self.cycle += 1
+
+    def transaction_boundary(self):
+        """ starts the next microframe if it is due, transactions are never interrupted """
+        if self._next_sof is not None and not self._in_periodic and self.cycle >= self._next_sof:
+            yield from self._start_of_microframe()
+
+    def wait(self, cycles):
+        for _ in range(int(cycles)):
+            yield from self.transaction_boundary()
+            yield from self.tick()
+
+    def time(self):
+        """ simulated time in seconds """
+        return self.cycle / (self.CYCLES_PER_MICROFRAME * 8000)
+
+    def _start_of_microframe(self):
+        self._in_periodic = True
+        if self.cycle > self._next_sof + self.CYCLES_PER_MICROFRAME // 10:
+            self.errors["late_microframes"] += 1
+
+        yield from self.send(sof_packet(self.microframe // 8))
+        for handler in self.periodic:
+            yield from handler(self.microframe)
+
+        self.microframe += 1
+        self._next_sof  += self.CYCLES_PER_MICROFRAME
+        self._in_periodic = False
+
+    #
+    # packet level
+    #
+    def send(self, packet):
+        self._phy.send(packet)
+        while not self._phy.idle():
+            yield from self.tick()
+
+    def send_token(self, pid, endpoint):
+        yield from self.send(token_packet(pid, self.address, endpoint))
+
+    def receive(self):
+        """ the next packet from the device as (pid, payload), or None on timeout or error """
+        for _ in range(self.RESPONSE_TIMEOUT):
+            if self._phy.received:
+                break
+            yield from self.tick()
+        else:
+            self.errors["timeouts"] += 1
+            return None
+
+        packet = self._phy.received.popleft()
+        pid = packet[0]
+        if (pid & 0xf) != (~pid >> 4) & 0xf:
+            self.errors["pid_errors"] += 1
+            return None
+
+        if pid in DATA_PIDS:
+            payload = packet[1:-2]
+            if crc16(payload) != packet[-2:]:
+                self.errors["crc_errors"] += 1
+                return None
+            return pid, payload
+
+        return pid, b""
+
+    #
+    # bus reset and high speed detection
+    #
+    def bus_reset(self):
+        phy = self._phy
+        chirps = phy.chirps
+        phy.set_line_state(phy.LINE_STATE_SE0)
+
+        for _ in range(self.DEVICE_CHIRP_TIMEOUT):
+            if phy.chirps != chirps:
+                break
+            yield from self.tick()
+        else:
+            raise AssertionError("the device did not chirp, it is not high speed capable")
+
+        for _ in range(self.HOST_CHIRP_PAIRS):
+            phy.set_line_state(phy.LINE_STATE_K)
+            yield from self.wait(self.HOST_CHIRP_CYCLES)
+            phy.set_line_state(phy.LINE_STATE_J)
+            yield from self.wait(self.HOST_CHIRP_CYCLES)
+
+        # high speed idle is squelch
+        phy.set_line_state(phy.LINE_STATE_SE0)
+        yield from self.wait(self.HOST_CHIRP_CYCLES)
+        assert phy.high_speed, "the device did not switch to high speed"
+
+        self.address    = 0
+        self._next_sof  = self.cycle
+
+    #
+    # control transfers
+    #
+    def _retry(self, transaction):
+        for _ in range(self.MAX_RETRIES):
+            yield from self.transaction_boundary()
+            response = yield from transaction()
+            if response is None:
+                continue
+            pid, _ = response
+            if pid == PID_STALL:
+                raise USBStall()
+            if pid == PID_NAK:
+                self.naks += 1
+                yield from self.wait(self.RESPONSE_TIMEOUT)
+                continue
+            return response
+        raise AssertionError(f"no response from the device after {self.MAX_RETRIES} tries")
+
+    def _setup_transaction(self, setup):
+        def transaction():
+            yield from self.send_token(PID_SETUP, 0)
+            yield from self.send(data_packet(PID_DATA0, setup))
+            return (yield from self.receive())
+        pid, _ = yield from self._retry(transaction)
+        if pid != PID_ACK:
+            self.errors["pid_errors"] += 1
+
+    def _in_transaction(self, endpoint, toggle):
+        def transaction():
+            yield from self.send_token(PID_IN, endpoint)
+            response = yield from self.receive()
+            if response is not None and response[0] in DATA_PIDS:
+                yield from self.send(bytes([PID_ACK]))
+            return response
+
+        while True:
+            pid, payload = yield from self._retry(transaction)
+            if pid == [PID_DATA0, PID_DATA1][toggle]:
+                return payload
+            # the device missed our ACK and sent the last packet again
+            self.errors["toggle_errors"] += 1
+
+    def _out_transaction(self, endpoint, toggle, payload):
+        def transaction():
+            yield from self.send_token(PID_OUT, endpoint)
+            yield from self.send(data_packet([PID_DATA0, PID_DATA1][toggle], payload))
+            return (yield from self.receive())
+        pid, _ = yield from self._retry(transaction)
+        if pid != PID_ACK:
+            self.errors["pid_errors"] += 1
+
+    def control_transfer(self, request_type, request, value, index, data_or_length):
+        """ runs a control transfer on EP0 and returns the data of an IN transfer """
+        is_in  = bool(request_type & 0x80)
+        length = data_or_length if is_in else len(data_or_length)
+        max_packet_size = self.CONTROL_MAX_PACKET_SIZE
+
+        yield from self._setup_transaction(struct.pack("<BBHHH", request_type, request, value, index, length))
+
+        data   = b""
+        toggle = 1
+        if is_in:
+            while len(data) < length:
+                payload = yield from self._in_transaction(0, toggle)
+                data   += payload
+                toggle ^= 1
+                if len(payload) < max_packet_size:
+                    break
+            # status stage
+            yield from self._out_transaction(0, 1, b"")
+        else:
+            for position in range(0, length, max_packet_size):
+                yield from self._out_transaction(0, toggle, data_or_length[position:position + max_packet_size])
+                toggle ^= 1
+            yield from self._in_transaction(0, 1)
+
+        return data
+
+    def get_descriptor(self, descriptor_type, index=0, length=255):
+        return (yield from self.control_transfer(0x80, 0x06, (descriptor_type << 8) | index, 0, length))
+
+    def set_address(self, address):
+        yield from self.control_transfer(0x00, 0x05, address, 0, b"")
+        self.address = address
+
+    def set_configuration(self, configuration):
+        yield from self.control_transfer(0x00, 0x09, configuration, 0, b"")
+
+    def set_interface(self, interface, alt_setting):
+        yield from self.control_transfer(0x01, 0x0b, alt_setting, interface, b"")
+
+    #
+    # isochronous transactions, for the periodic handlers
+    #
+    def isochronous_out(self, endpoint, payload, max_packet_size):
+        """ sends payload in as many transactions as needed, with the high bandwidth data PIDs """
+        transactions = [payload[position:position + max_packet_size]
+                        for position in range(0, len(payload), max_packet_size)] or [b""]
+        pids = {1: [PID_DATA0], 2: [PID_MDATA, PID_DATA1], 3: [PID_MDATA, PID_MDATA, PID_DATA2]}[len(transactions)]
+        for pid, transaction in zip(pids, transactions):
+            yield from self.send_token(PID_OUT, endpoint)
+            yield from self.send(data_packet(pid, transaction))
+
+    def isochronous_in(self, endpoint, max_transactions=1):
+        """ the data of one microframe, None if the device did not answer """
+        data = b""
+        for _ in range(max_transactions):
+            yield from self.send_token(PID_IN, endpoint)
+            response = yield from self.receive()
+            if response is None:
+                return None
+            pid, payload = response
+            if pid not in DATA_PIDS:
+                self.errors["pid_errors"] += 1
+                return None
+            data += payload
+            # the last transaction of a microframe is always DATA0
+            if pid == PID_DATA0:
+                break
+        return data
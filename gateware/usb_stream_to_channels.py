@@ -12,6 +12,8 @@ class USBStreamToChannels(Elaboratable):
         # ports
         self.usb_stream_in       = StreamInterface(name="usb_stream")
         self.channel_stream_out  = StreamInterface(name="channel_stream", payload_width=24, extra_fields=[("channel_no", self._channel_bits)])
+        # bytes per sample on USB: 4 (24 bit, padded), 3 (24 bit, packed) or 2 (16 bit)
+        self.subslot_size        = Signal(3, reset=4)
 
     def elaborate(self, platform: Platform) -> Module:
         m = Module()
@@ -31,21 +33,37 @@ class USBStreamToChannels(Elaboratable):
             self.usb_stream_in.ready.eq(out_ready),
         ]
 
-        m.d.sync += [
-            self.channel_stream_out.valid.eq(0),
-            self.channel_stream_out.first.eq(0),
-            self.channel_stream_out.last.eq(0),
-        ]
+        # hold the sample until it is taken
+        with m.If(out_ready):
+            m.d.sync += [
+                self.channel_stream_out.valid.eq(0),
+                self.channel_stream_out.first.eq(0),
+                self.channel_stream_out.last.eq(0),
+            ]
 
         with m.If(usb_valid & out_ready):
             with m.FSM():
+                # first byte of a subslot
                 with m.State("B0"):
                     with m.If(usb_first):
                         m.d.sync += out_channel_no.eq(0)
                     with m.Else():
                         m.d.sync += out_channel_no.eq(out_channel_no + 1)
 
-                    m.next = "B1"
+                    with m.Switch(self.subslot_size):
+                        # 24 bit sample, left justified in 32 bit: skip the padding byte
+                        with m.Case(4):
+                            m.next = "B1"
+
+                        # packed 24 bit sample: this is the LSB
+                        with m.Case(3):
+                            m.d.sync += out_sample[:8].eq(usb_payload)
+                            m.next = "B2"
+
+                        # 16 bit sample: this is the LSB, the lower 8 bits of the output stay zero
+                        with m.Case(2):
+                            m.d.sync += out_sample.eq(usb_payload << 8)
+                            m.next = "B3"
 
                 with m.State("B1"):
                     m.d.sync += out_sample[:8].eq(usb_payload)
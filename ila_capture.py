@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+#
+# headless ILA capture: streams the samples from EP3 IN with queued asynchronous
+# libusb transfers and writes every capture to disk, as long as the ILA keeps triggering
+#
+# usage: ila_capture.py [--output DIR] [--captures N] [--vcd] [--fake]
+#
+# Each capture is stored as capture-NNNNN.npz with one array per signal,
+# --vcd additionally writes capture-NNNNN.vcd for gtkwave.
+#
+import os
+import sys
+import random
+import argparse
+import threading
+import queue
+
+import numpy as np
+
+from device_protocol import VENDOR_ID, PRODUCT_ID, ILA_INTERFACE, ILA_ENDPOINT
+
+# see gateware/compressed_ila.py
+REPEAT_SIGNAL = "ila_repeat"
+
+def decode_samples(raw, layout, bytes_per_sample):
+    """ decodes the raw little endian samples of the ILA into one array per signal
+
+        layout is a list of (name, width) in the order of the ILA signals,
+        the first signal is in the least significant bits of a sample.
+    """
+    raw = np.frombuffer(raw, dtype=np.uint8)
+    assert len(raw) % bytes_per_sample == 0, "incomplete sample"
+
+    bits = np.unpackbits(raw.reshape(-1, bytes_per_sample), axis=1, bitorder="little")
+    nr_samples = bits.shape[0]
+
+    columns  = {}
+    position = 0
+    for name, width in layout:
+        assert width <= 64, f"{name} is wider than 64 bits"
+        signal_bits = np.zeros((nr_samples, 64), dtype=np.uint8)
+        signal_bits[:, :width] = bits[:, position:position + width]
+        values = np.packbits(signal_bits, axis=1, bitorder="little").view("<u8").ravel()
+        columns[name] = values.astype(np.min_scalar_type(2**width - 1))
+        position += width
+
+    return columns
+
+def expand_runs(columns):
+    """ compressed captures store how many more cycles each entry stayed the same
+        in the ila_repeat column, expand them to one sample per cycle
+    """
+    if REPEAT_SIGNAL not in columns:
+        return columns
+    counts = columns[REPEAT_SIGNAL].astype(np.int64) + 1
+    return { name: np.repeat(values, counts) for name, values in columns.items() if name != REPEAT_SIGNAL }
+
+def encode_samples(columns, layout, bytes_per_sample):
+    """ the inverse of decode_samples, used by the fake device """
+    nr_samples = len(columns[layout[0][0]])
+    bits = np.zeros((nr_samples, 8 * bytes_per_sample), dtype=np.uint8)
+
+    position = 0
+    for name, width in layout:
+        values = np.asarray(columns[name], dtype="<u8").reshape(-1, 1).view(np.uint8)
+        bits[:, position:position + width] = np.unpackbits(values, axis=1, bitorder="little")[:, :width]
+        position += width
+
+    return np.packbits(bits, axis=1, bitorder="little").tobytes()
+
+
+class USBCaptureSource:
+    """ reads the ILA sample stream with a queue of asynchronous bulk transfers,
+        so the endpoint is polled all the time and the ILA never has to wait for us
+    """
+    def __init__(self, nr_transfers=16, transfer_size=64 * 1024):
+        self._nr_transfers  = nr_transfers
+        self._transfer_size = transfer_size
+
+    def chunks(self):
+        import usb1
+
+        chunks  = queue.Queue()
+        stop    = threading.Event()
+
+        def transfer_done(transfer):
+            status = transfer.getStatus()
+            if status not in [usb1.TRANSFER_COMPLETED, usb1.TRANSFER_TIMED_OUT]:
+                chunks.put(None)
+                return
+            # a timed out transfer may still have received some data
+            if transfer.getActualLength() > 0:
+                chunks.put(bytes(transfer.getBuffer()[:transfer.getActualLength()]))
+            if not stop.is_set():
+                transfer.submit()
+
+        with usb1.USBContext() as context:
+            handle = context.openByVendorIDAndProductID(VENDOR_ID, PRODUCT_ID, skip_on_error=True)
+            if handle is None:
+                sys.exit("USB audio interface not found")
+
+            with handle.claimInterface(ILA_INTERFACE):
+                transfers = []
+                for _ in range(self._nr_transfers):
+                    transfer = handle.getTransfer()
+                    transfer.setBulk(ILA_ENDPOINT, self._transfer_size, callback=transfer_done, timeout=1000)
+                    transfer.submit()
+                    transfers.append(transfer)
+
+                def handle_events():
+                    while any(transfer.isSubmitted() for transfer in transfers):
+                        context.handleEvents()
+
+                event_thread = threading.Thread(target=handle_events, daemon=True)
+                event_thread.start()
+
+                try:
+                    while True:
+                        chunk = chunks.get()
+                        if chunk is None:
+                            break
+                        yield chunk
+                finally:
+                    stop.set()
+                    for transfer in transfers:
+                        if transfer.isSubmitted():
+                            transfer.cancel()
+                    event_thread.join()
+
+
+class FakeCaptureSource:
+    """ stands in for the device: sends random captures in chunks of random size,
+        like the USB transfers would deliver them
+    """
+    def __init__(self, layout, bytes_per_sample, sample_depth, nr_captures, seed=0):
+        rng = np.random.default_rng(seed)
+        self.captures = [
+            { name: rng.integers(0, 2**width, size=sample_depth, dtype=np.uint64) for name, width in layout }
+            for _ in range(nr_captures)
+        ]
+        self._data = b"".join(encode_samples(capture, layout, bytes_per_sample) for capture in self.captures)
+        self._random = random.Random(seed)
+
+    def chunks(self):
+        position = 0
+        while position < len(self._data):
+            size = self._random.choice([512, 4096, 64 * 1024])
+            yield self._data[position:position + size]
+            position += size
+
+
+class CaptureWriter:
+    """ writes each capture as compressed columns, optionally also as VCD """
+    def __init__(self, directory, layout, sample_period, vcd=False):
+        self._directory     = directory
+        # compressed captures are expanded before they are written
+        self._layout        = [(name, width) for name, width in layout if name != REPEAT_SIGNAL]
+        self._sample_period = sample_period
+        self._vcd           = vcd
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, capture_no, columns):
+        basename = os.path.join(self._directory, f"capture-{capture_no:05d}")
+        np.savez_compressed(basename + ".npz", sample_period=self._sample_period, **columns)
+        if self._vcd:
+            self._write_vcd(basename + ".vcd", columns)
+
+    def _write_vcd(self, filename, columns):
+        from vcd import VCDWriter
+
+        period_ns = max(round(self._sample_period * 1e9), 1)
+        with open(filename, "w") as f, VCDWriter(f, timescale="1 ns", date="today") as writer:
+            variables = { name: writer.register_var("ila", name, "wire", size=width) for name, width in self._layout }
+
+            # only the samples where a signal changes go into the file, in time order
+            changed = { name: np.diff(columns[name], prepend=~columns[name][:1]) != 0 for name, _ in self._layout }
+            for index in np.flatnonzero(np.logical_or.reduce(list(changed.values()))):
+                for name, _ in self._layout:
+                    if changed[name][index]:
+                        writer.change(variables[name], int(index) * period_ns, int(columns[name][index]))
+
+
+def capture(source, layout, bytes_per_sample, sample_depth, writer, nr_captures=None):
+    """ splits the sample stream into captures of sample_depth samples and writes them,
+        returns the number of captures written
+    """
+    capture_bytes = sample_depth * bytes_per_sample
+    buffer        = bytearray()
+    capture_no    = 0
+
+    for chunk in source.chunks():
+        buffer += chunk
+        while len(buffer) >= capture_bytes:
+            columns = decode_samples(bytes(buffer[:capture_bytes]), layout, bytes_per_sample)
+            writer.write(capture_no, expand_runs(columns))
+            del buffer[:capture_bytes]
+            capture_no += 1
+            if capture_no == nr_captures:
+                return capture_no
+
+    return capture_no
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output",   default="ila-captures", help="directory for the captures")
+    parser.add_argument("--captures", type=int, default=None, help="stop after this many captures")
+    parser.add_argument("--vcd",      action="store_true", help="also write a VCD file of each capture")
+    parser.add_argument("--transfers", type=int, default=16, help="number of queued USB transfers")
+    parser.add_argument("--fake",     action="store_true", help="use random captures instead of the device")
+    args = parser.parse_args()
+
+    if args.fake:
+        layout, bytes_per_sample, sample_depth, sample_period = [("a", 1), ("b", 12), ("c", 24)], 5, 1024, 1 / 60e6
+        source = FakeCaptureSource(layout, bytes_per_sample, sample_depth, nr_captures=args.captures or 4)
+    else:
+        # the parameters pickled by the gateware build, see gateware/deca_usb2_audio_interface.py
+        from amlib.debug.ila import ILACoreParameters
+
+        ila = ILACoreParameters.unpickle()
+        layout           = [(signal.name, len(signal)) for signal in ila.signals]
+        bytes_per_sample = ila.bytes_per_sample
+        sample_depth     = ila.sample_depth
+        sample_period    = ila.sample_period
+        source = USBCaptureSource(nr_transfers=args.transfers)
+
+    writer = CaptureWriter(args.output, layout, sample_period, vcd=args.vcd)
+    try:
+        nr_written = capture(source, layout, bytes_per_sample, sample_depth, writer, args.captures)
+    except KeyboardInterrupt:
+        nr_written = None
+
+    if nr_written is not None:
+        print(f"{nr_written} captures written to {args.output}")
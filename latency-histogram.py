@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+#
+# reads the playback and record latency histograms of the interface
+#
+# usage: latency-histogram.py [--clear]
+#
+import sys
+
+from device_protocol import find_device, vendor_request, read_words, \
+    REQUEST_READ_HISTOGRAM, REQUEST_CLEAR_HISTOGRAMS, MAX_REQUEST_LENGTH, \
+    HISTOGRAM_BINS, HISTOGRAM_BIN_SHIFT, USB_CLOCK_FREQUENCY
+
+BINS_PER_REQUEST = MAX_REQUEST_LENGTH // 4
+
+def read_histogram(dev, histogram):
+    bins = []
+    for first_bin in range(0, HISTOGRAM_BINS, BINS_PER_REQUEST):
+        bins += read_words(dev, REQUEST_READ_HISTOGRAM, histogram, first_bin, BINS_PER_REQUEST)
+    return bins
+
+def print_histogram(name, bins):
+    count = sum(bins)
+    print(f"{name}: {count} measurements")
+    if count == 0:
+        return
+
+    bin_us = 2**HISTOGRAM_BIN_SHIFT / USB_CLOCK_FREQUENCY * 1e6
+    peak   = max(bins)
+    total  = 0
+    for bin_no, value in enumerate(bins):
+        total += value
+        if value == 0:
+            continue
+        upper = "  +  " if bin_no == HISTOGRAM_BINS - 1 else f"{(bin_no + 1) * bin_us:7.1f}"
+        print(f"{bin_no * bin_us:7.1f} - {upper} us {value:10d} {100 * total / count:6.2f}% {'#' * round(50 * value / peak)}")
+
+dev = find_device()
+
+if "--clear" in sys.argv:
+    vendor_request(dev, REQUEST_CLEAR_HISTOGRAMS)
+    print("histograms cleared")
+else:
+    print_histogram("playback (OUT packet to serial output)", read_histogram(dev, 0))
+    print()
+    print_histogram("record (ADC sample to EP2 IN)", read_histogram(dev, 1))
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+#
+# measures the round-trip latency in samples with the loopback modes of the interface
+#
+# usage: loopback-latency.py [--mode digital|analog|off] [--repeat N] [--keep]
+#                            [--device NAME] [--sample-rate HZ] [--blocksize FRAMES] [--latency SECONDS]
+#
+# digital: the interface sends the playback samples straight back to the host, bypassing the codec.
+#          A marker is played through the audio driver of the host and searched in the recording,
+#          so the result contains the buffers of the host at the given --blocksize and --latency.
+#          Needs NumPy and python-sounddevice.
+# analog:  the interface plays a marker pulse on channel 1 and detects it at the input of channel 1,
+#          the result is the latency of the codec and the FPGA. Connect line out to line in.
+#
+# The loopback is switched off again at the end, unless --keep is given.
+#
+import sys
+import time
+import argparse
+
+from device_protocol import find_device, vendor_request, read_words, \
+    REQUEST_SET_LOOPBACK, REQUEST_READ_LOOPBACK, LOOPBACK_MODES, LOOPBACK_REGISTERS
+
+# silence before the marker, so both streams are running
+LEAD_IN_SECONDS = 0.5
+MARKER_LEVEL    = 0.5
+
+def set_loopback(dev, mode):
+    vendor_request(dev, REQUEST_SET_LOOPBACK, LOOPBACK_MODES[mode])
+
+def read_loopback(dev):
+    values = read_words(dev, REQUEST_READ_LOOPBACK, 0, 0, len(LOOPBACK_REGISTERS))
+    return dict(zip(LOOPBACK_REGISTERS, values))
+
+def measure_digital(args):
+    """ plays a marker on the first channel and returns the number of samples until it is recorded """
+    import numpy as np
+    import sounddevice as sd
+
+    lead_in = int(LEAD_IN_SECONDS * args.sample_rate)
+    signal  = np.zeros((lead_in + args.sample_rate, 1), dtype=np.float32)
+    signal[lead_in] = MARKER_LEVEL
+
+    recording = sd.playrec(signal, samplerate=args.sample_rate, channels=1, device=args.device,
+                           blocksize=args.blocksize, latency=args.latency, blocking=True)
+    found = np.flatnonzero(np.abs(recording[:, 0]) > MARKER_LEVEL / 2)
+    if len(found) == 0:
+        return None
+    return int(found[0]) - lead_in
+
+def measure_analog(dev):
+    """ waits for the next detected marker and returns its latency, None after a timeout """
+    last = read_loopback(dev)
+    while True:
+        time.sleep(0.05)
+        values = read_loopback(dev)
+        if values["measurements"] != last["measurements"]:
+            return values["latency"]
+        if values["timeouts"] != last["timeouts"]:
+            return None
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--mode", default="digital", choices=LOOPBACK_MODES.keys(), help="loopback mode")
+parser.add_argument("--repeat", type=int, default=5, help="number of measurements")
+parser.add_argument("--keep", action="store_true", help="leave the loopback on when done")
+parser.add_argument("--device", default="DECAface", help="host audio device, for the digital loopback")
+parser.add_argument("--sample-rate", type=int, default=48000, help="sample rate of the digital loopback")
+parser.add_argument("--blocksize", type=int, default=0, help="host buffer size in frames, 0 lets the driver choose")
+parser.add_argument("--latency", default="low",
+                    help="suggested host latency in seconds, or low / high")
+args = parser.parse_args()
+
+if args.latency not in ["low", "high"]:
+    args.latency = float(args.latency)
+
+dev = find_device()
+
+set_loopback(dev, args.mode)
+if args.mode == "off":
+    sys.exit(0)
+
+try:
+    results = []
+    for _ in range(args.repeat):
+        latency = measure_digital(args) if args.mode == "digital" else measure_analog(dev)
+        if latency is None:
+            print("marker not found")
+            continue
+
+        print(f"{latency} samples")
+        results.append(latency)
+
+    if results:
+        print(f"min {min(results)}  max {max(results)}  mean {sum(results) / len(results):.1f} samples "
+              f"in {len(results)} of {args.repeat} measurements")
+
+finally:
+    if not args.keep:
+        set_loopback(dev, "off")
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+#
+# polls the telemetry registers of the interface
+#
+# usage: telemetry-monitor.py [--interval SECONDS] [--once] [--clear]
+#
+import time
+import argparse
+
+from device_protocol import find_device, vendor_request, read_words, \
+    REQUEST_READ_TELEMETRY, REQUEST_CLEAR_TELEMETRY, TELEMETRY_REGISTERS
+
+COUNTERS = ["underflows", "jitter_buffer_underruns", "record_overflows", "sof_count", "altsetting_changes"]
+
+def read_telemetry(dev):
+    values = read_words(dev, REQUEST_READ_TELEMETRY, 0, 0, len(TELEMETRY_REGISTERS))
+    return dict(zip(TELEMETRY_REGISTERS, values))
+
+def format_value(name, value):
+    if name == "feedback_value":
+        return f"{value / 2**16:.5f} samples/microframe"
+    return str(value)
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--interval", type=float, default=1.0, help="seconds between polls")
+parser.add_argument("--once",  action="store_true", help="read the registers once and exit")
+parser.add_argument("--clear", action="store_true", help="clear the counters and high-water marks first")
+args = parser.parse_args()
+
+dev = find_device()
+
+if args.clear:
+    vendor_request(dev, REQUEST_CLEAR_TELEMETRY)
+
+last = None
+while True:
+    values = read_telemetry(dev)
+    print(time.strftime("%Y-%m-%d %H:%M:%S"))
+    for name, value in values.items():
+        # show how much the counters grew since the last poll
+        delta = f" (+{value - last[name]})" if last and name in COUNTERS and value > last[name] else ""
+        print(f"  {name:26s} {format_value(name, value)}{delta}")
+    last = values
+
+    if args.once:
+        break
+    time.sleep(args.interval)
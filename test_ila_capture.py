@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+#
+# tests the ILA capture decoder with the fake device
+#
+# run with: python -m pytest test_ila_capture.py
+#
+import numpy as np
+import pytest
+
+from ila_capture import FakeCaptureSource, CaptureWriter, capture
+
+LAYOUTS = [
+    # (layout, bytes per sample)
+    ([("valid", 1), ("payload", 8), ("first", 1), ("last", 1)], 2),
+    ([("sample", 24), ("channel_no", 5), ("level", 11), ("feedback", 32)], 9),
+    ([("wide", 64), ("bit", 1)], 9),
+]
+
+@pytest.mark.parametrize("layout, bytes_per_sample", LAYOUTS)
+def test_fake_captures_are_decoded(layout, bytes_per_sample, tmp_path):
+    sample_depth = 1000
+    source = FakeCaptureSource(layout, bytes_per_sample, sample_depth, nr_captures=3)
+    writer = CaptureWriter(str(tmp_path), layout, sample_period=1/60e6, vcd=True)
+
+    assert capture(source, layout, bytes_per_sample, sample_depth, writer) == 3
+
+    for capture_no, expected in enumerate(source.captures):
+        decoded = np.load(tmp_path / f"capture-{capture_no:05d}.npz")
+        for name, _ in layout:
+            assert np.array_equal(decoded[name], expected[name]), name
+        assert (tmp_path / f"capture-{capture_no:05d}.vcd").exists()
+
+def test_capture_stops_after_the_requested_number(tmp_path):
+    layout = [("a", 3), ("b", 5)]
+    source = FakeCaptureSource(layout, 1, sample_depth=64, nr_captures=5)
+    writer = CaptureWriter(str(tmp_path), layout, sample_period=1/60e6)
+
+    assert capture(source, layout, 1, 64, writer, nr_captures=2) == 2
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["capture-00000.npz", "capture-00001.npz"]
+
+def test_compressed_captures_are_expanded(tmp_path):
+    layout = [("a", 4), ("ila_repeat", 3)]
+    source = FakeCaptureSource(layout, 1, sample_depth=16, nr_captures=1)
+    writer = CaptureWriter(str(tmp_path), layout, sample_period=1/60e6)
+
+    assert capture(source, layout, 1, 16, writer) == 1
+
+    expected = source.captures[0]
+    decoded  = np.load(tmp_path / "capture-00000.npz")
+    assert list(decoded["a"]) == [value for value, repeat in zip(expected["a"], expected["ila_repeat"])
+                                        for _ in range(int(repeat) + 1)]
+    assert "ila_repeat" not in decoded